@@ -0,0 +1,5 @@
+"""
+Benchmarks for the metering system.
+Each script is run from the repository root, e.g. `PYTHONPATH=$PYTHONPATH:. python bench/<script>.py`.
+
+"""
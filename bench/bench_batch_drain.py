@@ -0,0 +1,159 @@
+"""
+Throughput of the main loop with batched telegrams
+**************************************************
+
+:synopsis: Measures telegrams/s through run_system for increasing burst sizes, one telegram or one batch per wakeup.
+
+A burst of binary records is written to a FIFO, as the driver does when several dongles deliver at once,
+and the main loop takes it through FifoSource, parses, decrypts and queues MQTT messages.
+No broker is needed: a publisher stands in for the MQTT client. Like paho with loop_start(),
+publish() queues the message and wakes the network thread through a socket pair, and that thread
+marks the queued messages as sent.
+
+Two ways of handling a burst are compared:
+
+- `per-telegram`: a wakeup (select) for every telegram, each one handled and its MQTT messages waited for
+  before the next, with debug output per telegram. This is how the loop worked before.
+- `batch`: one wakeup drains the FIFO, and the whole burst is handled by `run_system.handle_batch()`,
+  which waits for the MQTT messages once.
+
+Debug output is on, as in the running system, but sent to /dev/null.
+Each case is measured `REPEAT` times, and the fastest is reported, to reduce noise from other processes.
+
+Run: `PYTHONPATH=$PYTHONPATH:. python bench/bench_batch_drain.py`
+
+"""
+
+import contextlib
+import fcntl
+import os
+import socket
+import tempfile
+import threading
+import time
+from binascii import unhexlify
+
+from paho.mqtt.client import MQTTMessageInfo, MQTT_ERR_SUCCESS  # type: ignore
+
+from driver.DriverClass import PIPE_SIZE, F_SETPIPE_SZ
+from driver.hci import HciFrame
+from driver.ipc import encode_record
+from driver.sources import FifoSource
+from meter.OmniPower import OmniPower
+from meter.prefilter import TelegramPrefilter
+import run.run_system as main_loop
+
+
+# Telegram from the OmniPower in test/test_OmniPower.py, with its key
+TELEGRAM = unhexlify(b'27442d2c5768663230028d208e11de0320188851bdc4b72dd3c2954a341be369e9089b4eb3858169494e')
+AES_KEY = '9A25139E3244CC2E391A8EF6B915B697'
+
+BURSTS = (1, 10, 100, 1000)
+TELEGRAMS = 2000        # Telegrams per measurement, in bursts
+REPEAT = 5              # Measurements per case, the fastest is reported
+
+
+class LoopbackPublisher:
+    """
+    Stands in for MqttClient. Messages are marked as published by a thread, like paho's network loop.
+    """
+
+    def __init__(self):
+        self.queued = []
+        self.mid = 0
+        self.lock = threading.Lock()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_w.setblocking(False)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def publish(self, topic, payload):
+        with self.lock:
+            self.mid += 1
+            info = MQTTMessageInfo(self.mid)
+            info.rc = MQTT_ERR_SUCCESS
+            self.queued.append(info)
+        try:
+            self.wake_w.send(b'0')
+        except BlockingIOError:
+            pass
+        return info
+
+    def run(self):
+        while True:
+            self.wake_r.recv(4096)
+            with self.lock:
+                sent, self.queued = self.queued, []
+            for info in sent:
+                info._set_as_published()
+
+
+def setup_main_loop() -> None:
+    """
+    Set the globals that run_system.py makes in its __main__ section.
+    """
+    main_loop.DEBUG_ON = True
+    main_loop.publisher = LoopbackPublisher()
+    meter_control = {
+        "ManufacturerKey": "kam",
+        "ManufacturerDeviceKey": "OmniPower1",
+        "handler": OmniPower(name="OP32666857", meter_id='32666857', aes_key=AES_KEY),
+        "mqttTopic": "v2/bench/kam-32666857/data",
+    }
+    main_loop.meter_list = {'32666857': meter_control}
+    main_loop.meter_index = {meter_control["handler"].identity: meter_control}
+    main_loop.prefilter = TelegramPrefilter(main_loop.meter_index)
+    main_loop.pool = None
+
+
+def run_case(name: str, burst: int, handle) -> None:
+    fifo_path = os.path.join(tempfile.mkdtemp(), 'IM871A_pipe')
+    os.mkfifo(fifo_path)
+    source = FifoSource(fifo_path)
+    writer = os.open(fifo_path, os.O_WRONLY)
+    fcntl.fcntl(writer, F_SETPIPE_SZ, PIPE_SIZE)     # As the driver does, so a burst fits in the FIFO
+    data = encode_record(HciFrame(b'\xa5\x82\x03' + TELEGRAM, time.time(), time.monotonic())) * burst
+
+    rates = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(REPEAT):
+            handled = 0
+            elapsed = 0.0
+            while handled < TELEGRAMS:
+                os.write(writer, data)
+                start = time.perf_counter()
+                handled += handle(source, burst)
+                elapsed += time.perf_counter() - start
+            rates.append(handled / elapsed)
+
+    print("{:13s} burst {:5d}: {:8.0f} telegrams/s".format(name, burst, max(rates)))
+    os.close(writer)
+    source.close()
+
+
+def per_telegram(source: FifoSource, burst: int) -> int:
+    handled = 0
+    while handled < burst:
+        source.wait(10)
+        records = source.records()
+        for record in records:
+            main_loop.DEBUG("Message received from IM871A")
+            main_loop.DEBUG(bytes(record[0]).hex())
+            handled += main_loop.handle_batch([record])
+            source.wait(0)      # The old loop went back to select after every telegram
+    return handled
+
+
+def batch(source: FifoSource, burst: int) -> int:
+    handled = 0
+    while handled < burst:
+        source.wait(10)
+        handled += main_loop.handle_batch(source.records())
+    return handled
+
+
+if __name__ == '__main__':
+    setup_main_loop()
+    for burst in BURSTS:
+        run_case("per-telegram", burst, per_telegram)
+        run_case("batch", burst, batch)
@@ -0,0 +1,147 @@
+"""
+Cost of parsing a C1 telegram
+*****************************
+
+:synopsis: Compares the previous C1Telegram parser with the current one, per telegram.
+
+The previous parser unhexlified the header, unpacked it with a format string, and built
+`big_endian`, `SN` and the AES prefix for every telegram, also the ones that are dropped right away.
+The current one wraps the raw bytes, unpacks the header with one precompiled Struct,
+and makes the rest on first use.
+
+Cases, each on the sample telegrams from meter/main.py:
+
+- `parse`: construct the telegram only, as for a telegram that is dropped.
+- `dispatch`: construct and read the key the main loop finds the meter by, `identity`.
+  For the previous parser, the address as a string, which is what the main loop used then.
+- `full`: construct and read everything a decrypting meter uses (identity, prefix, encrypted).
+
+The previous parser takes hex, the current one is also measured from raw bytes (`from_bytes`),
+as the main loop gets them from the driver.
+
+Run: `PYTHONPATH=$PYTHONPATH:. python bench/bench_c1telegram.py`
+
+"""
+
+import timeit
+from binascii import hexlify, unhexlify
+from struct import pack, unpack
+
+from meter.OmniPower import C1Telegram
+
+
+# Sample telegrams from meter/main.py (test4)
+TELEGRAMS = [b'27442D2C5768663230028D202E21870320D3A4F149B1B8F5783DF7434B8A66A55786499ABE7BAB59ffff',
+             b'27442d2c5768663230028d206360dd0320c42b87f46fc048d42498b44b5e34f083e93e6af16176313d9c',
+             b'2d442d2c5768663230028d206461dd032038931d14b405536e0250592f8b908138d58602eca676ff79e0caf0b14d0e7d',
+             b'27442d2c5768663230028d206562dd03200ac3aea1e613dd9af1a75c68cdedd5fdd2617c1e71a9d0b3b1',
+             b'2d442d2c5768663230028d206c81dd03202dcd10989cd870e4439ee09a309f7114681d40570623dfae7b3c6214679786',
+             b'27442d2c5768663230028d206e90dd03201dfbbd7871e6ec990f60ee940532c09e505bd4cac5728e2864']
+RAW_TELEGRAMS = [unhexlify(t) for t in TELEGRAMS]
+
+NUMBER = 20000      # Passes over the sample telegrams per measurement
+REPEAT = 5          # Measurements, the fastest is reported
+
+
+class LegacyC1Telegram:
+    """
+    The parsing part of C1Telegram before it wrapped raw bytes.
+    """
+
+    header_slice = slice(0, 17*2)
+    ell_sn_slice = slice(13*2, 17*2)
+    payload_start_byte = 17
+    im871a_crc_bytes = 2
+
+    def __init__(self, telegram: bytes) -> None:
+        header = telegram[self.header_slice]
+        self.encrypted = telegram[self.payload_start_byte * 2: len(telegram) - self.im871a_crc_bytes * 2]
+        self.decrypted = bytes()
+        self.im871_crc = telegram[len(telegram) - self.im871a_crc_bytes * 2:]
+
+        header_values = unpack('<BBHIBBBBBI', unhexlify(header))
+        self.L = header_values[0]
+        self.C = header_values[1]
+        self.M = header_values[2]
+        self.A = header_values[3]
+        self.version = header_values[4]
+        self.medium = header_values[5]
+        self.CI = header_values[6]
+        self.CC = header_values[7]
+        self.ACC = header_values[8]
+        self.AES_CTR = header_values[9]
+
+        ell_sn = self.parse_ell_sn(telegram[self.ell_sn_slice])
+        self.SN = {
+            "ENC": ell_sn[0],
+            "Time": ell_sn[1],
+            "Session": ell_sn[2],
+        }
+
+        self.big_endian = {
+            'L': hexlify(pack('>B', self.L)),
+            'C': hexlify(pack('>B', self.C)),
+            'M': hexlify(pack('>H', self.M)),
+            'A': hexlify(pack('>I', self.A)),
+            'version': hexlify(pack('>B', self.version)),
+            'medium': hexlify(pack('>B', self.medium)),
+            'CI': hexlify(pack('>B', self.CI)).upper(),
+            'CC': hexlify(pack('>B', self.CC)).upper(),
+            'ACC': hexlify(pack('>B', self.ACC)),
+            'AES_CTR': hexlify(pack('>I', self.AES_CTR)),
+        }
+
+        self.prefix = pack('<HIBBBIB', self.M, self.A, self.version, self.medium, self.CC, self.AES_CTR, 0)
+
+    @property
+    def identity(self) -> str:
+        return self.big_endian['A'].decode()
+
+    @staticmethod
+    def parse_ell_sn(sn_field: bytes):
+        ell_sn = unpack('<I', unhexlify(sn_field))[0]
+        enc = (ell_sn & (0xe << 28)) >> 29
+        time = (ell_sn & (0x1ffffff << 4)) >> 4
+        session = ell_sn & 0xf
+        return enc, time, session
+
+
+def parse(make, telegrams):
+    for t in telegrams:
+        make(t)
+
+
+def dispatch(make, telegrams):
+    for t in telegrams:
+        make(t).identity
+
+
+def full(make, telegrams):
+    for t in telegrams:
+        tlg = make(t)
+        tlg.identity
+        tlg.prefix
+        tlg.encrypted
+
+
+def measure(case, make, telegrams) -> float:
+    """
+    Microseconds per telegram.
+    """
+    best = min(timeit.repeat(lambda: case(make, telegrams), number=NUMBER, repeat=REPEAT))
+    return best / (NUMBER * len(telegrams)) * 1e6
+
+
+if __name__ == '__main__':
+    # Same results before comparing speed
+    for t in TELEGRAMS:
+        old, new = LegacyC1Telegram(t), C1Telegram(t)
+        assert (old.big_endian, old.SN, old.prefix) == (new.big_endian, new.SN, new.prefix)
+
+    print("{:10s} {:>10s} {:>10s} {:>12s}".format("case", "legacy", "hex", "from_bytes"))
+    for case in (parse, dispatch, full):
+        print("{:10s} {:8.2f}us {:8.2f}us {:10.2f}us".format(
+            case.__name__,
+            measure(case, LegacyC1Telegram, TELEGRAMS),
+            measure(case, C1Telegram, TELEGRAMS),
+            measure(case, C1Telegram.from_bytes, RAW_TELEGRAMS)))
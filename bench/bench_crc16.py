@@ -0,0 +1,83 @@
+"""
+Cost of the wm-bus CRC16
+************************
+
+:synopsis: Compares the previous CRC16 implementations with the table-driven one, per message.
+
+- `bigint`: the first implementation, the hex message as one Python integer, divided bit by bit.
+- `bitwise`: the same on bytes, 8 divisions per byte, as used when decrypting before the tables.
+- `table`: `crc16_wmbus_raw`, two table lookups per 16 bits.
+- `hex`: `crc16_wmbus`, the hex interface, now unhexlifying and using the tables.
+
+Messages are the CRC'ed parts of decrypted OmniPower payloads (short and long telegram), and a message
+of the largest size a telegram can carry.
+
+Run: `PYTHONPATH=$PYTHONPATH:. python bench/bench_crc16.py`
+
+"""
+
+import os
+import timeit
+from binascii import hexlify, unhexlify
+from struct import pack
+
+from utils.crc16_wmbus import CRC16_POLY, crc16_wmbus, crc16_wmbus_raw
+
+
+MESSAGES = [('short', unhexlify(b'79138C4491CE000000000000000300000000000000')),
+            ('long', unhexlify(b'780404CE00000004843C00000000042B0300000004AB3C00000000')),
+            ('255 bytes', os.urandom(255))]
+
+NUMBER = 2000       # Messages per measurement
+REPEAT = 5          # Measurements, the fastest is reported
+
+
+def bigint(message: bytes) -> bytes:
+    """
+    The first crc16_wmbus, taking hex.
+    """
+    crc_bits = 16
+    g = CRC16_POLY
+    m = int(message, 16) << crc_bits
+    crc = m
+    m_bitlen = len(bin(m)[2:])
+    for n in range(m_bitlen - 1, crc_bits - 1, -1):
+        if crc & (1 << n):
+            crc = (crc ^ (g << (n - crc_bits))) % 2**n
+    return hexlify(pack('<H', crc ^ 0xFFFF))
+
+
+def bitwise(message: bytes) -> int:
+    """
+    The first crc16_wmbus_raw, taking bytes.
+    """
+    crc = 0x0000
+    for byte in message:
+        crc ^= byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ CRC16_POLY) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc ^ 0xFFFF
+
+
+def measure(function, message) -> float:
+    """
+    Microseconds per message.
+    """
+    return min(timeit.repeat(lambda: function(message), number=NUMBER, repeat=REPEAT)) / NUMBER * 1e6
+
+
+if __name__ == '__main__':
+    print("{:10s} {:>10s} {:>10s} {:>10s} {:>10s}".format("message", "bigint", "bitwise", "table", "hex"))
+    for name, message in MESSAGES:
+        hex_message = hexlify(message)
+
+        # Same results before comparing speed
+        assert bigint(hex_message) == crc16_wmbus(hex_message) == hexlify(pack('<H', crc16_wmbus_raw(message)))
+        assert bitwise(message) == crc16_wmbus_raw(message)
+
+        print("{:10s} {:8.2f}us {:8.2f}us {:8.2f}us {:8.2f}us".format(
+            name, measure(bigint, hex_message), measure(bitwise, message),
+            measure(crc16_wmbus_raw, message), measure(crc16_wmbus, hex_message)))
@@ -0,0 +1,69 @@
+"""
+Cost of decrypting many telegrams at once
+*****************************************
+
+:synopsis: Compares decrypting stored telegrams one at a time with OmniPower.decrypt_batch, per telegram.
+
+Replays and backfills decrypt thousands of telegrams from the same meter.
+One at a time, every telegram makes its own AES call and XOR. `decrypt_batch` makes one AES call
+for the counter blocks of all telegrams, and one XOR over all their encrypted payloads.
+
+Cases, on `COUNT` telegrams made from the samples in meter/main.py:
+
+- `decrypt`: decryption and CRC16 check only, `decrypt_raw` per telegram against `decrypt_batch`.
+- `process`: also unpacking and logging the measurements, `process_telegram` per telegram
+  against `process_telegrams`.
+
+The CRC16 check and unpacking are still done per telegram in both, so they limit the gain.
+
+Run: `PYTHONPATH=$PYTHONPATH:. python bench/bench_decrypt_batch.py`
+
+"""
+
+import timeit
+
+from bench.bench_c1telegram import RAW_TELEGRAMS
+from meter.OmniPower import C1Telegram, OmniPower
+
+
+COUNT = 6000        # Telegrams per measurement
+REPEAT = 5          # Measurements, the fastest is reported
+
+
+def decrypt_one_by_one(meter, telegrams):
+    for t in telegrams:
+        meter.decrypt_raw(t)
+
+
+def decrypt_batch(meter, telegrams):
+    meter.decrypt_batch(telegrams)
+
+
+def process_one_by_one(meter, telegrams):
+    for t in telegrams:
+        meter.process_telegram(t)
+
+
+def process_batch(meter, telegrams):
+    meter.process_telegrams(telegrams)
+
+
+def measure(case, telegrams) -> float:
+    """
+    Microseconds per telegram, with a fresh meter (empty log) for each measurement.
+    """
+    best = min(timeit.repeat(lambda: case(OmniPower(), telegrams), number=1, repeat=REPEAT))
+    return best / len(telegrams) * 1e6
+
+
+if __name__ == '__main__':
+    telegrams = [C1Telegram.from_bytes(RAW_TELEGRAMS[i % len(RAW_TELEGRAMS)]) for i in range(COUNT)]
+
+    # Same results before comparing speed
+    meter = OmniPower()
+    assert meter.decrypt_batch(telegrams) == [meter.decrypt_raw(t) for t in telegrams]
+
+    print("{:10s} {:>12s} {:>10s}".format("case", "one-by-one", "batch"))
+    for name, one_by_one, batch in (("decrypt", decrypt_one_by_one, decrypt_batch),
+                                    ("process", process_one_by_one, process_batch)):
+        print("{:10s} {:10.2f}us {:8.2f}us".format(name, measure(one_by_one, telegrams), measure(batch, telegrams)))
@@ -0,0 +1,160 @@
+"""
+CPU cost of reading the IM871-A serial port
+*******************************************
+
+:synopsis: Measures CPU time used by the driver read loop while idle and while receiving telegrams.
+
+A pseudo-terminal (pty) stands in for the USB-dongle, so no hardware is needed.
+The slave end is opened by the driver, and the master end is used to inject
+captured IM871-A frames.
+
+Two read loops are compared:
+
+- `legacy`: the old `read(100)` loop on a port opened with `timeout=0` (busy polling).
+- `select`: the current `IM871A.read_data()`, which sleeps in select() until data arrives.
+
+CPU time is taken from the reading thread only (RUSAGE_THREAD), and reported as
+
+- CPU seconds per idle hour (extrapolated from a short idle window), and
+- CPU seconds per 1000 telegrams.
+
+Run: `PYTHONPATH=$PYTHONPATH:. python bench/bench_serial_cpu.py`
+
+"""
+
+import os
+import resource
+import tempfile
+import threading
+import time
+import tty
+from unittest import mock
+
+import serial as port  # type: ignore
+
+from driver.DriverClass import IM871A
+
+
+# Captured radio frame from IM871-A (SOF, control, msg-id, length, payload, CRC16)
+FRAME = bytes.fromhex('a5820327442d2c5768663230028d201a13e00920dddf142f84b1107cae4e84dbcb98210fc275ddc868ce8d2554')
+
+IDLE_SECONDS = 5.0
+TELEGRAMS = 1000
+
+
+def thread_cpu() -> float:
+    """
+    CPU time (user + system) used by the calling thread.
+    """
+    r = resource.getrusage(resource.RUSAGE_THREAD)
+    return r.ru_utime + r.ru_stime
+
+
+class Probe:
+    """
+    Runs a read loop in a thread and samples that thread's CPU time on request.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.samples = []
+        self.sample_now = threading.Event()
+        self.sampled = threading.Event()
+        self.stop = False
+        self.count = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stop:
+            if self.loop(self):
+                self.count += 1
+            if self.sample_now.is_set():
+                self.samples.append(thread_cpu())
+                self.sample_now.clear()
+                self.sampled.set()
+
+    def sample(self, poke) -> float:
+        """
+        Ask the reader thread for its CPU time. `poke` wakes up a blocked reader.
+        """
+        self.sampled.clear()
+        self.sample_now.set()
+        poke()
+        self.sampled.wait()
+        return self.samples[-1]
+
+
+def run_case(name: str, make_loop, poke_frame: bytes) -> None:
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    slave_path = os.ttyname(slave)
+    pipe_dir = tempfile.mkdtemp()
+
+    with mock.patch('driver.DriverClass.im871a_port', return_value=slave_path):
+        drv = IM871A(pipe_dir, logOnDestruct=False)
+
+    # Drain the driver's FIFO in the background
+    fifo_path = os.path.join(pipe_dir, 'IM871A_pipe')
+    reader = threading.Thread(target=lambda: [None for _ in iter(lambda f=open(fifo_path, 'rb', buffering=0): f.read(65536), b'')],
+                              daemon=True)
+    reader.start()
+    drv.open_pipe()
+
+    probe = Probe(make_loop(drv))
+    probe.thread.start()
+
+    def poke():
+        os.write(master, poke_frame)
+
+    # Idle: nobody transmits
+    t0 = probe.sample(poke)
+    time.sleep(IDLE_SECONDS)
+    t1 = probe.sample(poke)
+    idle_per_hour = (t1 - t0) / IDLE_SECONDS * 3600
+
+    # Burst of telegrams, paced so each is read as its own frame
+    before = probe.count
+    t2 = probe.sample(poke)
+    for _ in range(TELEGRAMS):
+        os.write(master, FRAME)
+        time.sleep(0.001)
+    while probe.count - before < TELEGRAMS:
+        time.sleep(0.01)
+    t3 = probe.sample(poke)
+    per_1k = (t3 - t2) / TELEGRAMS * 1000
+
+    print("{:8s} idle: {:8.1f} CPU-s/hour   load: {:6.3f} CPU-s/1k telegrams".format(name, idle_per_hour, per_1k))
+
+    probe.stop = True
+    poke()
+    probe.thread.join(1)
+    drv.close()
+    os.close(master)
+
+
+def legacy_loop(drv: IM871A):
+    """
+    The read loop as it was before select() was introduced.
+    """
+    ser = drv.IM871
+
+    def loop(probe) -> bool:
+        while not probe.sample_now.is_set():
+            data = ser.read(100)
+            if len(data) != 0:
+                drv.fp.write((data.hex()[6::] + os.linesep).encode())
+                drv.fp.flush()
+                return True
+        return False
+    return loop
+
+
+def select_loop(drv: IM871A):
+    def loop(probe) -> bool:
+        return drv.read_data()
+    return loop
+
+
+if __name__ == '__main__':
+    run_case("legacy", legacy_loop, FRAME)
+    run_case("select", select_loop, FRAME)
@@ -0,0 +1,102 @@
+"""
+Throughput of the main loop against decrypt workers
+***************************************************
+
+:synopsis: Measures telegrams/s through run_system.handle_batch, decrypting in the loop or in a DecryptPool
+           of 1, 2 or 4 processes or threads.
+
+Batches of telegrams from `METERS` meters are handled as the main loop does after a wakeup:
+prefilter, decrypt and extract (in the loop, or by the workers), and queue MQTT messages.
+No broker is needed, the publisher of bench/bench_batch_drain.py stands in for the MQTT client.
+
+The telegrams are the sample telegrams of our OmniPower, encrypted again for other addresses with its key,
+so the meters are spread over the workers.
+
+Gains need as many free cores as workers. On one core, workers only add the cost of handing over telegrams.
+Each case is measured `REPEAT` times, and the fastest is reported.
+
+Run: `PYTHONPATH=$PYTHONPATH:. python bench/bench_worker_pool.py`
+
+"""
+
+import contextlib
+import os
+import time
+from struct import pack
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+from bench.bench_batch_drain import AES_KEY, setup_main_loop
+from bench.bench_c1telegram import RAW_TELEGRAMS
+from meter.OmniPower import C1Telegram, OmniPower
+from run.workers import DecryptPool, PROCESS, THREAD
+import run.run_system as main_loop
+
+
+METERS = 16
+BATCH = 256             # Telegrams per wakeup
+TELEGRAMS = 8192        # Telegrams per measurement
+REPEAT = 5
+CASES = ((0, None), (1, PROCESS), (2, PROCESS), (4, PROCESS), (2, THREAD), (4, THREAD))
+
+
+def readdress(raw: bytes, address: int) -> bytes:
+    """
+    The telegram as if sent by the meter with the address, with the same key and payload.
+    """
+    plaintext = OmniPower().decrypt_raw(C1Telegram.from_bytes(raw))
+    header = raw[:4] + pack('<I', address) + raw[8:C1Telegram.header_len]
+    prefix = C1Telegram.from_bytes(header + bytes(len(raw) - len(header))).prefix
+    counter = Counter.new(nbits=16, prefix=prefix, initial_value=0x0000)
+    ciphertext = AES.new(bytes.fromhex(AES_KEY), AES.MODE_CTR, counter=counter).encrypt(plaintext)
+    return header + ciphertext + raw[-2:]
+
+
+def setup_meters() -> list:
+    """
+    Register the meters with the main loop, and return their telegrams, in the order received.
+    """
+    setup_main_loop()
+    telegrams = []
+    for i in range(METERS):
+        meter_id = '{:08X}'.format(0x32666857 + i)
+        meter_control = {
+            "handler": OmniPower(name="OP" + meter_id, meter_id=meter_id, aes_key=AES_KEY),
+            "mqttTopic": "v2/bench/kam-{}/data".format(meter_id),
+        }
+        main_loop.meter_list[meter_id] = meter_control
+        main_loop.meter_index[meter_control["handler"].identity] = meter_control
+        telegrams += [readdress(raw, int(meter_id, 16)) for raw in RAW_TELEGRAMS]
+    return [telegrams[i % len(telegrams)] for i in range(TELEGRAMS)]
+
+
+def run_case(workers: int, mode: str, pool, telegrams: list) -> None:
+    main_loop.pool = pool
+    if pool is not None:
+        pool.set_meters([m["handler"] for m in main_loop.meter_index.values()])
+
+    rx_info = {'rx_time': None, 'rx_monotonic': time.monotonic()}
+    batches = [[(t, rx_info) for t in telegrams[i:i + BATCH]] for i in range(0, len(telegrams), BATCH)]
+
+    rates = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(REPEAT):
+            start = time.perf_counter()
+            handled = sum(main_loop.handle_batch(b) for b in batches)
+            rates.append(handled / (time.perf_counter() - start))
+
+    name = "in loop" if pool is None else "{} {}".format(workers, mode + ("es" if mode == PROCESS else "s"))
+    print("{:12s}: {:8.0f} telegrams/s".format(name, max(rates)))
+
+
+if __name__ == '__main__':
+    # Worker processes are started before the publisher's thread, as in run_system
+    pools = [DecryptPool(workers, mode) if workers else None for workers, mode in CASES]
+
+    telegrams = setup_meters()
+    print("{} cores, {} meters, batches of {}".format(os.cpu_count(), METERS, BATCH))
+    for (workers, mode), pool in zip(CASES, pools):
+        run_case(workers, mode, pool, telegrams)
+        if pool is not None:
+            pool.close()
@@ -15,6 +15,19 @@ Version history
 - Ver 1.2: Implemented CRC-16 check.
 - Ver 1.3: Logging exceptions to syslog instead of printing to console.
 - Ver 1.4: No longer takes USB port as argument. Function for handling port is located in 'utils/Search_for_dongle'.  
+- Ver 1.5: Event-driven reading. 'read_data' sleeps in select() on the serial port until data arrives, instead of busy polling.
+- Ver 1.6: Streaming HCI framer (driver/hci.py). Partial and concatenated frames from a single read are reassembled.
+- Ver 1.7: Command/data demultiplexer. Commands wait on a Future with a deadline, radio telegrams received meanwhile are kept.
+- Ver 1.8: Link mode setup enables RSSI and time stamp attachment. Receive times and RSSI are sent to the pipe with the telegram.
+- Ver 1.9: Deadline-based 'bring_up' sequence replaces reset + fixed sleep + link mode setup. Reports time per phase.
+- Ver 1.10: Optional raw capture of every received frame, set 'capture' to a CaptureWriter (driver/capture.py).
+- Ver 1.11: Optional USB port argument, used when several dongles are driven together (driver/multi.py).
+- Ver 1.12: 'reconnect' reopens the port after the dongle re-enumerated, and sets up link mode again (utils/hotplug.py).
+- Ver 1.13: Pipe buffer is enlarged to PIPE_SIZE bytes when opened, so bursts do not block the writer.
+- Ver 1.14: Telegrams are sent to the pipe as binary records by default, hex lines on request (driver/ipc.py).
+  Records are collected for a short flush window and written together.
+- Ver 1.15: 'open_ring' sends telegrams through a shared-memory ring instead of the pipe (driver/shm_ring.py).
+- Ver 1.16: 'open_fanout' serves telegrams to any number of subscribers on a Unix domain socket (driver/fanout.py).
 
 
 
@@ -53,11 +66,20 @@ import struct
 import os
 import subprocess
 import errno
-from binascii import hexlify
-from struct import pack
+import fcntl
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import wait
+from threading import Lock
+from select import select
 from utils.log import log_info, log_error
-from typing import Union
+from typing import Union, Optional, List, Deque
 from utils.Search_for_dongle import im871a_port
+from driver.hci import HciFramer, HciFrame, HciDemux
+from driver.ipc import RecordWriter
+from driver.shm_ring import ShmRingWriter
+from driver.fanout import FanoutServer, LAG
+from driver.capture import CaptureWriter
 
 
 
@@ -72,20 +94,40 @@ DEVMGMT_MSG_SET_CONFIG_RSP = 0x04
 DEVMGMT_MSG_RESET_REQ = 0x07
 DEVMGMT_MSG_RESET_RSP = 0x08
 
+# Flags and values for DEVMGMT_MSG_SET_CONFIG_REQ
+IIFLAG1_LINK_MODE = 0x02            # Link mode parameter follows
+IIFLAG2_AUTO_RSSI = 0x10            # Auto RSSI attachment parameter follows
+IIFLAG2_AUTO_TIMESTAMP = 0x20       # Auto Rx time stamp attachment parameter follows
+ENABLE = 0x01
+
+# Requested size of the pipe buffer, in bytes. Linux default is 64 KiB, unprivileged limit is /proc/sys/fs/pipe-max-size
+PIPE_SIZE = 1024 * 1024
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)     # Not in fcntl before Python 3.10
+
+# Deadline for a response to a command, in seconds
+COMMAND_TIMEOUT = 0.5
+
+# Bring-up after reset. The module restarts approx. 500 ms after acknowledging a reset request.
+BRING_UP_TIMEOUT = 3.0          # Deadline for the whole bring-up sequence, in seconds
+RESTART_TIMEOUT = 1.0           # Give up waiting to see the module go down after this, in seconds
+PING_POLL_TIMEOUT = 0.05        # Deadline per ping while polling the module state, in seconds
+PING_POLL_INTERVAL = 0.01       # Pause between polling pings, in seconds
+
 
 class IM871A:  
     """
     Implementation of a driver class for IM871A USB-dongle. 
     Takes 1 argument1:
     - The path to where to put the pipe, e.g. the program directory. 
+    Optionally takes the path of the USB-port. If not given, the first IM871A found is used.
     """ 
 
 
 
-    def __init__(self, program_path, logOnDestruct=True):
+    def __init__(self, program_path, logOnDestruct=True, port_path: Optional[str] = None):
 
         try:
-            self.Port = im871a_port()                       # Path to the USB-port used
+            self.Port = port_path if port_path else im871a_port()   # Path to the USB-port used
         except Exception as err:
             log_error(err)
             exit(1)
@@ -94,6 +136,13 @@ class IM871A:
         self.__init_open(self.Port)                         # Initially creates and opens port
         self.__create_pipe(self.Port)                       # Initially creates 'named pipe' file
         self.fp = None                                      # Pointer to pipe
+        self.writer = None                                  # type: Optional[Union[RecordWriter, ShmRingWriter, FanoutServer]]
+        self.framer = HciFramer(require_crc=False)          # Reassembles frames, responses come without CRC16
+        self.backlog = deque()                              # type: Deque[HciFrame]
+        self.demux = HciDemux(self.backlog.append)          # Routes frames to commands or backlog
+        self.__read_lock = Lock()                           # Only one thread reads the port at a time
+        self.bring_up_times = OrderedDict()                 # type: OrderedDict[str, float]
+        self.capture = None                                 # type: Optional[CaptureWriter]
 
         self.logOnDestruct = logOnDestruct
 
@@ -164,119 +213,232 @@ class IM871A:
 
 
 
-    def __CRC16_check(self, message: bytes) -> bool:
-        """
-        Argument must be the entire message from IM871-A as byte string
-        Function returns TRUE if the check sum matches the expected CRC16 value
+    def __pipe_data(self, frame: Optional[HciFrame]) -> bool:
         """
-        Checksum = message[-4:]                         # Store the expected CRC16 value
-        data = message[2:-4]                            # Removes SOF field and CRC16 value
+        Send a frame to the pipe writer, or write out waiting frames if frame is None.
+        Returns a bool to verify if data is sent to pipe.
+        """ 
+        try:
+            if frame is None:
+                self.writer.flush()
+            else:
+                self.writer.write(frame)
+            return True
 
-        hex_radix = 16
-        g = 0x8408                                      # Generator polynomial, g(x)
-        crc = 0xFFFF                                    # Init value for CCITT CRC16
+        except Exception as err:
+            log_error(err)
+            exit()
 
-        for byte in range(0, len(data), 2):             # Loop over all bytes in message
-            b = int(data[byte:byte + 2], hex_radix)     # Make byte value from hex digits
+            return False
 
-            for _ in range(0, 8):                       # Repeat for 8 bits in a byte
-                if (b & 1) ^ (crc & 1):                 # Is there a remainder for division by the poly for this bit?
-                    crc = (crc >> 1) ^ g                # Get remainder from division
-                else:
-                    crc >>= 1                           # Just advance to next bit in division
-                b >>= 1                                 # Move on to next bit in this byte of the message
 
-        crc = crc ^ 0xFFFF                              # Perform final complement
-        crc16 = hexlify(pack('<H', crc))                # CRC16 as little-endian
 
-        if Checksum == crc16:                           # Check if sum matches expected CRC16 value
-            return True
-        else:
+    def open_pipe(self, binary: bool = True) -> bool:
+        """ 
+        Open up the pipe. Blocks until pipe is opened at the other end.
+        Telegrams are written as binary records, or as hex lines if binary is False.
+        The pipe buffer is enlarged to PIPE_SIZE, if the system allows it.
+        """
+        try:
+            self.fp = open(self.pipe, "wb")
+        except IOError as err:
+            log_error(err)
             return False
 
+        self.writer = RecordWriter(self.fp, binary)
+
+        try:
+            fcntl.fcntl(self.fp, F_SETPIPE_SZ, PIPE_SIZE)
+        except (OSError, TypeError, ValueError) as err:
+            # Not fatal, the pipe keeps its default size
+            log_error("Could not enlarge pipe buffer: {}".format(err))
+        return True
+
 
 
-    def __pipe_data(self, data) -> bool:
+    def open_ring(self, path: str) -> bool:
+        """
+        Send telegrams through the shared-memory ring at path, instead of the pipe. Does not block.
         """
-        Open the pipe, try to send data to pipe and close the pipe again.
-        Returns a bool to verify if data is sent to pipe.
-        """ 
         try:
-            self.fp.write(data + os.linesep)
-            self.fp.flush()
+            self.writer = ShmRingWriter(path)
             return True
 
-        except Exception as err:
+        except (OSError, ValueError) as err:
             log_error(err)
-            exit()
-
             return False
 
 
 
-    def open_pipe(self) -> bool:
-        """ 
-        Open up the pipe. Blocks until pipe is opened at the other end.
+    def open_fanout(self, path: str, policy: str = LAG) -> bool:
+        """
+        Serve telegrams on a Unix domain socket at path, instead of the pipe. Does not block.
+        Policy tells what to do with subscribers that fall behind, see driver/fanout.py.
         """
         try:
-            self.fp = open(self.pipe, "w")
+            self.writer = FanoutServer(path, policy=policy)
             return True
 
-        except IOError as err:
+        except (OSError, ValueError) as err:
             log_error(err)
-            return False           
+            return False
+
+
+
+    def __wait_for_data(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block on the serial port file descriptor until the dongle has sent data.
+        Takes an optional timeout in seconds, None waits forever.
+        Returns True if data is ready to be read, False if the timeout expired.
+        """
+        readable, _, _ = select([self.IM871], [], [], timeout)
+        return len(readable) != 0
+
+
+
+    def __pump(self, timeout: Optional[float]) -> None:
+        """
+        Wait up to timeout for data on the serial port, read everything available
+        and route the complete frames through the demultiplexer.
+        Caller must hold the read lock.
+        If capture is enabled, every frame is recorded before it is routed.
+        """
+        if self.__wait_for_data(timeout):
+            data = self.IM871.read(max(self.IM871.in_waiting, 1))
+            for frame in self.framer.feed(data):
+                if self.capture is not None:
+                    self.capture.record(frame)
+                self.demux.dispatch(frame)
+
+
+
+    def read_frames(self, timeout: Optional[float] = None) -> List[HciFrame]:
+        """
+        Return radio frames received from meters. Blocks until at least one frame
+        is available, or until timeout (seconds) has passed. Then returns an empty list.
+        Serial errors are raised to the caller.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while len(self.backlog) == 0:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+
+            with self.__read_lock:
+                # A command may have read frames into the backlog while we waited for the lock
+                if len(self.backlog) == 0:
+                    self.__pump(remaining)
+
+        frames = []
+        while len(self.backlog) != 0:
+            frames.append(self.backlog.popleft())
+        return frames
 
 
 
     def read_data(self) -> bool:
         """
-        Read single dataframe from meters sending with the specified link mode.
+        Read dataframes from meters sending with the specified link mode.
         Send data into 'named pipe' (USBx_pipe).
         Removes the WM-Bus frame before sending data to pipe.
+
+        The process sleeps in select() until the serial port is readable,
+        and then drains all bytes waiting in the UART buffer in one call.
+        The bytes are fed to the HCI framer, and every complete radio frame is sent to the pipe.
+        Returns when at least one frame has been sent.
         """   
-        while True:
-            try:
-                data = self.IM871.read(100)
-            except (AttributeError, port.SerialException) as err:
-                log_error(err)
+        try:
+            frames = self.read_frames()
+        except (AttributeError, ValueError, OSError, port.SerialException) as err:
+            log_error(err)
+            return False
+
+        for frame in frames:
+            if not self.write_frame(frame):
                 return False
-            
-            if len(data) != 0:
-                if self.__CRC16_check(hexlify(data)):
-                    data_conv = data.hex()
-                    
-                    # Output to named pipe
-                    if self.__pipe_data(data_conv[6::]):
-                        return True
-                    else:                                            
-                        return False
-        
+        return self.flush_pipe()
 
-    
-    def ping(self) -> bool:
+
+
+    def write_frame(self, frame: HciFrame) -> bool:
         """
-        Ping the WM-Bus module to check if it's alive.
+        Output telegram, from the length field and onwards, and its receive info to named pipe.
+        The frame may wait up to the flush window, to be written together with the next frames.
+        """
+        return self.__pipe_data(frame)
+
+
+
+    def flush_pipe(self) -> bool:
         """
+        Write all frames waiting for the pipe.
+        """
+        return self.__pipe_data(None)
+
+
+
+    def pipe_flush_timeout(self) -> Optional[float]:
+        """
+        Seconds until frames waiting for the pipe must be written, or None if nothing is waiting.
+        """
+        return None if self.writer is None else self.writer.flush_timeout()
+
+
+
+    def command(self, endpoint: int, msg_id: int, payload: bytes = b'',
+                timeout: float = COMMAND_TIMEOUT) -> Optional[HciFrame]:
+        """
+        Send a request to IM871A and wait for its response, which has message ID msg_id + 1.
+        Returns the response frame, or None on error or if the deadline passes.
+
+        If another thread is reading the port (e.g. in read_data), that thread routes the response here.
+        Otherwise this thread reads the port until the response arrives.
+        Radio telegrams received meanwhile are kept in the backlog, not discarded.
+        """
+        response_id = msg_id + 1
+        future = self.demux.expect(endpoint, response_id)
+
         try:
-            self.IM871.write(port.to_bytes([IM871A_SERIAL_SOF, DEVMGMT_ID, DEVMGMT_MSG_PING_REQ, 0x0]))
-        except (AttributeError, port.SerialTimeoutException) as err:
+            self.IM871.write(bytes([IM871A_SERIAL_SOF, endpoint, msg_id, len(payload)]) + payload)
+        except (AttributeError, port.SerialTimeoutException, port.SerialException) as err:
             log_error(err)
-            return False
+            self.demux.forget(endpoint, response_id, future)
+            return None
+
+        deadline = time.monotonic() + timeout
+        while not future.done():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            if self.__read_lock.acquire(blocking=False):
+                # Nobody else is reading, so read the port ourselves
+                try:
+                    if not future.done():
+                        self.__pump(remaining)
+                except (ValueError, OSError, port.SerialException) as err:
+                    log_error(err)
+                    break
+                finally:
+                    self.__read_lock.release()
+            else:
+                # Reader thread will route the response, check the lock again now and then
+                wait([future], timeout=min(remaining, 0.05))
+
+        if future.done() and not future.cancelled():
+            return future.result()
+
+        self.demux.forget(endpoint, response_id, future)
+        return None
 
-        # Looking for response message from IM871A
-        for _ in range(0, 500):
-            try:
-                data = self.IM871.read(10)
-            except port.SerialException as err:
-                log_error(err)
-                return False
-            data_conv = data.hex()
-            # Looking for Endpoint-ID and Msg-ID in response
-            if(data_conv[3:6] == "102"):
-                return True
 
-        # If no response message arrives        
-        return False
+    
+    def ping(self) -> bool:
+        """
+        Ping the WM-Bus module to check if it's alive.
+        """
+        return self.command(DEVMGMT_ID, DEVMGMT_MSG_PING_REQ) is not None
 
 
 
@@ -285,26 +447,102 @@ class IM871A:
         Reset the WM-Bus module.
         The reset will be performed after approx. 500ms.
         """ 
-        try:
-            self.IM871.write([IM871A_SERIAL_SOF, DEVMGMT_ID, DEVMGMT_MSG_RESET_REQ, 0x00])
-        except (AttributeError, port.SerialTimeoutException) as err:
-            log_error(err)
+        return self.command(DEVMGMT_ID, DEVMGMT_MSG_RESET_REQ) is not None
+
+
+
+    def __poll_ping(self, expect_alive: bool, deadline: float) -> bool:
+        """
+        Ping the module until it answers (expect_alive True) or stops answering (expect_alive False).
+        Returns False if the deadline passes first.
+        """
+        while time.monotonic() < deadline:
+            timeout = min(PING_POLL_TIMEOUT, max(deadline - time.monotonic(), 0))
+            alive = self.command(DEVMGMT_ID, DEVMGMT_MSG_PING_REQ, timeout=timeout) is not None
+            if alive == expect_alive:
+                return True
+            if alive:
+                time.sleep(PING_POLL_INTERVAL)
+        return False
+
+
+
+    def bring_up(self, mode: str, timeout: float = BRING_UP_TIMEOUT) -> bool:
+        """
+        Reset the module and set up link mode, without fixed sleeps.
+        Phases:
+
+        - reset: wait for the response to the reset request.
+        - restart: ping until the module stops answering, i.e. it is actually restarting.
+          If this is not seen within RESTART_TIMEOUT, the restart is assumed to be over already.
+        - ready: ping until the module answers again.
+        - linkmode: set up link mode.
+
+        Duration of each phase in seconds is stored in 'bring_up_times' and logged.
+        Returns True when the module is ready to receive telegrams.
+        """
+        deadline = time.monotonic() + timeout
+        self.bring_up_times = OrderedDict()
+
+        phase_start = time.monotonic()
+
+        def phase_done(name: str) -> None:
+            nonlocal phase_start
+            now = time.monotonic()
+            self.bring_up_times[name] = now - phase_start
+            phase_start = now
+
+        if not self.reset_module():
+            log_error("IM871A bring-up: no response to reset")
             return False
+        phase_done('reset')
+
+        # Not seeing the module go down is not an error, it may have restarted between two pings
+        self.__poll_ping(False, min(deadline, time.monotonic() + RESTART_TIMEOUT))
+        phase_done('restart')
 
-        # Looking for response message from IM871A    
-        for _ in range(0, 500):
+        if not self.__poll_ping(True, deadline):
+            log_error("IM871A bring-up: module not ready after reset")
+            return False
+        phase_done('ready')
+
+        if not self.setup_linkmode(mode):
+            log_error("IM871A bring-up: link mode setup failed")
+            return False
+        phase_done('linkmode')
+
+        log_info("IM871A bring-up done in {:.1f} ms: ".format(sum(self.bring_up_times.values()) * 1000) +
+                 ", ".join("{} {:.1f} ms".format(k, v * 1000) for k, v in self.bring_up_times.items()))
+        return True
+
+
+
+    def reconnect(self, mode: str, port_path: Optional[str] = None, timeout: float = BRING_UP_TIMEOUT) -> bool:
+        """
+        Reopen the serial port after the dongle disappeared, e.g. re-enumerated on USB, and set up link mode again.
+        Takes the link mode and optionally a new port path. The pipe is left open.
+        The module has just powered up, so no reset is needed: it is pinged until ready.
+        Returns True when the module is ready to receive telegrams.
+        """
+        with self.__read_lock:
             try:
-                data = self.IM871.read(10)
-            except port.SerialException as err:
-                log_error(err)
+                self.IM871.close()
+            except (AttributeError, OSError, port.SerialException):
+                pass
+
+            if port_path:
+                self.Port = port_path
+            if not self.__init_open(self.Port):
                 return False
-            data_conv = data.hex()
-            # Looking for Endpoint-ID and Msg-ID in response
-            if(data_conv[3:6] == "108"):
-                return True
 
-        # If no response message arrives
-        return False
+            # Bytes of a frame cut off by the disconnect must not be joined with new data
+            self.framer = HciFramer(require_crc=False)
+
+        if not self.__poll_ping(True, time.monotonic() + timeout):
+            log_error("IM871A reconnect: module on {} not ready".format(self.Port))
+            return False
+
+        return self.setup_linkmode(mode)
 
 
 
@@ -313,31 +551,22 @@ class IM871A:
         Setup link mode for communication with meter. 
         Takes the link mode as argument.
         If no Link Mode is set, default is 'S2'
+        Also enables RSSI and time stamp attachment on every received telegram.
         """
         # Converting mode-string to byte
         Mode = self.__string_to_hex(mode)
         if(Mode == 0xa):
             return False
-        try:
-            self.IM871.write(port.to_bytes([IM871A_SERIAL_SOF, DEVMGMT_ID, DEVMGMT_MSG_SET_CONFIG_REQ, 0x03, TEMP_MEM, 0x2, Mode]))
-        except (AttributeError, port.SerialTimeoutException) as err:
-            log_error(err)
-            return False
 
-        # Looking for responce message from IM871A     
-        for _ in range(0, 500):
-            try:
-                data = self.IM871.read(10)
-            except port.SerialException as err:
-                log_error(err)
-                return False
-            data_conv = data.hex()
-            # Looking for Endpoint-ID and Msg-ID in response
-            if(data_conv[3:6] == "104"):
-                return True
+        config = bytes([TEMP_MEM,
+                        IIFLAG1_LINK_MODE, Mode,
+                        IIFLAG2_AUTO_RSSI | IIFLAG2_AUTO_TIMESTAMP, ENABLE, ENABLE])
+        response = self.command(DEVMGMT_ID, DEVMGMT_MSG_SET_CONFIG_REQ, config)
+        if response is None:
+            return False
 
-        # If no responce message arrives
-        return False
+        # First byte of payload is status, 0x00 is OK
+        return len(response.payload) == 0 or response.payload[0] == 0x00
         
 
 
@@ -368,6 +597,9 @@ class IM871A:
         """
         if not self.fp is None:
             self.fp.close()     # only run if not NoneType
+        if isinstance(self.writer, (ShmRingWriter, FanoutServer)):
+            self.writer.close()
+            self.writer = None
         self.IM871.close()
 
 
@@ -2,36 +2,174 @@
 Runs the IM871A dongle driver, starting it as a daemon.
 The path of where to put the pipe is created before creating the daemon,
 to put it in the driver folder.
-Mode for IM871A is set to 'c1a'.
+Mode for IM871A is set to 'c1a' by default.
+A background thread pings the dongle periodically while telegrams are read.
+
+When the dongle is set up and the pipe exists, the file IM871A_ready is written next to the pipe,
+holding the duration of each bring-up phase as JSON. Consumers wait for this file instead of sleeping.
+The file is removed again when the driver stops.
 
 Call kill -15 <pid> to send SIGTERM and leave program nicely.
+
+Options:
+
+- `--capture DIR`: record every frame received from the dongle to rotating capture segments in DIR.
+  See driver/capture.py for the format.
+- `--multi`: drive every IM871A found in /dev/serial/by-id, merge their telegrams and drop duplicates.
+  See driver/multi.py.
+- `--mode MODE`: link mode, e.g. c1a or t1. Repeat to give each dongle its own mode in `--multi`.
+- `--transport shm`: send telegrams through a shared-memory ring in /dev/shm instead of the pipe,
+  at the path given by `--ring` (default /dev/shm/IM871A_ring). See driver/shm_ring.py.
+- `--transport socket`: serve telegrams to any number of subscribers on the Unix domain socket
+  IM871A.sock next to the pipe. `--subscriber-policy` is `lag` (default) or `disconnect`,
+  for subscribers that fall behind. See driver/fanout.py.
+- `--format FORMAT`: `binary` (default) records or `hex` lines on the pipe. See driver/ipc.py.
+- `--overflow POLICY`: `drop-oldest` (default) or `drop-newest`, when the pipe consumer falls behind
+  and `--queue-size` frames (default 4096) are waiting. See driver/framequeue.py.
+
+Reader threads drain the dongles into a bounded queue, and the main thread writes the queue to the pipe.
+The main loop sends the monitored meters to the control FIFO IM871A_ctrl, next to the pipe,
+and frames from other meters are dropped before queueing. See driver/control.py.
+Queue counters, including dropped frames, are logged with the health check when frames were dropped.
+
+If a dongle disappears, e.g. re-enumerates on USB, the driver waits for that dongle to come back in
+/dev/serial/by-id, reconnects and sets up link mode again. The outage duration is logged. See utils/hotplug.py.
 """
 
 import daemon   # type: ignore
 from driver.DriverClass import IM871A
+from driver.capture import CaptureWriter
+from driver.control import ControlChannel, CONTROL_FIFO
+from driver.framequeue import POLICIES, DROP_OLDEST, QUEUE_SIZE
+from driver.multi import IM871AGroup
+from driver.shm_ring import ShmRingWriter, RING_PATH
+from driver.fanout import FanoutServer, SOCKET_NAME, POLICIES as SUBSCRIBER_POLICIES, LAG
+from utils.Search_for_dongle import im871a_port, im871a_ports
+from typing import List
 import time, signal
 import os
+import threading
+import json
+import argparse
 from utils.log import log_error, log_info
 
 
+# Seconds between health check pings to the dongle
+PING_INTERVAL = 60
+
+
+def health_check(group: IM871AGroup):
+    """
+    Ping the dongles every PING_INTERVAL seconds, while the main thread writes data.
+    Logs the queue counters whenever frames were dropped since the last check.
+    """
+    dropped = 0
+    while True:
+        time.sleep(PING_INTERVAL)
+        for driver in group.drivers:
+            if not driver.ping():
+                log_error("IM871A on {} did not respond to ping".format(driver.Port))
+
+        stats = group.queue.stats()
+        writer = group.drivers[0].writer
+        if isinstance(writer, ShmRingWriter):
+            stats['ring'] = dict(writer.stats(), dropped=writer.dropped)
+            stats['dropped'] += writer.dropped
+        elif isinstance(writer, FanoutServer):
+            stats['fanout'] = writer.stats()
+            stats['dropped'] += sum(s['dropped'] for s in stats['fanout']['subscribers'])
+        if stats['dropped'] != dropped:
+            log_error("IM871A queue overflow: {}".format(stats))
+            dropped = stats['dropped']
+
+
+def signal_ready(ready_file: str, drivers: List[IM871A]) -> None:
+    """
+    Atomically write the readiness file with the bring-up phase durations in ms, per dongle.
+    """
+    tmp_file = ready_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({d.Port: {k: round(v * 1000, 1) for k, v in d.bring_up_times.items()} for d in drivers}, f)
+    os.rename(tmp_file, ready_file)
+
+
+def remove_ready(ready_file: str) -> None:
+    """
+    Remove the readiness file, if any.
+    """
+    try:
+        os.remove(ready_file)
+    except FileNotFoundError:
+        pass
+
+
 # Main_program will be run as daemon
 def main_program():
     
     log_info("Start daemon")
+    ready_file = os.path.join(path, 'IM871A_ready')
+    remove_ready(ready_file)
+
+    # Instantiate one driver object per dongle used
+    try:
+        ports = im871a_ports() if args.multi else [im871a_port()]
+    except Exception as err:
+        log_error(err)
+        return
 
-    # Instantialte driver object
-    myIM871A = IM871A(path)
+    myIM871A = IM871AGroup(path, ports, hotplug=True, queue_size=args.queue_size, policy=args.overflow)
+    ready = myIM871A.bring_up(args.mode)
+    drivers = myIM871A.drivers
 
-    if(myIM871A.reset_module()):      
-        # Needs time after reset before being able to setup linkmode
-        time.sleep(2)
-        myIM871A.setup_linkmode('c1a')
-        myIM871A.open_pipe()
+    if not ready:
+        log_error("IM871A-Driver could not bring up dongle")
+        return
+
+    capture = CaptureWriter(args.capture) if args.capture else None
+    for driver in drivers:
+        driver.capture = capture
+
+    try:
+        ControlChannel(os.path.join(path, CONTROL_FIFO), myIM871A.address_filter).start()
+
+        # Ring and socket are there before the main loop is started, the pipe blocks until it is opened
+        if args.transport == 'shm':
+            myIM871A.open_ring(args.ring)
+        elif args.transport == 'socket':
+            myIM871A.open_fanout(os.path.join(path, SOCKET_NAME), args.subscriber_policy)
+        signal_ready(ready_file, drivers)
+        if args.transport == 'fifo':
+            myIM871A.open_pipe(binary=args.format == 'binary')
+        myIM871A.start()
+        threading.Thread(target=health_check, args=(myIM871A,), daemon=True).start()
         while True:
-            myIM871A.read_data()   
+            myIM871A.read_data()
+    finally:
+        remove_ready(ready_file)
+        if capture is not None:
+            capture.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IM871A driver daemon")
+    parser.add_argument('--capture', metavar='DIR', help="record received frames to capture segments in DIR")
+    parser.add_argument('--multi', action='store_true', help="use all IM871A dongles found, drop duplicate telegrams")
+    parser.add_argument('--mode', action='append', help="link mode, repeat to give each dongle its own (default c1a)")
+    parser.add_argument('--transport', choices=('fifo', 'shm', 'socket'), default='fifo',
+                        help="pipe, shared-memory ring or fan-out socket")
+    parser.add_argument('--subscriber-policy', choices=SUBSCRIBER_POLICIES, default=LAG,
+                        help="what to do with socket subscribers that fall behind")
+    parser.add_argument('--ring', default=RING_PATH, help="path of the shared-memory ring")
+    parser.add_argument('--format', choices=('binary', 'hex'), default='binary', help="record format on the pipe")
+    parser.add_argument('--overflow', choices=POLICIES, default=DROP_OLDEST, help="frames to drop when the queue is full")
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help="frames waiting for the pipe before dropping")
+    args = parser.parse_args()
+    if not args.mode:
+        args.mode = ['c1a']
+    if args.capture:
+        # Daemon changes working directory, so keep an absolute path
+        args.capture = os.path.abspath(args.capture)
+
     # Get program directory
     path = os.path.dirname(os.path.abspath(__file__))
 
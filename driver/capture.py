@@ -0,0 +1,170 @@
+"""
+Raw radio capture for IM871A
+****************************
+
+:Platform: Python 3.5.10 on Linux
+:Synopsis: Records every HCI frame received from IM871A to rotating binary segment files.
+
+Captures from real sites can be replayed for load tests and post-mortems.
+
+- Frames are handed to a background thread through a bounded queue, so the read loop never waits for the disk.
+- If the queue is full, the frame is dropped from the capture and counted in `dropped`. Telegram flow is unaffected.
+- Files are written with a large buffer, and flushed when the queue runs empty.
+- A new segment is started when the current one reaches `segment_size` bytes.
+  Only the newest `max_segments` segments are kept.
+
+Segment file format
+===================
+Each segment starts with the 8 byte magic `SEGMENT_MAGIC`, followed by records:
+
++--------------+-------+----------------------------------------------------+
+| Field        | Bytes | Description                                        |
++==============+=======+====================================================+
+| rx_wall      | 8     | Receive time, seconds since epoch (double, LE)     |
++--------------+-------+----------------------------------------------------+
+| rx_monotonic | 8     | Receive time, CLOCK_MONOTONIC seconds (double, LE) |
++--------------+-------+----------------------------------------------------+
+| length       | 2     | Number of frame bytes that follow (uint16, LE)     |
++--------------+-------+----------------------------------------------------+
+| frame        | n     | Entire HCI frame, SOF to CRC16                     |
++--------------+-------+----------------------------------------------------+
+
+Use `read_capture` to iterate over the records of a segment.
+
+"""
+
+import os
+import queue
+import threading
+import time
+from struct import Struct
+from typing import Iterator, List, Tuple
+
+from driver.hci import HciFrame
+from utils.log import log_error
+
+
+SEGMENT_MAGIC = b'IMCAP\x00\x01\x00'
+RECORD_HEADER = Struct('<ddH')
+
+SEGMENT_SIZE = 8 * 1024 * 1024      # Bytes per segment before rotating
+MAX_SEGMENTS = 16                   # Number of segments kept on disk
+QUEUE_SIZE = 4096                   # Frames waiting to be written
+WRITE_BUFFER = 64 * 1024            # Buffer size for the segment file
+
+
+class CaptureWriter:
+    """
+    Writes received HCI frames to rotating, size-bounded capture segments in a background thread.
+    """
+
+    def __init__(self, directory: str,
+                 segment_size: int = SEGMENT_SIZE,
+                 max_segments: int = MAX_SEGMENTS,
+                 queue_size: int = QUEUE_SIZE) -> None:
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.dropped = 0                    # Frames not captured because the queue was full
+        self.written = 0                    # Frames written to disk
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.__queue = queue.Queue(maxsize=queue_size)     # type: queue.Queue
+        self.__file = None
+        self.__file_size = 0
+        self.__segment_no = 0
+        self.__thread = threading.Thread(target=self.__run, name="IM871A-capture", daemon=True)
+        self.__thread.start()
+
+    def record(self, frame: HciFrame) -> bool:
+        """
+        Queue a frame for capture. Never blocks.
+        Returns False if the frame was dropped because the writer is behind.
+        """
+        try:
+            self.__queue.put_nowait(frame)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self) -> None:
+        """
+        Write all queued frames, then close the current segment and stop the thread.
+        """
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def segments(self) -> List[str]:
+        """
+        Paths of all capture segments in the directory, oldest first.
+        """
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith('capture-') and n.endswith('.bin'))
+        return [os.path.join(self.directory, n) for n in names]
+
+    def __open_segment(self) -> None:
+        if self.__file is not None:
+            self.__file.close()
+
+        self.__segment_no += 1
+        name = "capture-{}-{:04d}.bin".format(time.strftime('%Y%m%dT%H%M%S', time.gmtime()), self.__segment_no)
+        self.__file = open(os.path.join(self.directory, name), 'wb', buffering=WRITE_BUFFER)
+        self.__file.write(SEGMENT_MAGIC)
+        self.__file_size = len(SEGMENT_MAGIC)
+
+        # Keep only the newest segments
+        for old in self.segments()[:-self.max_segments]:
+            os.remove(old)
+
+    def __write(self, frame: HciFrame) -> None:
+        if self.__file is None or self.__file_size >= self.segment_size:
+            self.__open_segment()
+
+        self.__file.write(RECORD_HEADER.pack(frame.rx_wall, frame.rx_monotonic, len(frame.raw)))
+        self.__file.write(frame.raw)
+        self.__file_size += RECORD_HEADER.size + len(frame.raw)
+        self.written += 1
+
+    def __run(self) -> None:
+        while True:
+            try:
+                frame = self.__queue.get_nowait()
+            except queue.Empty:
+                # Nothing waiting, good time to push buffered records to disk
+                if self.__file is not None:
+                    self.__file.flush()
+                frame = self.__queue.get()
+
+            if frame is None:
+                break
+
+            try:
+                self.__write(frame)
+            except OSError as err:
+                log_error(err)
+
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+def read_capture(path: str) -> Iterator[Tuple[float, float, bytes]]:
+    """
+    Iterate over (rx_wall, rx_monotonic, frame) records in a capture segment.
+    A truncated last record, e.g. from a power cut, is skipped.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+            raise ValueError("Not an IM871A capture segment: {}".format(path))
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            rx_wall, rx_monotonic, length = RECORD_HEADER.unpack(header)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            yield rx_wall, rx_monotonic, frame
@@ -0,0 +1,160 @@
+"""
+Control channel and address filter for IM871A
+*********************************************
+
+:Platform: Python 3.5.10 on Linux
+:Synopsis: Lets the main loop tell the driver which meters are monitored, so foreign telegrams are dropped early.
+
+In dense installations most telegrams heard come from meters that are not monitored.
+The driver keeps the set of monitored (M, A) pairs, and drops other radio frames in the reader thread,
+before they are queued, encoded and sent through the pipe.
+
+- Until the main loop has sent a list, every frame passes, as before.
+- An empty list means no meters are monitored, and every frame is dropped.
+- Counts of passed and filtered frames are kept in `AddressFilter` for diagnostics.
+
+Control messages
+================
+The main loop writes one line of JSON per update to the control FIFO (driver/IM871A_ctrl).
+Manufacturer ID and meter ID are hex strings in big-endian, as configured in OmniPower::
+
+    {"meters": [["2C2D", "32666857"], ["2C2D", "12345678"]]}
+
+`"meters": null` removes the filter again. Use `send_meters` to write an update.
+
+"""
+
+import errno
+import json
+import os
+import threading
+from typing import Any, Dict, FrozenSet, Iterable, Optional, Tuple
+
+from driver.hci import HciFrame
+from utils.log import log_error, log_info
+
+
+CONTROL_FIFO = 'IM871A_ctrl'
+
+
+def address_key(manufacturer_id: str, meter_id: str) -> bytes:
+    """
+    The M and A fields as they are sent over the air (little-endian), from big-endian hex strings.
+    """
+    return bytes.fromhex(manufacturer_id)[::-1] + bytes.fromhex(meter_id)[::-1]
+
+
+class AddressFilter:
+    """
+    Set of monitored (M, A) pairs, and counters of frames passed and filtered.
+    """
+
+    def __init__(self) -> None:
+        self.passed = 0
+        self.filtered = 0
+        self.__keys = None      # type: Optional[FrozenSet[bytes]]
+
+    def set_meters(self, meters: Optional[Iterable[Tuple[str, str]]]) -> None:
+        """
+        Replace the monitored meters with (manufacturer ID, meter ID) pairs. None lets every frame pass.
+        Pairs that are not valid hex can never match a telegram, and are left out.
+        """
+        if meters is None:
+            self.__keys = None
+            return
+
+        keys = set()
+        for manufacturer_id, meter_id in meters:
+            try:
+                keys.add(address_key(manufacturer_id, meter_id))
+            except ValueError:
+                log_error("Meter {} {} not valid, not monitored".format(manufacturer_id, meter_id))
+
+        # Replaced as a whole, so reader threads see either the old or the new set
+        self.__keys = frozenset(keys)
+
+    def accepts(self, frame: HciFrame) -> bool:
+        """
+        True if the frame comes from a monitored meter, or no meters have been set.
+        """
+        keys = self.__keys
+        if keys is None or frame.payload[1:7] in keys:
+            self.passed += 1
+            return True
+
+        self.filtered += 1
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Counters for diagnostics.
+        """
+        keys = self.__keys
+        return {'meters': None if keys is None else len(keys),
+                'passed': self.passed,
+                'filtered': self.filtered}
+
+
+class ControlChannel:
+    """
+    Reads control messages from a FIFO in a background thread, and applies them to an address filter.
+    """
+
+    def __init__(self, path: str, address_filter: AddressFilter) -> None:
+        self.path = path
+        self.address_filter = address_filter
+
+        try:
+            os.mkfifo(path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                log_error(err)
+
+    def start(self) -> None:
+        """
+        Start reading control messages.
+        """
+        threading.Thread(target=self.__run, name="IM871A-control", daemon=True).start()
+
+    def handle(self, line: str) -> None:
+        """
+        Apply one control message.
+        """
+        try:
+            message = json.loads(line)
+            self.address_filter.set_meters(message['meters'])
+        except (ValueError, KeyError, TypeError) as err:
+            log_error("Bad control message: {}".format(err))
+            return
+
+        log_info("Address filter updated: {}".format(self.address_filter.stats()))
+
+    def __run(self) -> None:
+        # Opened for reading and writing, so open does not block and there is no EOF when a writer closes
+        with os.fdopen(os.open(self.path, os.O_RDWR), 'r') as f:
+            for line in f:
+                if line.strip():
+                    self.handle(line)
+
+
+def send_meters(path: str, meters: Optional[Iterable[Tuple[str, str]]]) -> bool:
+    """
+    Send the monitored (manufacturer ID, meter ID) pairs to the driver. Never blocks.
+    Returns False if the driver is not listening.
+    """
+    line = json.dumps({'meters': None if meters is None else [list(m) for m in meters]}) + '\n'
+
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError as err:
+        log_error("Could not send address filter to driver: {}".format(err))
+        return False
+
+    try:
+        os.write(fd, line.encode())
+        return True
+    except OSError as err:
+        log_error("Could not send address filter to driver: {}".format(err))
+        return False
+    finally:
+        os.close(fd)
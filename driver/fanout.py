@@ -0,0 +1,282 @@
+"""
+Fan-out of telegrams to several consumers
+*****************************************
+
+:Platform: Python 3.5.10 on Linux
+:Synopsis: Serves received telegrams over a Unix domain SEQPACKET socket, to any number of subscribers.
+
+The FIFO has exactly one reader, and the driver blocks until it appears.
+With the fan-out server, the MQTT pipeline, a local archiver and a debug tap can all subscribe at once,
+and come and go while the driver runs.
+
+- Each telegram is one SEQPACKET message holding one binary record (driver/ipc.py),
+  so message boundaries are kept and no line parsing is needed.
+- Every subscriber has its own bounded send queue. A background thread sends from the queues
+  as the sockets allow, so a slow subscriber never stalls the radio reader or the other subscribers.
+- When a subscriber's queue is full, the policy decides:
+
+  - `LAG`: the oldest queued record is dropped, and the next record delivered has `FLAG_LAGGED` set
+    in its flags byte, so the subscriber knows it missed telegrams.
+  - `DISCONNECT`: the subscriber is disconnected. It may connect again.
+
+Use `FanoutClient` to subscribe.
+
+"""
+
+import os
+import socket
+import threading
+from collections import deque
+from select import select
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from driver.hci import HciFrame
+from driver.ipc import encode_record, decode_record
+from utils.log import log_error, log_info
+
+
+SOCKET_NAME = 'IM871A.sock'
+SUBSCRIBER_QUEUE = 1024         # Records queued per subscriber
+MAX_RECORD = 4096               # Largest record, telegrams are at most 255 bytes
+
+LAG = 'lag'
+DISCONNECT = 'disconnect'
+POLICIES = (LAG, DISCONNECT)
+
+FLAG_LAGGED = 0x80              # Set in the record flags byte, records were dropped before this one
+FLAGS_OFFSET = 1
+
+
+class Subscriber:
+    """
+    A connected consumer, with its queue and counters.
+    """
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.queue = deque()        # type: Deque[bytes]
+        self.lagged = False         # Records were dropped, flag the next one sent
+        self.slow = False           # Queue overflowed with the DISCONNECT policy
+        self.sent = 0
+        self.dropped = 0
+
+
+class FanoutServer:
+    """
+    Listens on a Unix domain SEQPACKET socket and sends every published record to all subscribers.
+    Has the same interface as RecordWriter, so it can replace the pipe writer.
+    """
+
+    def __init__(self, path: str, queue_size: int = SUBSCRIBER_QUEUE, policy: str = LAG) -> None:
+        if policy not in POLICIES:
+            raise ValueError("Unknown subscriber policy: {}".format(policy))
+
+        self.path = path
+        self.queue_size = queue_size
+        self.policy = policy
+        self.disconnected = 0       # Subscribers disconnected for being too slow
+        self.subscribers = []       # type: List[Subscriber]
+        self.__lock = threading.Lock()
+        self.__closed = False
+
+        # Remove socket left by a previous run
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.__sock.bind(path)
+        self.__sock.listen(8)
+        self.__sock.setblocking(False)
+
+        # Wakes the sending thread when records are published
+        self.__wake_r, self.__wake_w = os.pipe()
+        os.set_blocking(self.__wake_r, False)
+        os.set_blocking(self.__wake_w, False)
+
+        self.__thread = threading.Thread(target=self.__run, name="IM871A-fanout", daemon=True)
+        self.__thread.start()
+
+    def publish(self, record: bytes) -> None:
+        """
+        Queue a record for every subscriber. Never blocks.
+        """
+        with self.__lock:
+            for sub in self.subscribers:
+                if sub.slow:
+                    continue
+                if len(sub.queue) >= self.queue_size:
+                    sub.dropped += 1
+                    if self.policy == DISCONNECT:
+                        sub.slow = True
+                        sub.queue.clear()
+                        continue
+                    sub.queue.popleft()
+                    sub.lagged = True
+                sub.queue.append(record)
+
+        try:
+            os.write(self.__wake_w, b'\x00')
+        except BlockingIOError:
+            pass    # Already woken
+
+    def write(self, frame: HciFrame) -> None:
+        """
+        Publish a received radio frame as a binary record.
+        """
+        self.publish(encode_record(frame))
+
+    def flush_timeout(self) -> Optional[float]:
+        return None
+
+    def flush(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Counters for diagnostics.
+        """
+        with self.__lock:
+            return {'subscribers': [{'queued': len(s.queue), 'sent': s.sent, 'dropped': s.dropped}
+                                    for s in self.subscribers],
+                    'disconnected': self.disconnected}
+
+    def __remove(self, sub: Subscriber) -> None:
+        with self.__lock:
+            self.subscribers.remove(sub)
+        sub.sock.close()
+
+    def __send(self, sub: Subscriber) -> bool:
+        """
+        Send queued records until the socket is full. Returns False if the subscriber is gone.
+        """
+        while True:
+            with self.__lock:
+                if not sub.queue:
+                    return True
+                record = sub.queue.popleft()
+                lagged = sub.lagged
+                sub.lagged = False
+
+            if lagged:
+                record = bytearray(record)
+                record[FLAGS_OFFSET] |= FLAG_LAGGED
+
+            try:
+                sub.sock.send(record)
+            except BlockingIOError:
+                # Socket full, keep the record first in line
+                with self.__lock:
+                    sub.queue.appendleft(record)
+                    sub.lagged = sub.lagged or lagged
+                return True
+            except OSError:
+                return False
+
+            sub.sent += 1
+
+    def __run(self) -> None:
+        while True:
+            with self.__lock:
+                slow = [s for s in self.subscribers if s.slow]
+
+            for sub in slow:
+                log_info("Fan-out subscriber disconnected, too slow")
+                self.disconnected += 1
+                self.__remove(sub)
+
+            if self.__closed:
+                break
+
+            with self.__lock:
+                subs = list(self.subscribers)
+                pending = [s.sock for s in subs if s.queue]
+
+            readable, writable, _ = select([self.__sock, self.__wake_r] + [s.sock for s in subs], pending, [])
+
+            if self.__wake_r in readable:
+                try:
+                    os.read(self.__wake_r, 4096)
+                except BlockingIOError:
+                    pass
+
+            if self.__sock in readable:
+                try:
+                    conn, _ = self.__sock.accept()
+                    conn.setblocking(False)
+                    with self.__lock:
+                        self.subscribers.append(Subscriber(conn))
+                    log_info("Fan-out subscriber connected")
+                except OSError as err:
+                    log_error(err)
+
+            for sub in subs:
+                gone = False
+                if sub.sock in readable:
+                    # Subscribers do not send, so readable means closed
+                    try:
+                        gone = sub.sock.recv(MAX_RECORD) == b''
+                    except BlockingIOError:
+                        pass
+                    except OSError:
+                        gone = True
+                if not gone and sub.sock in writable:
+                    gone = not self.__send(sub)
+                if gone:
+                    self.__remove(sub)
+
+    def close(self) -> None:
+        """
+        Stop serving, and disconnect all subscribers.
+        """
+        self.__closed = True
+        os.write(self.__wake_w, b'\x00')
+        self.__thread.join()
+
+        for sub in list(self.subscribers):
+            self.__remove(sub)
+        self.__sock.close()
+        os.close(self.__wake_r)
+        os.close(self.__wake_w)
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class FanoutClient:
+    """
+    Subscribes to the fan-out server. Select on the client, then call records().
+    """
+
+    def __init__(self, path: str) -> None:
+        self.lagged = 0             # Records received with FLAG_LAGGED, i.e. gaps in the stream
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.connect(path)
+        self.sock.setblocking(False)
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def records(self) -> List[Tuple[memoryview, Dict[str, Any]]]:
+        """
+        Receive all waiting records. Returns (telegram, receive information) for each.
+        Raises ConnectionError if the server has gone.
+        """
+        records = []    # type: List[Tuple[memoryview, Dict[str, Any]]]
+        while True:
+            try:
+                message = self.sock.recv(MAX_RECORD)
+            except BlockingIOError:
+                return records
+            if not message:
+                if records:
+                    return records      # Closed connection is reported on the next call
+                raise ConnectionError("Fan-out server closed the connection")
+            if message[FLAGS_OFFSET] & FLAG_LAGGED:
+                self.lagged += 1
+            records.append(decode_record(memoryview(message)))
+
+    def close(self) -> None:
+        self.sock.close()
@@ -0,0 +1,95 @@
+"""
+Bounded frame queue with overflow policy
+****************************************
+
+:Platform: Python 3.5.10 on Linux
+:Synopsis: Decouples reading the serial port from writing the pipe, and counts what is lost on overload.
+
+Reader threads only drain the serial port into the queue, so the UART buffer in the dongle is emptied
+even while the consumer of the pipe is slow, e.g. waiting for an MQTT publish.
+A writer takes frames from the queue and sends them on.
+
+If the writer falls behind until the queue is full, frames are dropped according to the policy:
+
+- `DROP_OLDEST`: discard the oldest queued frame to make room. Keeps the freshest readings.
+- `DROP_NEWEST`: discard the frame being added. Keeps the order of what was already queued.
+
+Either way the reader never blocks, and every drop is counted in `dropped`.
+
+"""
+
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from driver.hci import HciFrame
+
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+POLICIES = (DROP_OLDEST, DROP_NEWEST)
+
+QUEUE_SIZE = 4096           # Frames waiting for the writer
+
+
+class FrameQueue:
+    """
+    Thread safe, bounded queue of received frames. put() never blocks.
+    """
+
+    def __init__(self, maxsize: int = QUEUE_SIZE, policy: str = DROP_OLDEST) -> None:
+        if policy not in POLICIES:
+            raise ValueError("Unknown overflow policy: {}".format(policy))
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.received = 0           # Frames put in the queue
+        self.dropped = 0            # Frames lost because the queue was full
+        self.high_water = 0         # Largest number of frames waiting at once
+
+        self.__frames = deque()     # type: Deque[HciFrame]
+        self.__ready = threading.Condition()
+
+    def __len__(self) -> int:
+        return len(self.__frames)
+
+    def put(self, frame: HciFrame) -> bool:
+        """
+        Add a frame. If the queue is full, a frame is dropped according to the policy.
+        Returns False if the frame given was dropped.
+        """
+        with self.__ready:
+            self.received += 1
+            if len(self.__frames) >= self.maxsize:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return False
+                self.__frames.popleft()
+
+            self.__frames.append(frame)
+            self.high_water = max(self.high_water, len(self.__frames))
+            self.__ready.notify()
+            return True
+
+    def get_all(self, timeout: Optional[float] = None) -> List[HciFrame]:
+        """
+        Take all queued frames, oldest first.
+        Blocks until at least one frame is queued, or until timeout (seconds). Then an empty list is returned.
+        """
+        with self.__ready:
+            self.__ready.wait_for(lambda: len(self.__frames) != 0, timeout)
+
+            frames = list(self.__frames)
+            self.__frames.clear()
+            return frames
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Counters for diagnostics.
+        """
+        with self.__ready:
+            return {'policy': self.policy,
+                    'queued': len(self.__frames),
+                    'high_water': self.high_water,
+                    'received': self.received,
+                    'dropped': self.dropped}
@@ -0,0 +1,280 @@
+"""
+Streaming HCI framer for IM871A
+*******************************
+
+:Platform: Python 3.5.10 on Linux
+:Synopsis: Splits the serial byte stream from IM871A into complete HCI frames.
+
+The serial port delivers a stream of bytes. A single read can hold part of a frame,
+one frame, or several frames back to back. The framer keeps unconsumed bytes
+in a buffer between reads and emits every complete frame it can find.
+
+
+HCI frame layout
+================
+Imported from WMBus_HCI_Spec_V1_6.pdf.
+
++------+---------+------------+--------+--------+-------------+------------+------+-------+
+| SOF  | Control | Endpoint   | Msg-ID | Length | Payload     | Time stamp | RSSI | CRC16 |
++======+=========+============+========+========+=============+============+======+=======+
+| 0xA5 | 4 bit   | 4 bit      | 1 byte | 1 byte | Length bytes| 4 (option) | 1 (o)| 2 (o) |
++------+---------+------------+--------+--------+-------------+------------+------+-------+
+
+The control nibble tells which optional fields are attached:
+
+- bit 3 (0x8): CRC16 attached,
+- bit 2 (0x4): RSSI attached,
+- bit 1 (0x2): time stamp attached,
+- bit 0 (0x1): reserved, must be 0.
+
+Resync
+======
+If a frame fails the CRC16 check, or the header can not be a valid frame,
+only the SOF byte is discarded, and the search continues from the next 0xA5.
+So garbage on the line costs at most the frames it overlaps.
+
+By default, frames must have the CRC16 attached, as radio telegrams from IM871A have.
+Otherwise any 0xA5 in garbage followed by a valid endpoint would pass as a frame,
+and its length could swallow the start of the next real frame.
+Command responses come without CRC16, as the driver sends its requests without it, so the driver lets
+frames without CRC16 through (`require_crc=False`), but only if they are not radio telegrams,
+and only if the next frame starts right after them (or nothing has arrived yet after them).
+
+Demultiplexing
+==============
+Command responses and radio telegrams arrive interleaved on the same serial line.
+`HciDemux` routes each frame by its endpoint ID and message ID:
+
+- A frame matching a pending command completes that command's Future.
+- Radio telegrams (RADIOLINK_ID, WMBUSMSG_IND) are passed to the data callback.
+- Anything else is counted and dropped.
+
+"""
+
+from collections import deque
+from concurrent.futures import Future
+from struct import unpack_from
+from threading import Lock
+import time
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from utils.crc16_im871a import crc16_im871a_raw
+
+
+# Definitions imported from WMBus_HCI_Spec_V1_6.pdf
+IM871A_SERIAL_SOF = 0xA5
+DEVMGMT_ID = 0x01
+RADIOLINK_ID = 0x02
+RADIOLINKTEST_ID = 0x03
+HWTEST_ID = 0x04
+RADIOLINK_MSG_WMBUSMSG_IND = 0x03
+
+# Control field flags (upper nibble of the control/endpoint byte)
+CONTROL_CRC16 = 0x8
+CONTROL_RSSI = 0x4
+CONTROL_TIMESTAMP = 0x2
+CONTROL_RESERVED = 0x1
+
+HEADER_LEN = 4          # SOF, control/endpoint, msg-id, length
+TIMESTAMP_LEN = 4
+RSSI_LEN = 1
+CRC16_LEN = 2
+
+VALID_ENDPOINTS = (DEVMGMT_ID, RADIOLINK_ID, RADIOLINKTEST_ID, HWTEST_ID)
+
+
+class HciFrame:
+    """
+    A single, complete and CRC-checked HCI frame received from IM871A.
+    Stamped with wall-clock and monotonic receive times, taken when the bytes were read from the port.
+    """
+
+    def __init__(self, raw: bytes, rx_wall: float = 0.0, rx_monotonic: float = 0.0) -> None:
+        self.raw = raw                                  # Entire frame, SOF to CRC16
+        self.rx_wall = rx_wall                          # Receive time, seconds since epoch (time.time)
+        self.rx_monotonic = rx_monotonic                # Receive time, time.monotonic
+        self.control = raw[1] >> 4                      # Flags for optional fields
+        self.endpoint = raw[1] & 0x0F                   # Endpoint ID
+        self.msg_id = raw[2]                            # Message ID
+        self.length = raw[3]                            # Payload length
+        self.payload = raw[HEADER_LEN:HEADER_LEN + self.length]
+
+        # Optional fields follow the payload in this order
+        pos = HEADER_LEN + self.length
+        self.timestamp = None                           # type: Optional[int]
+        self.rssi = None                                # type: Optional[int]
+
+        if self.control & CONTROL_TIMESTAMP:
+            self.timestamp = unpack_from('<I', raw, pos)[0]
+            pos += TIMESTAMP_LEN
+
+        if self.control & CONTROL_RSSI:
+            self.rssi = raw[pos]
+
+    @property
+    def telegram(self) -> bytes:
+        """
+        The wm-bus telegram as passed on to the parser: length field, payload and CRC16.
+        The optional time stamp and RSSI fields are left out.
+        """
+        end = HEADER_LEN + self.length
+        crc = self.raw[-CRC16_LEN:] if self.control & CONTROL_CRC16 else b''
+        return self.raw[HEADER_LEN - 1:end] + crc
+
+    def is_radio_message(self) -> bool:
+        """
+        True if the frame carries a wm-bus telegram received over the air.
+        """
+        return self.endpoint == RADIOLINK_ID and self.msg_id == RADIOLINK_MSG_WMBUSMSG_IND
+
+    def __repr__(self) -> str:
+        return "HciFrame({})".format(self.raw.hex())
+
+
+def frame_length(control: int, length: int) -> int:
+    """
+    Total number of bytes in a frame, given the control nibble and the payload length field.
+    """
+    total = HEADER_LEN + length
+    if control & CONTROL_TIMESTAMP:
+        total += TIMESTAMP_LEN
+    if control & CONTROL_RSSI:
+        total += RSSI_LEN
+    if control & CONTROL_CRC16:
+        total += CRC16_LEN
+    return total
+
+
+class HciFramer:
+    """
+    Reassembles HCI frames from arbitrary chunks of the serial byte stream.
+    Feed it every chunk read from the port, and it returns the frames completed by that chunk.
+    """
+
+    def __init__(self, require_crc: bool = True) -> None:
+        self.require_crc = require_crc  # Drop frames without CRC16, see the module for the exceptions
+        self.buffer = bytearray()       # Bytes received but not yet consumed as a frame
+        self.crc_errors = 0             # Frames dropped due to CRC16 mismatch, or no CRC16
+        self.discarded_bytes = 0        # Bytes skipped while searching for SOF
+
+    def feed(self, data: bytes) -> List[HciFrame]:
+        """
+        Append a chunk from the serial port and return all complete frames, in order of arrival.
+        Incomplete trailing bytes are kept for the next call.
+        Frames are stamped with the time of this call, i.e. when the chunk was read.
+        """
+        rx_wall = time.time()
+        rx_monotonic = time.monotonic()
+        buf = self.buffer
+        buf += data
+        frames = []     # type: List[HciFrame]
+        pos = 0
+
+        while True:
+            sof = buf.find(IM871A_SERIAL_SOF, pos)
+            if sof < 0:
+                # No frame start left in buffer, everything is garbage
+                self.discarded_bytes += len(buf) - pos
+                pos = len(buf)
+                break
+
+            self.discarded_bytes += sof - pos
+            pos = sof
+
+            # Wait for the full header before judging the frame
+            if len(buf) - pos < HEADER_LEN:
+                break
+
+            control = buf[pos + 1] >> 4
+            endpoint = buf[pos + 1] & 0x0F
+            if control & CONTROL_RESERVED or endpoint not in VALID_ENDPOINTS:
+                # Not a real SOF, resync from next byte
+                self.discarded_bytes += 1
+                pos += 1
+                continue
+
+            total = frame_length(control, buf[pos + 3])
+            if len(buf) - pos < total:
+                # Frame not complete yet, wait for more data
+                break
+
+            if control & CONTROL_CRC16:
+                crc_recv = buf[pos + total - 2] | (buf[pos + total - 1] << 8)
+                if crc16_im871a_raw(buf[pos + 1:pos + total - 2]) != crc_recv:
+                    # Corrupt or false frame, resync from next byte
+                    self.crc_errors += 1
+                    self.discarded_bytes += 1
+                    pos += 1
+                    continue
+            elif (self.require_crc
+                  or (endpoint == RADIOLINK_ID and buf[pos + 2] == RADIOLINK_MSG_WMBUSMSG_IND)
+                  or (len(buf) > pos + total and buf[pos + total] != IM871A_SERIAL_SOF)):
+                # Nothing to check the frame by, so it is taken as false, resync from next byte
+                self.crc_errors += 1
+                self.discarded_bytes += 1
+                pos += 1
+                continue
+
+            frames.append(HciFrame(bytes(buf[pos:pos + total]), rx_wall, rx_monotonic))
+            pos += total
+
+        # Consume everything up to the first incomplete frame
+        del buf[:pos]
+        return frames
+
+
+class HciDemux:
+    """
+    Routes received frames to waiting commands or to the telegram output.
+    Thread-safe, so commands can be issued from one thread while another thread reads the port.
+    """
+
+    def __init__(self, on_data: Callable[[HciFrame], None]) -> None:
+        self.on_data = on_data          # Called with every radio telegram
+        self.unexpected = 0             # Frames that matched neither a command nor radio data
+        self.__lock = Lock()
+        self.__pending = {}             # type: Dict[Tuple[int, int], Deque[Future]]
+
+    def expect(self, endpoint: int, msg_id: int) -> Future:
+        """
+        Register interest in a response frame. Must be called before the request is written,
+        so a fast response can not slip past.
+        Returns a Future which gets the HciFrame as result.
+        """
+        future = Future()   # type: Future
+        with self.__lock:
+            self.__pending.setdefault((endpoint, msg_id), deque()).append(future)
+        return future
+
+    def forget(self, endpoint: int, msg_id: int, future: Future) -> None:
+        """
+        Withdraw a pending response, e.g. when its deadline has passed.
+        """
+        with self.__lock:
+            waiting = self.__pending.get((endpoint, msg_id))
+            if waiting is not None and future in waiting:
+                waiting.remove(future)
+                if len(waiting) == 0:
+                    del self.__pending[(endpoint, msg_id)]
+        future.cancel()
+
+    def dispatch(self, frame: HciFrame) -> None:
+        """
+        Route a single frame. Responses are matched first-in, first-out per (endpoint, msg-id).
+        """
+        if frame.is_radio_message():
+            self.on_data(frame)
+            return
+
+        future = None
+        with self.__lock:
+            waiting = self.__pending.get((frame.endpoint, frame.msg_id))
+            if waiting:
+                future = waiting.popleft()
+                if len(waiting) == 0:
+                    del self.__pending[(frame.endpoint, frame.msg_id)]
+
+        if future is not None and future.set_running_or_notify_cancel():
+            future.set_result(frame)
+        else:
+            self.unexpected += 1
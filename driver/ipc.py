@@ -0,0 +1,282 @@
+"""
+Message format between driver and main loop
+*******************************************
+
+:Platform: Python 3.5.10 on Linux
+:Synopsis: Encodes received telegrams and their receive information for the FIFO, and decodes them again.
+
+Two formats are used on the FIFO. The driver writes one of them, the main loop accepts both,
+and can tell them apart by the first byte of each record.
+
+Binary records
+==============
+Default format. Each record is a fixed header followed by the telegram bytes, all little-endian:
+
++-----------------+-------+--------------------------------------------------------------+
+| Field           | Bytes | Description                                                  |
++=================+=======+==============================================================+
+| version         | 1     | `RECORD_VERSION`, never a hex digit or white space           |
++-----------------+-------+--------------------------------------------------------------+
+| flags           | 1     | `FLAG_RSSI` and `FLAG_DONGLE_TIME` if those fields are valid |
++-----------------+-------+--------------------------------------------------------------+
+| length          | 2     | Number of telegram bytes that follow (uint16)                |
++-----------------+-------+--------------------------------------------------------------+
+| rx_wall         | 8     | Receive time in the driver, seconds since epoch (double)     |
++-----------------+-------+--------------------------------------------------------------+
+| rx_monotonic    | 8     | Receive time in the driver, CLOCK_MONOTONIC seconds (double) |
++-----------------+-------+--------------------------------------------------------------+
+| dongle_time     | 4     | Time stamp attached by IM871A, counter ticks (uint32)        |
++-----------------+-------+--------------------------------------------------------------+
+| rssi            | 1     | Raw RSSI value attached by IM871A (uint8)                    |
++-----------------+-------+--------------------------------------------------------------+
+| telegram        | n     | wm-bus telegram: length field, payload and CRC16             |
++-----------------+-------+--------------------------------------------------------------+
+
+`RecordWriter` collects records for up to `FLUSH_WINDOW` seconds and writes them with a single system call.
+
+Hex lines
+=========
+Compatibility format. Each telegram is sent as one line of text, with fields separated by a single space:
+
++-----------------+--------------------------------------------------------------+
+| Field           | Description                                                  |
++=================+==============================================================+
+| telegram        | Hex encoded wm-bus telegram: length field, payload and CRC16 |
++-----------------+--------------------------------------------------------------+
+| rx_wall         | Receive time in the driver, seconds since epoch (UTC)        |
++-----------------+--------------------------------------------------------------+
+| rx_monotonic    | Receive time in the driver, CLOCK_MONOTONIC seconds          |
++-----------------+--------------------------------------------------------------+
+| rssi            | Raw RSSI value attached by IM871A, or '-'                    |
++-----------------+--------------------------------------------------------------+
+| dongle_time     | Time stamp attached by IM871A (counter ticks), or '-'        |
++-----------------+--------------------------------------------------------------+
+
+CLOCK_MONOTONIC is system wide on Linux, so the main loop can compare `rx_monotonic`
+with its own `time.monotonic()` to see how long a telegram has been queued.
+
+A line holding only the telegram, as sent by older drivers, is still accepted.
+
+Decoding
+========
+`RecordDecoder` takes bytes as read from the FIFO, in chunks of any size, and returns
+the telegram bytes and receive information of every complete record, in either format.
+
+Binary records are checked before they are trusted: the flags must be known, the length must fit a telegram
+(`MAX_TELEGRAM`), and agree with the length field of the telegram. A record failing these checks is counted
+in `errors`, and decoding resumes at the next `RECORD_VERSION` byte. Text never holds that byte, so a line
+running into it is also taken as garbage, and decoding resumes there instead of at the next line break.
+
+"""
+
+import os
+import time
+from binascii import unhexlify
+from datetime import datetime
+from struct import Struct
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from driver.hci import HciFrame
+from utils.timezone import ZuluTime
+
+zulu_time = ZuluTime()
+
+MISSING = '-'
+
+RECORD_VERSION = 0xB1
+RECORD_HEADER = Struct('<BBHddIB')
+FLAG_RSSI = 0x01
+FLAG_DONGLE_TIME = 0x02
+RECORD_FLAGS = FLAG_RSSI | FLAG_DONGLE_TIME
+MAX_TELEGRAM = 1 + 255 + 2      # Length field, payload and CRC16
+
+FLUSH_WINDOW = 0.002            # Seconds records may wait to be written together
+FLUSH_SIZE = 64 * 1024          # Write at once when this many bytes are waiting
+
+
+def format_line(frame: HciFrame) -> str:
+    """
+    Encode a received radio frame as a line for the FIFO, without line break.
+    """
+    return "{} {:.6f} {:.6f} {} {}".format(
+        frame.telegram.hex(),
+        frame.rx_wall,
+        frame.rx_monotonic,
+        MISSING if frame.rssi is None else frame.rssi,
+        MISSING if frame.timestamp is None else frame.timestamp)
+
+
+def parse_line(line: str) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Decode a line from the FIFO (without line break).
+    Returns the hex telegram as bytes, and the receive information as keyword arguments for C1Telegram.
+    """
+    fields = line.split()
+    telegram = fields[0].encode()
+    rx_info = {}    # type: Dict[str, Any]
+
+    if len(fields) == 5:
+        rx_info['rx_time'] = datetime.fromtimestamp(float(fields[1]), tz=zulu_time)
+        rx_info['rx_monotonic'] = float(fields[2])
+        rx_info['rssi'] = None if fields[3] == MISSING else int(fields[3])
+        rx_info['dongle_time'] = None if fields[4] == MISSING else int(fields[4])
+
+    return telegram, rx_info
+
+
+def encode_record(frame: HciFrame) -> bytes:
+    """
+    Encode a received radio frame as a binary record.
+    """
+    telegram = frame.telegram
+    flags = (0 if frame.rssi is None else FLAG_RSSI) | (0 if frame.timestamp is None else FLAG_DONGLE_TIME)
+    return RECORD_HEADER.pack(RECORD_VERSION, flags, len(telegram), frame.rx_wall, frame.rx_monotonic,
+                              frame.timestamp or 0, frame.rssi or 0) + telegram
+
+
+def rx_info_from_header(flags: int, rx_wall: float, rx_monotonic: float,
+                        dongle_time: int, rssi: int) -> Dict[str, Any]:
+    """
+    Receive information from the fields of a binary record, as keyword arguments for C1Telegram.
+    """
+    return {'rx_time': datetime.fromtimestamp(rx_wall, tz=zulu_time),
+            'rx_monotonic': rx_monotonic,
+            'rssi': rssi if flags & FLAG_RSSI else None,
+            'dongle_time': dongle_time if flags & FLAG_DONGLE_TIME else None}
+
+
+def rx_info_from_frame(frame: HciFrame) -> Dict[str, Any]:
+    """
+    Receive information of a frame taken directly from the driver, without a record in between.
+    """
+    return {'rx_time': datetime.fromtimestamp(frame.rx_wall, tz=zulu_time),
+            'rx_monotonic': frame.rx_monotonic,
+            'rssi': frame.rssi,
+            'dongle_time': frame.timestamp}
+
+
+def decode_record(record: memoryview) -> Tuple[memoryview, Dict[str, Any]]:
+    """
+    Decode one complete binary record, e.g. from the shared-memory ring.
+    Returns the telegram as a view into the record (no copy), and the receive information.
+    """
+    version, flags, length, rx_wall, rx_monotonic, dongle_time, rssi = RECORD_HEADER.unpack_from(record)
+    if version != RECORD_VERSION:
+        raise ValueError("Unknown record version: {:#04x}".format(version))
+    return (record[RECORD_HEADER.size:RECORD_HEADER.size + length],
+            rx_info_from_header(flags, rx_wall, rx_monotonic, dongle_time, rssi))
+
+
+class RecordDecoder:
+    """
+    Splits bytes read from the FIFO into telegrams with receive information.
+    Accepts binary records and hex lines, also mixed.
+    """
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.errors = 0             # Lines and records that could not be decoded, and were skipped
+
+    def feed(self, data: bytes) -> List[Tuple[bytes, Dict[str, Any]]]:
+        """
+        Add bytes read from the FIFO. Returns (telegram bytes, receive information) for every complete record.
+        An incomplete record at the end is kept until more bytes arrive. Garbage is skipped, see the module.
+        """
+        buf = self.buffer
+        buf += data
+        records = []    # type: List[Tuple[bytes, Dict[str, Any]]]
+        pos = 0
+
+        while pos < len(buf):
+            if buf[pos] == RECORD_VERSION:
+                end = pos + RECORD_HEADER.size
+                if end > len(buf):
+                    break
+                _, flags, length, rx_wall, rx_monotonic, dongle_time, rssi = RECORD_HEADER.unpack_from(buf, pos)
+                if flags & ~RECORD_FLAGS or not 0 < length <= MAX_TELEGRAM:
+                    # Not a record header, resync from the next version byte
+                    self.errors += 1
+                    pos += 1
+                    continue
+                if end + length > len(buf):
+                    break
+                try:
+                    # The telegram's own length field, with or without CRC16
+                    if buf[end] + 1 != length and buf[end] + 3 != length:
+                        raise ValueError("Record length does not match telegram")
+                    rx_info = rx_info_from_header(flags, rx_wall, rx_monotonic, dongle_time, rssi)
+                except (ValueError, OverflowError, OSError):
+                    self.errors += 1
+                    pos += 1
+                    continue
+                records.append((bytes(buf[end:end + length]), rx_info))
+                pos = end + length
+            else:
+                end = buf.find(b'\n', pos)
+                version = buf.find(RECORD_VERSION, pos, len(buf) if end < 0 else end)
+                if version >= 0:
+                    # Binary data out of step, not a line
+                    self.errors += 1
+                    pos = version
+                    continue
+                if end < 0:
+                    break
+                line = buf[pos:end]
+                pos = end + 1
+                if not line.strip():
+                    continue
+                try:
+                    hex_telegram, rx_info = parse_line(line.decode())
+                    records.append((unhexlify(hex_telegram), rx_info))
+                except (ValueError, IndexError):
+                    # Includes UnicodeDecodeError and binascii.Error
+                    self.errors += 1
+
+        del buf[:pos]
+        return records
+
+
+class RecordWriter:
+    """
+    Writes received frames to the FIFO, as binary records or hex lines,
+    collecting them for up to flush_window seconds to write them with one system call.
+    """
+
+    def __init__(self, fileobj: BinaryIO, binary: bool = True, flush_window: float = FLUSH_WINDOW) -> None:
+        self.fileobj = fileobj
+        self.binary = binary
+        self.flush_window = flush_window
+        self.__buffer = bytearray()
+        self.__first = 0.0          # time.monotonic() when the oldest waiting record was added
+
+    def write(self, frame: HciFrame) -> None:
+        """
+        Add a frame. Waiting records are written if the oldest has waited flush_window, or too many are waiting.
+        """
+        if not self.__buffer:
+            self.__first = time.monotonic()
+
+        if self.binary:
+            self.__buffer += encode_record(frame)
+        else:
+            self.__buffer += (format_line(frame) + os.linesep).encode()
+
+        if len(self.__buffer) >= FLUSH_SIZE or time.monotonic() - self.__first >= self.flush_window:
+            self.flush()
+
+    def flush_timeout(self) -> Optional[float]:
+        """
+        Seconds until waiting records must be written, or None if nothing is waiting.
+        """
+        if not self.__buffer:
+            return None
+        return max(self.flush_window - (time.monotonic() - self.__first), 0.0)
+
+    def flush(self) -> None:
+        """
+        Write all waiting records.
+        """
+        if self.__buffer:
+            self.fileobj.write(self.__buffer)
+            self.fileobj.flush()
+            self.__buffer = bytearray()
@@ -0,0 +1,222 @@
+"""
+Multi-dongle ingestion for IM871A
+*********************************
+
+:Platform: Python 3.5.10 on Linux
+:Synopsis: Runs one reader per IM871A dongle on the gateway, merges their telegrams and drops duplicates.
+
+Several dongles on one gateway give better coverage, and can listen in different link modes (e.g. c1a and t1).
+A meter heard by more than one dongle would otherwise be decrypted and published more than once.
+
+- Each dongle gets its own IM871A driver object and reader thread.
+- Reader threads only drain their serial port into one shared, bounded FrameQueue (driver/framequeue.py).
+  They never wait for the pipe, so a slow consumer cannot make the dongle's UART buffer overflow.
+- The writer side takes frames from the queue, drops duplicates and sends the rest to the pipe.
+  If it falls behind, frames are dropped from the queue by its overflow policy, and counted.
+- Frames from meters that are not monitored are dropped before queueing, by `address_filter`
+  (driver/control.py).
+- A single dongle is driven the same way, as a group of one.
+- With `hotplug` set, a reader whose dongle disappears waits for that dongle's link to come back
+  and reconnects (utils/hotplug.py). The other dongles keep running meanwhile.
+- The group can also run inside the main loop's process, without pipe, see GroupSource in driver/sources.py.
+
+Deduplication
+=============
+A telegram is identified by manufacturer (M), address (A) and the ELL session number (ELL-SN),
+which the meter changes for every transmission. Telegrams without ELL (CI is not 0x8D) are identified by
+their full content. The first copy received is kept, copies arriving within `window` seconds are dropped.
+
+Offsets into the HCI payload, which starts at the C-field:
+
++---+-------+-----+-----+-----+---------+--------+
+| C | M     | A   | Ver | Med | CI      | ELL-SN |
++===+=======+=====+=====+=====+=========+========+
+| 0 | 1-2   | 3-6 | 7   | 8   | 9       | 12-15  |
++---+-------+-----+-----+-----+---------+--------+
+
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from driver.DriverClass import IM871A
+from driver.control import AddressFilter
+from driver.framequeue import FrameQueue, DROP_OLDEST, QUEUE_SIZE
+from driver.hci import HciFrame
+from utils.hotplug import DongleWatcher, recover
+from utils.log import log_error, log_info
+
+
+CI_ELL_II = 0x8D
+DEDUP_WINDOW = 2.0              # Seconds in which a repeated telegram is a duplicate
+DEDUP_MAX_ENTRIES = 4096        # Upper bound on remembered telegrams
+
+
+class TelegramDeduplicator:
+    """
+    Remembers recently seen telegrams by (M, A, ELL-SN) and flags repeats.
+    """
+
+    def __init__(self, window: float = DEDUP_WINDOW, max_entries: int = DEDUP_MAX_ENTRIES) -> None:
+        self.window = window
+        self.max_entries = max_entries
+        self.duplicates = 0
+        self.__seen = OrderedDict()     # type: OrderedDict[bytes, float]
+
+    @staticmethod
+    def key(frame: HciFrame) -> bytes:
+        """
+        Identity of the telegram in a frame: M, A and ELL-SN when present, otherwise the whole payload.
+        """
+        payload = frame.payload
+        if len(payload) >= 16 and payload[9] == CI_ELL_II:
+            return payload[1:7] + payload[12:16]
+        return payload
+
+    def is_duplicate(self, frame: HciFrame) -> bool:
+        """
+        True if the same telegram was seen within the window before this frame's receive time.
+        """
+        now = frame.rx_monotonic
+        seen = self.__seen
+
+        # Forget telegrams that are too old, oldest are first
+        while seen:
+            oldest_key, oldest_time = next(iter(seen.items()))
+            if now - oldest_time <= self.window and len(seen) < self.max_entries:
+                break
+            del seen[oldest_key]
+
+        key = self.key(frame)
+        if key in seen:
+            self.duplicates += 1
+            return True
+
+        seen[key] = now
+        return False
+
+
+class IM871AGroup:
+    """
+    Drives several IM871A dongles as one source of telegrams.
+    Takes the program path (for the pipe) and the USB-port paths of the dongles.
+    The pipe is opened and written through the first dongle's driver object.
+    If hotplug is True, dongles that disappear are reconnected when they come back.
+    Frames wait for the writer in a queue of queue_size frames, which overflows according to policy.
+    """
+
+    def __init__(self, program_path: str, ports: List[str], hotplug: bool = False,
+                 queue_size: int = QUEUE_SIZE, policy: str = DROP_OLDEST) -> None:
+        self.drivers = [IM871A(program_path, logOnDestruct=False, port_path=p) for p in ports]
+        self.hotplug = hotplug
+        self.modes = {}         # type: Dict[str, str]
+        self.dedup = TelegramDeduplicator()
+        self.queue = FrameQueue(queue_size, policy)
+        self.address_filter = AddressFilter()
+        self.reconnects = 0     # Dongles reconnected after they disappeared
+        self.__threads = []     # type: List[threading.Thread]
+
+    def bring_up(self, modes: List[str]) -> bool:
+        """
+        Bring up every dongle. Dongle number i uses link mode modes[i], repeating the list if it is short.
+        Returns True if at least one dongle is ready. Dongles that fail are left out.
+        """
+        ready = []
+        for i, driver in enumerate(self.drivers):
+            mode = modes[i % len(modes)]
+            self.modes[driver.Port] = mode
+            if driver.bring_up(mode):
+                log_info("IM871A on {} ready in mode {}".format(driver.Port, mode))
+                ready.append(driver)
+            else:
+                log_error("IM871A on {} failed bring-up, not used".format(driver.Port))
+                driver.close()
+
+        self.drivers = ready
+        return len(ready) != 0
+
+    def open_pipe(self, binary: bool = True) -> bool:
+        """
+        Open up the pipe. Blocks until pipe is opened at the other end.
+        Telegrams are written as binary records, or as hex lines if binary is False.
+        """
+        return self.drivers[0].open_pipe(binary)
+
+    def open_ring(self, path: str) -> bool:
+        """
+        Send telegrams through the shared-memory ring at path, instead of the pipe.
+        """
+        return self.drivers[0].open_ring(path)
+
+    def open_fanout(self, path: str, policy: str) -> bool:
+        """
+        Serve telegrams to subscribers on a Unix domain socket at path, instead of the pipe.
+        """
+        return self.drivers[0].open_fanout(path, policy)
+
+    def start(self) -> None:
+        """
+        Start one reader thread per dongle.
+        """
+        for driver in self.drivers:
+            t = threading.Thread(target=self.__reader, args=(driver,), name="IM871A-" + driver.Port, daemon=True)
+            t.start()
+            self.__threads.append(t)
+
+    def __reader(self, driver: IM871A) -> None:
+        # Each reader has its own watcher, as they wait for different links
+        watcher = DongleWatcher() if self.hotplug else None
+        while True:
+            try:
+                frames = driver.read_frames()
+            except Exception as err:
+                log_error("IM871A on {} stopped: {}".format(driver.Port, err))
+                if watcher is None:
+                    return
+                # The by-id link names the dongle, so wait for this dongle and not just any
+                recover(driver, self.modes[driver.Port], watcher, driver.Port)
+                self.reconnects += 1
+                continue
+            for frame in frames:
+                if self.address_filter.accepts(frame):
+                    self.queue.put(frame)
+
+    def read_frames(self, timeout: Optional[float] = None) -> List[HciFrame]:
+        """
+        Return merged, deduplicated radio frames from all dongles.
+        Blocks until at least one frame has been received, or until timeout. Then an empty list is returned.
+        """
+        frames = self.queue.get_all(timeout)
+
+        # Merging sorts by receive time, so the copy heard first is kept
+        frames.sort(key=lambda f: f.rx_monotonic)
+        return [f for f in frames if not self.dedup.is_duplicate(f)]
+
+    def read_data(self) -> bool:
+        """
+        Send merged, deduplicated telegrams from all dongles into the pipe.
+        Returns when at least one telegram has been received, or frames waiting for the pipe were written.
+        """
+        writer = self.drivers[0]
+
+        # Wait no longer than frames already waiting for the pipe may wait
+        frames = self.read_frames(writer.pipe_flush_timeout())
+        if not frames:
+            return writer.flush_pipe()
+
+        for frame in frames:
+            if not writer.write_frame(frame):
+                return False
+
+        # Frames keep coming, so do not wait for an empty poll to write those that have waited long enough
+        if writer.pipe_flush_timeout() == 0.0:
+            return writer.flush_pipe()
+        return True
+
+    def close(self) -> None:
+        """
+        Close all dongles and the pipe.
+        """
+        for driver in self.drivers:
+            driver.close()
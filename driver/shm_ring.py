@@ -0,0 +1,286 @@
+"""
+Shared-memory ring buffer between driver and main loop
+*****************************************************
+
+:Platform: Python 3.5.10 on Linux
+:Synopsis: Single-producer/single-consumer ring of binary records in /dev/shm, as an alternative to the FIFO.
+
+Through the FIFO every telegram is copied into the kernel and out again.
+With the ring, the driver writes records into a shared memory file, and the main loop reads them
+in place, as memoryviews, without copies.
+
+- The ring lives in a file in /dev/shm (tmpfs), mapped by both processes with mmap.
+- The file holds a header and a data area. The header keeps the write and read positions,
+  so either side can restart and carry on where it left off.
+- The driver wakes the main loop through a doorbell FIFO next to the ring file (eventfd-style).
+  Each ring of the doorbell is the 8 byte write position after a publish. The consumer uses the newest
+  position received, so it only reads data that was stored before the system call that announced it.
+- Like the pipe writer, records are published together: when the oldest unpublished record has waited
+  `FLUSH_WINDOW`, when `FLUSH_SIZE` bytes are unpublished, or on flush(). So they are published under
+  steady traffic too, when the driver never finds its queue empty.
+- If the ring is full, the record is dropped and counted, the driver never waits for the main loop.
+- When the driver exits, the reader sees EOF on the doorbell, and opens it again for the next driver.
+
+Layout
+======
+
++----------------+--------+------------------------------------------------------------+
+| Field          | Bytes  | Description                                                |
++================+========+============================================================+
+| magic          | 8      | `RING_MAGIC`                                               |
++----------------+--------+------------------------------------------------------------+
+| capacity       | 8      | Size of the data area in bytes (uint64, LE)                |
++----------------+--------+------------------------------------------------------------+
+| write_pos      | 8      | Bytes ever written, by the driver (uint64, LE)             |
++----------------+--------+------------------------------------------------------------+
+| read_pos       | 8      | Bytes ever consumed, by the main loop (uint64, LE)         |
++----------------+--------+------------------------------------------------------------+
+| data           | n      | Records, each a uint32 length followed by a binary record  |
++----------------+--------+------------------------------------------------------------+
+
+Positions only grow, the offset in the data area is position modulo capacity.
+A record never wraps: if it does not fit before the end of the data area, a `WRAP` length is written
+and the record starts at the beginning.
+
+"""
+
+import errno
+import mmap
+import os
+import time
+from select import select
+from struct import Struct
+from typing import Any, Dict, Iterator, Optional
+
+from driver.hci import HciFrame
+from driver.ipc import encode_record, FLUSH_SIZE, FLUSH_WINDOW
+from utils.log import log_error
+
+
+RING_MAGIC = b'IMRING\x00\x01'
+RING_HEADER = Struct('<8sQQQ')
+WRITE_POS = Struct('<Q')
+LENGTH = Struct('<I')
+WRAP = 0xFFFFFFFF
+
+WRITE_POS_OFFSET = 16
+READ_POS_OFFSET = 24
+
+RING_PATH = '/dev/shm/IM871A_ring'
+RING_SIZE = 1024 * 1024         # Bytes in the data area
+
+
+def doorbell_path(path: str) -> str:
+    """
+    Path of the doorbell FIFO belonging to a ring file.
+    """
+    return path + '.bell'
+
+
+class ShmRing:
+    """
+    Maps a ring file, creating it if needed. Common part of writer and reader.
+    An existing ring with a different capacity is created anew.
+    """
+
+    def __init__(self, path: str = RING_PATH, capacity: int = RING_SIZE) -> None:
+        self.path = path
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o660)
+        try:
+            size = RING_HEADER.size + capacity
+            existing = os.read(fd, RING_HEADER.size)
+            if len(existing) != RING_HEADER.size or RING_HEADER.unpack(existing)[:2] != (RING_MAGIC, capacity):
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, RING_HEADER.pack(RING_MAGIC, capacity, 0, 0), 0)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self.capacity = capacity
+        self.data = memoryview(self.map)[RING_HEADER.size:]
+
+        try:
+            os.mkfifo(doorbell_path(path), 0o660)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    @property
+    def write_pos(self) -> int:
+        return WRITE_POS.unpack_from(self.map, WRITE_POS_OFFSET)[0]
+
+    @property
+    def read_pos(self) -> int:
+        return WRITE_POS.unpack_from(self.map, READ_POS_OFFSET)[0]
+
+    def fill(self) -> float:
+        """
+        Fraction of the data area in use, 0.0 to 1.0.
+        """
+        return (self.write_pos - self.read_pos) / self.capacity
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Fill level, for diagnostics.
+        """
+        return {'capacity': self.capacity, 'used': self.write_pos - self.read_pos, 'fill': round(self.fill(), 3)}
+
+
+class ShmRingWriter(ShmRing):
+    """
+    Producer side, used by the driver. Has the same interface as RecordWriter, so it can replace the pipe writer.
+    Records are published and the doorbell rung when the oldest has waited flush_window, too many bytes
+    are waiting, or on flush().
+    """
+
+    def __init__(self, path: str = RING_PATH, capacity: int = RING_SIZE, flush_window: float = FLUSH_WINDOW) -> None:
+        super().__init__(path, capacity)
+        self.flush_window = flush_window
+        self.dropped = 0            # Records lost because the ring was full
+        self.__pos = self.write_pos
+        self.__first = 0.0          # time.monotonic() when the oldest unpublished record was stored
+
+        # Read and write, so opening never blocks or fails when the main loop is not there
+        self.__bell = os.open(doorbell_path(path), os.O_RDWR | os.O_NONBLOCK)
+
+    def write(self, frame: HciFrame) -> None:
+        """
+        Store a frame as a binary record. Stored records are published if the oldest has waited flush_window,
+        or too many bytes are waiting, otherwise they are visible to the reader after flush().
+        """
+        record = encode_record(frame)
+        needed = LENGTH.size + len(record)
+        offset = self.__pos % self.capacity
+        pad = self.capacity - offset if offset + needed > self.capacity else 0
+
+        if self.__pos + pad + needed - self.read_pos > self.capacity:
+            self.dropped += 1
+            return
+
+        published = self.write_pos
+        if self.__pos == published:
+            self.__first = time.monotonic()
+
+        if pad:
+            if pad >= LENGTH.size:
+                LENGTH.pack_into(self.data, offset, WRAP)
+            self.__pos += pad
+            offset = 0
+
+        LENGTH.pack_into(self.data, offset, len(record))
+        self.data[offset + LENGTH.size:offset + needed] = record
+        self.__pos += needed
+
+        if self.__pos - published >= FLUSH_SIZE or time.monotonic() - self.__first >= self.flush_window:
+            self.flush()
+
+    def flush_timeout(self) -> Optional[float]:
+        """
+        Seconds until stored records must be published, or None if nothing is waiting.
+        """
+        if self.__pos == self.write_pos:
+            return None
+        return max(self.flush_window - (time.monotonic() - self.__first), 0.0)
+
+    def flush(self) -> None:
+        """
+        Publish stored records, and ring the doorbell with the new write position.
+        """
+        if self.__pos == self.write_pos:
+            return
+
+        WRITE_POS.pack_into(self.map, WRITE_POS_OFFSET, self.__pos)
+        try:
+            os.write(self.__bell, WRITE_POS.pack(self.__pos))
+        except OSError as err:
+            # Doorbell full, the main loop is behind or not running. It reads the header when idle.
+            if err.errno != errno.EAGAIN:
+                log_error(err)
+
+    def close(self) -> None:
+        os.close(self.__bell)
+        self.data.release()
+        self.map.close()
+
+
+class ShmRingReader(ShmRing):
+    """
+    Consumer side, used by the main loop. Select on the reader for new records, then iterate over records().
+    """
+
+    def __init__(self, path: str = RING_PATH, capacity: int = RING_SIZE) -> None:
+        super().__init__(path, capacity)
+        self.reconnects = 0         # Times the doorbell was reopened after the driver went away
+        self.__bell = os.open(doorbell_path(path), os.O_RDONLY | os.O_NONBLOCK)
+        self.__announced = self.read_pos
+
+    def fileno(self) -> int:
+        """
+        The doorbell, readable when the driver has published records.
+        """
+        return self.__bell
+
+    def __drain_bell(self) -> None:
+        while True:
+            try:
+                rings = os.read(self.__bell, 8 * 1024)
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    return
+                raise
+            if not rings:
+                # EOF, the driver has closed the doorbell. Reopen, or select would report EOF forever.
+                os.close(self.__bell)
+                self.__bell = os.open(doorbell_path(self.path), os.O_RDONLY | os.O_NONBLOCK)
+                self.__announced = max(self.__announced, self.write_pos)
+                self.reconnects += 1
+                return
+            # Rings are written whole, 8 bytes at a time, and each is newer than the one before
+            if len(rings) >= WRITE_POS.size:
+                self.__announced = max(self.__announced, WRITE_POS.unpack_from(rings, len(rings) - WRITE_POS.size)[0])
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait up to timeout seconds for the doorbell. Returns True if it rang.
+        On timeout, positions published while the doorbell was full are picked up from the header.
+        """
+        readable, _, _ = select([self.__bell], [], [], timeout)
+        if not readable:
+            self.__announced = max(self.__announced, self.write_pos)
+        return len(readable) != 0
+
+    def records(self) -> Iterator[memoryview]:
+        """
+        Yield every published record as a memoryview into the ring.
+        A record is consumed when the next one is requested, so do not keep the view beyond that.
+        """
+        self.__drain_bell()
+        pos = self.read_pos
+
+        while pos < self.__announced:
+            offset = pos % self.capacity
+            if self.capacity - offset < LENGTH.size:
+                pos += self.capacity - offset
+                continue
+
+            length = LENGTH.unpack_from(self.data, offset)[0]
+            if length == WRAP:
+                pos += self.capacity - offset
+                continue
+
+            start = offset + LENGTH.size
+            view = self.data[start:start + length]
+            yield view
+            view.release()
+
+            pos += LENGTH.size + length
+            WRITE_POS.pack_into(self.map, READ_POS_OFFSET, pos)
+
+        WRITE_POS.pack_into(self.map, READ_POS_OFFSET, pos)
+
+    def close(self) -> None:
+        os.close(self.__bell)
+        self.data.release()
+        self.map.close()
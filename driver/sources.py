@@ -0,0 +1,271 @@
+"""
+Telegram sources for the main loop
+**********************************
+
+:Platform: Python 3.5.10 on Linux
+:Synopsis: Reads telegrams from the driver over FIFO, shared-memory ring or fan-out socket, and survives driver restarts.
+           Or runs the driver's readers inside the main loop process.
+
+All sources have the same interface, so the main loop does not depend on the transport:
+
+- `wait(timeout)`: sleep until telegrams may be ready, at most timeout seconds.
+  The main loop uses the timeout to check for MQTT commands.
+- `records()`: (telegram, receive information) for every telegram ready, without blocking.
+  Everything waiting is taken at once, so the main loop handles telegrams in batches, one per wakeup.
+  Process each telegram before taking the next, the ring reuses its space as soon as the next is taken.
+- `reconnects`: number of times the connection to the driver was re-established.
+- `close()`
+
+When the driver exits or restarts, the source notices (EOF on the FIFO or doorbell, closed socket),
+and connects again without blocking. While the driver is absent, attempts are spaced by a back-off
+that doubles from `RETRY_MIN` to `RETRY_MAX` seconds.
+
+The FIFO is opened non-blocking, so opening does not wait for the driver.
+Linux does not report EOF on a newly opened FIFO until a writer has come and gone again,
+so after EOF the FIFO is reopened instead of spinning on it.
+
+`GroupSource` needs no driver process: the dongle readers (driver/multi.py) run as threads in the main loop's
+process, and frames are taken from their queue directly. There is no FIFO, no encoding and no start-up order.
+Telegrams from other meters are dropped by the group's address filter, set with `set_meters()`.
+`reconnects` counts dongles reconnected after they disappeared.
+
+"""
+
+import errno
+import os
+import time
+from select import select
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from driver.ipc import RecordDecoder, decode_record, rx_info_from_frame
+from driver.multi import IM871AGroup
+from driver.hci import HciFrame
+from driver.shm_ring import ShmRingReader
+from driver.fanout import FanoutClient
+from utils.log import log_error, log_info
+
+
+FIFO_READ_SIZE = 64 * 1024      # Bytes read from the FIFO at once, holds many records
+BATCH_SIZE = 1024 * 1024        # Most bytes taken from the FIFO per records() call, the driver's pipe size
+RETRY_MIN = 0.1                 # First pause before connecting again, in seconds
+RETRY_MAX = 5.0                 # Longest pause between attempts, in seconds
+
+Record = Tuple[Any, Dict[str, Any]]
+
+
+class Backoff:
+    """
+    Delay between connection attempts, doubling up to a maximum.
+    """
+
+    def __init__(self, first: float = RETRY_MIN, maximum: float = RETRY_MAX) -> None:
+        self.first = first
+        self.maximum = maximum
+        self.delay = first
+        self.next_try = 0.0         # time.monotonic() of the next attempt
+
+    def failed(self) -> None:
+        self.next_try = time.monotonic() + self.delay
+        self.delay = min(self.delay * 2, self.maximum)
+
+    def succeeded(self) -> None:
+        self.delay = self.first
+        self.next_try = 0.0
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        """
+        Sleep until the next attempt is due, but no longer than timeout. Returns True if it is due.
+        """
+        remaining = self.next_try - time.monotonic()
+        if timeout is not None and remaining > timeout:
+            time.sleep(max(timeout, 0))
+            return False
+        if remaining > 0:
+            time.sleep(remaining)
+        return True
+
+
+class FifoSource:
+    """
+    Reads binary records or hex lines from the driver's FIFO.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.reconnects = 0
+        self.decoder = RecordDecoder()
+        self.__fd = None            # type: Optional[int]
+        self.__backoff = Backoff()
+        self.__open()
+
+    def __open(self) -> bool:
+        try:
+            self.__fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            self.__backoff.succeeded()
+            return True
+        except OSError as err:
+            log_error("Could not open FIFO {}: {}".format(self.path, err))
+            self.__backoff.failed()
+            return False
+
+    def __reopen(self) -> None:
+        """
+        Writer has gone, open again so we wait for the next one.
+        """
+        os.close(self.__fd)
+        self.__fd = None
+        # Half a record from the last writer must not be joined with the next writer's records
+        self.decoder = RecordDecoder()
+        if self.__open():
+            self.reconnects += 1
+            log_info("Driver closed FIFO, reopened it (reconnects: {})".format(self.reconnects))
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        if self.__fd is None:
+            if self.__backoff.wait(timeout) and self.__open():
+                self.reconnects += 1
+            return False
+
+        readable, _, _ = select([self.__fd], [], [], timeout)
+        return len(readable) != 0
+
+    def records(self) -> List[Record]:
+        if self.__fd is None:
+            return []
+
+        # Drain the FIFO. A short read means it was empty, so no extra system call to find out.
+        chunks = []     # type: List[bytes]
+        size = 0
+        eof = False
+        while size < BATCH_SIZE:
+            try:
+                data = os.read(self.__fd, FIFO_READ_SIZE)
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    break
+                raise
+            if not data:
+                eof = True
+                break
+            chunks.append(data)
+            size += len(data)
+            if len(data) < FIFO_READ_SIZE:
+                break
+
+        records = self.decoder.feed(b''.join(chunks)) if chunks else []
+        if eof:
+            self.__reopen()
+        return records
+
+    def close(self) -> None:
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+
+class RingSource:
+    """
+    Reads records in place from the driver's shared-memory ring.
+    Telegrams are memoryviews into the ring, valid until the next telegram is taken.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.ring = ShmRingReader(path)
+
+    @property
+    def reconnects(self) -> int:
+        return self.ring.reconnects
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.ring.wait(timeout)
+
+    def records(self) -> Iterable[Record]:
+        return (decode_record(r) for r in self.ring.records())
+
+    def close(self) -> None:
+        self.ring.close()
+
+
+class SocketSource:
+    """
+    Subscribes to the driver's fan-out socket, and subscribes again if the driver restarts.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.reconnects = 0
+        self.client = None          # type: Optional[FanoutClient]
+        self.__backoff = Backoff()
+        self.__connect()
+
+    def __connect(self) -> bool:
+        try:
+            self.client = FanoutClient(self.path)
+            self.__backoff.succeeded()
+            return True
+        except OSError as err:
+            log_error("Could not subscribe to {}: {}".format(self.path, err))
+            self.__backoff.failed()
+            return False
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        if self.client is None:
+            if self.__backoff.wait(timeout) and self.__connect():
+                self.reconnects += 1
+                log_info("Subscribed to driver again (reconnects: {})".format(self.reconnects))
+            return False
+
+        readable, _, _ = select([self.client], [], [], timeout)
+        return len(readable) != 0
+
+    def records(self) -> List[Record]:
+        if self.client is None:
+            return []
+
+        try:
+            return self.client.records()
+        except OSError as err:
+            # Includes ConnectionError when the driver closed the socket
+            log_error("Driver socket closed: {}".format(err))
+            self.client.close()
+            self.client = None
+            self.__backoff.failed()
+            return []
+
+    def close(self) -> None:
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+
+class GroupSource:
+    """
+    Reads telegrams in process, from dongle reader threads started by the group.
+    The group must be brought up. It is started here, and closed with the source.
+    """
+
+    def __init__(self, group: IM871AGroup) -> None:
+        self.group = group
+        self.__frames = []          # type: List[HciFrame]
+        group.start()
+
+    @property
+    def reconnects(self) -> int:
+        return self.group.reconnects
+
+    def set_meters(self, meters: Optional[Iterable[Tuple[str, str]]]) -> None:
+        """
+        Pass only telegrams from the given (manufacturer id, meter id) pairs. None passes all.
+        """
+        self.group.address_filter.set_meters(meters)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        self.__frames += self.group.read_frames(timeout)
+        return len(self.__frames) != 0
+
+    def records(self) -> List[Record]:
+        frames, self.__frames = self.__frames, []
+        return [(f.telegram, rx_info_from_frame(f)) for f in frames]
+
+    def close(self) -> None:
+        self.group.close()
@@ -9,6 +9,7 @@ Generic class for measurements and measurement frames
 
 Changelog:
 03 Nov 2020: Added is_empty() method to MeterMeasurement. Janus.
+17 Oct 2026: Added optional RSSI of the received telegram to MeterMeasurement.
 
 """
 
@@ -16,7 +17,7 @@ import os
 from collections import OrderedDict
 import json
 from datetime import datetime
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 from utils.timezone import zulu_time_str
 
@@ -46,15 +47,17 @@ class MeterMeasurement:
     Will contain multiple measurements of physical quantities taken at the same time.
     """
 
-    def __init__(self, meter_id: str, timestamp: datetime):
+    def __init__(self, meter_id: str, timestamp: datetime, rssi: Optional[int] = None):
         """
         Make a new measurement collection.
         Takes meter ID of the meter taking the measurement.
         Add the time when the measurement was received as a datetime obj.
+        Optionally add the raw RSSI (signal strength) of the received telegram.
         """
 
         self.meter_id = meter_id
         self.timestamp = timestamp
+        self.rssi = rssi
         self.measurements = OrderedDict()   # type: OrderedDict[str, Any]
 
     def add_measurement(self, name: str, measurement: Measurement) -> None:
@@ -78,6 +81,8 @@ class MeterMeasurement:
         # Build the header
         header = "Meter ID: " + str(self.meter_id) + os.linesep
         header = header + "Timestamp: " + zulu_time_str(self.timestamp) + os.linesep
+        if self.rssi is not None:
+            header = header + "RSSI: " + str(self.rssi) + os.linesep
 
         # Iterate over the measurements in the collection, making a combined string
         text = [k + ": " + str(v.value) + " " + str(v.unit) for k, v in self.measurements.items()]
@@ -100,6 +105,9 @@ class MeterMeasurement:
             'Timestamp': zulu_time_str(self.timestamp),
         })  # type: Dict[str, Any]
 
+        if self.rssi is not None:
+            obj.update({'RSSI': self.rssi})
+
         # Build a temporary dict where we insert all the measurements
         tmp = dict()    # type: Dict[str, Any]
 
@@ -14,6 +14,17 @@ Version history
 - Ver 2.0: Implement CRC16, timezone. Janus.
 - Ver 2.1: More robust exception handling, parse ELL-SN. Janus
 - Ver 2.2: Utilize new MeterMeasurement.is_empty() in validation during parsing. Janus
+- Ver 2.3: Carry receive time and RSSI from the driver on the telegram, and stamp measurements with the receive time.
+- Ver 2.4: C1Telegram.from_bytes builds a telegram from the raw bytes of a binary record from the driver.
+- Ver 2.5: C1Telegram wraps the raw bytes with __slots__, unpacks the header with one precompiled Struct,
+  and makes big_endian, SN, prefix and encrypted on first use.
+- Ver 2.6: Identity tuple of integers (M, A, version, medium) on telegram and meter, for dispatch and is_this_my.
+- Ver 2.7: Decrypt, CRC-check and unpack measurements on bytes, hex is only made when asked for (encrypted, decrypted).
+- Ver 2.8: Decode measurements with a DataRecordDecoder (meter/difvif.py), which learns layouts from long
+  telegrams and decodes short telegrams by their data format signature.
+- Ver 2.9: The AES key is checked, and its cipher set up, once when the key is set. Decryption reuses the cipher
+  and the meter's part of the counter block.
+- Ver 2.10: decrypt_batch and process_telegrams decrypt many telegrams with one AES call, for replays and backfills.
 
 
 Overview
@@ -61,7 +72,8 @@ In a telegram C1 telegram, the data fields are:
 |11 |       | 2     | CRC16       | CRC16 check                                 |                                 |
 +---+-------+-------+-------------+---------------------------------------------+---------------------------------+
 
-The fields 0-9 of the telegram can be unpacked using the little-endian format `<BBHIBBBBB`, where
+The fields 0-9 of the telegram can be unpacked using the little-endian format `<BBHIBBBBBI`
+(`C1Telegram.header`, compiled once), where
 
 - `<` marks little-endian,
 - `B` is an unsigned 1 byte (char),
@@ -135,6 +147,12 @@ Decryption
 
 
 It can be packed using the format `<HIBBBIB`.
+M, A, Ver and Med are the same for every telegram from a meter, so OmniPower packs them once.
+The counter blocks for a telegram are encrypted with the meter's key in one call (AES-ECB, reused for all
+telegrams), and the resulting key stream is XOR'ed onto the encrypted payload. This is AES-CTR,
+without setting up a new cipher for each telegram.
+`OmniPower.decrypt_batch` does the same for many telegrams at once: the counter blocks of all of them
+in one buffer and one AES call, and one XOR over all the encrypted payloads, each padded to whole blocks.
 
 +-----+---------+---+---+---+---------+-----+----+
 |M    |A        |Ver|Med|CC |AES_CTR  |FN   |BC  |
@@ -186,6 +204,9 @@ ________________________________
 +------+-------+----------------+-----------+---------+---------+---------+---------+
 
 Measurement data starts at byte 7, and can easily be extracted using `<IIII` little-endian format.
+The data format signature is the CRC16 of the DIF/VIF codes of the long telegram below,
+0x8C13 for the four fields. The short telegram is decoded by the layout with that signature,
+learnt from long telegrams (see meter/difvif.py), and known from the start for the four fields.
 
 In this example, 206 10^1 Wh (2.06 kWh) have been consumed, and the current power draw is 3 10^0 W (0.003 kW).
 
@@ -201,7 +222,8 @@ In this kind of telegram, the DRHs are included.
 |9831  |78     |04 04     |D7000000 |04 84 3C       |00000000 |04 2B     |03000000 |04 AB 3C  |00000000 |
 +------+-------+----------+---------+---------------+---------+----------+---------+----------+---------+
 
-Extraction is slightly more complex, requiring either a longer parsing pattern or perhaps a regex.
+Extraction is slightly more complex. The DIF/VIF codes are walked once per layout and compiled into
+a Struct, with pad bytes for the codes, see meter/difvif.py.
 
 In this example, 215 10^1 Wh (2.15 kWh) have been consumed, and the current power draw is 3 10^0 W (0.003 kW).
 
@@ -209,17 +231,19 @@ In this example, 215 10^1 Wh (2.15 kWh) have been consumed, and the current powe
 
 from binascii import hexlify, unhexlify
 from struct import *
+from struct import error as StructError
 from Crypto.Cipher import AES
-from Crypto.Util import Counter
+from Crypto.Util.strxor import strxor
 from datetime import datetime
 import json
 import re
-from typing import List, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 # And our own implementation
 from meter.MeterMeasurement import MeterMeasurement, Measurement
+from meter.difvif import DataRecordDecoder, RecordPlan
 from utils.timezone import ZuluTime
-from utils.crc16_wmbus import crc16_wmbus, crc16_check, CrcCheckException
+from utils.crc16_wmbus import crc16_wmbus, crc16_check_raw, CrcCheckException
 
 # Set timezone
 zulu_time = ZuluTime()
@@ -227,86 +251,176 @@ zulu_time = ZuluTime()
 
 class C1Telegram:
     """
-    Implements capture of data fields for a C1 telegram from OmniPower
+    Implements capture of data fields for a C1 telegram from OmniPower.
+    Wraps the raw telegram bytes (or a memoryview), the header fields are unpacked when created,
+    everything derived from them (big_endian, SN, prefix, encrypted) on first use.
+    A telegram made from a memoryview reads from it, so it must not outlive the buffer.
+    Decryption works on bytes (ciphertext, plaintext), the hex forms (encrypted, decrypted) are for debugging.
     """
 
-    # Define slices for C1 telegram
-    # These byte positions are multiplied by *2 to get hex digit count
-    header_slice = slice(0, 17*2)       # Byte 0-16 (inclusive)
-    ell_sn_slice = slice(13*2, 17*2)    # Bytes 13-16 (inclusive)
+    # Header fields L to AES_CTR (bytes 0-16), see first table in documentation
+    header = Struct('<BBHIBBBBBI')
+    header_len = 17
+
+    # Decryption prefix, see documentation
+    prefix_format = Struct('<HIBBBIB')
     payload_start_byte = 17
     im871a_crc_bytes = 2
 
-    def __init__(self, telegram: bytes) -> None:
+    __slots__ = ('raw', 'rx_time', 'rx_monotonic', 'rssi', 'dongle_time', 'plaintext',
+                 'L', 'C', 'M', 'A', 'version', 'medium', 'CI', 'CC', 'ACC', 'AES_CTR',
+                 '_big_endian', '_SN')
+
+    def __init__(self, telegram: bytes,
+                 rx_time: Optional[datetime] = None,
+                 rx_monotonic: Optional[float] = None,
+                 rssi: Optional[int] = None,
+                 dongle_time: Optional[int] = None) -> None:
         """
-        Take a telegram (bytestring with hex values) and parses into fields
+        Take a telegram (bytestring with hex values) and parses into fields.
+        Optionally takes the receive information from the driver:
+        time of reception (Zulu time and time.monotonic()), raw RSSI and the dongle's time stamp.
         """
         try:
-            # Pull out non-encrypted header. Will discard this variable after parsing it
-            header = telegram[self.header_slice]
-
-            # Encrypted part of telegram, keep after parsing
-            self.encrypted = telegram[self.payload_start_byte * 2 : len(telegram) - self.im871a_crc_bytes * 2]
-
-            # The payload message is set as an empty bytestring until decrypted
-            self.decrypted = bytes()
-
-            # The CRC16 from the IM871-A dongle, always at the end
-            self.im871_crc = telegram[len(telegram) - self.im871a_crc_bytes * 2 : ]
-
-            # Unpack header values into a tuple
-            header_values = unpack('<BBHIBBBBBI', unhexlify(header))
-
-            # Extract fields by field numbers, see first table in documentation
-            self.L = header_values[0]
-            self.C = header_values[1]
-            self.M = header_values[2]
-            self.A = header_values[3]
-            self.version = header_values[4]
-            self.medium = header_values[5]
-            self.CI = header_values[6]
-            self.CC = header_values[7]
-            self.ACC = header_values[8]
-            self.AES_CTR = header_values[9]
-
-            # The ELL-SN (AES_CTR) field is a composite 4-byte session number (SN) field.
-            # Including encryption method, minute counter and session number
-            ell_sn = self.parse_ell_sn(telegram[self.ell_sn_slice])
-            self.SN = {
+            raw = unhexlify(telegram)
+        except Exception as e:
+            raise TelegramParseException("Failed to parse.") from e
+
+        self.__parse(raw, rx_time, rx_monotonic, rssi, dongle_time)
+
+    @classmethod
+    def from_bytes(cls, raw: Union[bytes, memoryview], **rx_info) -> 'C1Telegram':
+        """
+        Make a telegram from raw bytes (not hex), as received in a binary record from the driver.
+        The bytes are not copied. Takes the same receive information keywords as the constructor.
+        """
+        telegram = cls.__new__(cls)
+        telegram.__parse(raw, **rx_info)
+        return telegram
+
+    def __parse(self, raw: Union[bytes, memoryview],
+                rx_time: Optional[datetime] = None,
+                rx_monotonic: Optional[float] = None,
+                rssi: Optional[int] = None,
+                dongle_time: Optional[int] = None) -> None:
+
+        # Receive information, None if not known
+        self.rx_time = rx_time
+        self.rx_monotonic = rx_monotonic
+        self.rssi = rssi
+        self.dongle_time = dongle_time
+
+        self.raw = raw
+
+        # The payload message is set as an empty bytestring until decrypted
+        self.plaintext = bytes()
+
+        # Derived views, made on first use
+        self._big_endian = None     # type: Optional[Dict[str, bytes]]
+        self._SN = None             # type: Optional[Dict[str, int]]
+
+        try:
+            # Unpack header values, see first table in documentation
+            (self.L, self.C, self.M, self.A, self.version, self.medium,
+             self.CI, self.CC, self.ACC, self.AES_CTR) = self.header.unpack_from(raw)
+
+        except Exception as e:
+            # Raise exception for upstream handling. and propagate the existing exception
+            raise TelegramParseException("Failed to parse.") from e
+
+    @property
+    def identity(self) -> Tuple[int, int, int, int]:
+        """
+        The sending meter: manufacturer, address, version and medium, as integers from the header.
+        Equal to OmniPower.identity of the meter that sent it.
+        """
+        return self.M, self.A, self.version, self.medium
+
+    @property
+    def ciphertext(self) -> Union[bytes, memoryview]:
+        """
+        Encrypted part of the telegram, a slice of the raw telegram (not copied if it is a memoryview).
+        """
+        return self.raw[self.payload_start_byte:len(self.raw) - self.im871a_crc_bytes]
+
+    @property
+    def encrypted(self) -> bytes:
+        """
+        Encrypted part of the telegram, as hex.
+        """
+        return hexlify(self.ciphertext)
+
+    @property
+    def decrypted(self) -> bytes:
+        """
+        Decrypted payload (plaintext), as hex. Empty until decrypted.
+        """
+        return hexlify(self.plaintext)
+
+    @decrypted.setter
+    def decrypted(self, value: bytes) -> None:
+        self.plaintext = unhexlify(value)
+
+    @property
+    def im871_crc(self) -> bytes:
+        """
+        The CRC16 from the IM871-A dongle, always at the end, as hex.
+        """
+        return hexlify(self.raw[len(self.raw) - self.im871a_crc_bytes:])
+
+    @property
+    def SN(self) -> Dict[str, int]:
+        """
+        The ELL-SN (AES_CTR) field is a composite 4-byte session number (SN) field.
+        Including encryption method, minute counter and session number
+        """
+        if self._SN is None:
+            ell_sn = self.split_ell_sn(self.AES_CTR)
+            self._SN = {
                 "ENC": ell_sn[0],
                 "Time": ell_sn[1],
                 "Session": ell_sn[2],
             }
+        return self._SN
 
-            # Store original hex values as big-endian inside strings
-            # for comparison with human-readable values
-            self.big_endian = {
-                'L': hexlify(pack('>B', self.L)),
-                'C': hexlify(pack('>B', self.C)),
-                'M': hexlify(pack('>H', self.M)),
-                'A': hexlify(pack('>I', self.A)),
-                'version': hexlify(pack('>B', self.version)),
-                'medium': hexlify(pack('>B', self.medium)),
-                'CI': hexlify(pack('>B', self.CI)).upper(),
-                'CC': hexlify(pack('>B', self.CC)).upper(),
-                'ACC': hexlify(pack('>B', self.ACC)),
-                'AES_CTR': hexlify(pack('>I', self.AES_CTR)),
+    @property
+    def big_endian(self) -> Dict[str, bytes]:
+        """
+        Original hex values as big-endian inside strings, for comparison with human-readable values.
+        """
+        if self._big_endian is None:
+            # In the reversed header, every field is in big-endian order, so one hexlify covers them all.
+            # Byte 0 (L) is last, at hex digits 32-33.
+            d = hexlify(bytes(self.raw[:self.header_len])[::-1])
+            self._big_endian = {
+                'L': d[32:34],
+                'C': d[30:32],
+                'M': d[26:30],
+                'A': d[18:26],
+                'version': d[16:18],
+                'medium': d[14:16],
+                'CI': d[12:14].upper(),
+                'CC': d[10:12].upper(),
+                'ACC': d[8:10],
+                'AES_CTR': d[0:8],
             }
+        return self._big_endian
 
-            # Compute decryption prefix
-            # See recipe in documentation, currently FN=0
-            self.prefix = pack('<HIBBBIB', self.M, self.A, self.version, self.medium, self.CC, self.AES_CTR, 0)
-
-        except Exception as e:
-            # TODO: Specify error type caught and handle
-            # Raise exception for upstream handling. and propagate the existing exception
-            raise TelegramParseException("Failed to parse.") from e
+    @property
+    def prefix(self) -> bytes:
+        """
+        Decryption prefix, see recipe in documentation, currently FN=0.
+        """
+        return self.prefix_format.pack(self.M, self.A, self.version, self.medium, self.CC, self.AES_CTR, 0)
 
     @staticmethod
     def parse_ell_sn(sn_field: bytes) -> Tuple[int, ...]:
 
         # Get 32 bit from little-endian format
-        ell_sn = unpack('<I', unhexlify(sn_field))[0]
+        return C1Telegram.split_ell_sn(unpack('<I', unhexlify(sn_field))[0])
+
+    @staticmethod
+    def split_ell_sn(ell_sn: int) -> Tuple[int, ...]:
 
         # Get bits using masks
         enc = (ell_sn & (0xe << 28)) >> 29       # Get bits 31-29
@@ -323,8 +437,8 @@ class C1Telegram:
         """
 
         try:
-            # Store decrypted value in field decrypted
-            self.decrypted = meter.decrypt(self)
+            # Store decrypted value in field plaintext
+            self.plaintext = meter.decrypt_raw(self)
             return True
         except AesKeyException as e:
             # Missing key or malformed
@@ -349,19 +463,34 @@ class OmniPower:
     # Anything else must be a malformed key
     aes_req_key_digits = 2*16
 
+    # Counter block of AES-CTR, see documentation: M, A, version and medium are the meter's,
+    # CC and ELL-SN the telegram's, then FN and the 16-bit block counter BC (big-endian)
+    iv_head_format = Struct('<HIBB')
+    iv_tail_format = Struct('<BIx')
+    block_counters = tuple(pack('>H', bc) for bc in range(256))
+    aes_block_bytes = 16
+
     # Byte limit for short, data-only telegrams from OmniPower.
     # Larger telegrams also contain DIF/VIF information
     short_telegram_lim = 39
 
-    # TPL-CI field value for different C1 frame formats
+    # TPL-CI field value for different C1 frame formats, byte 2 of the decrypted payload
     tpl_ci_field = slice(4, 6)
+    tpl_ci_byte = 2
     tpl_ci_compact = b'79'      # This kind is data-only
     tpl_ci_drh = b'78'          # This kind has DIF/VIF information too
+    tpl_ci_compact_byte = 0x79
+    tpl_ci_drh_byte = 0x78
+
+    # Data records, or the format signature of a short telegram, follow the TPL-CI field
+    tpl_records_start = 3
 
     # Short telegram format is contiguous frame of 4 32-bit uints
     # The data begins at byte 7 of the payload
     short_telegram_fmt = '<IIII'
     short_telegram_data_slice = slice(7*2, None)
+    short_telegram_data_start = 7
+    short_telegram_struct = Struct(short_telegram_fmt)
 
     # Long telegram format contains DIF/VIF/VIF followed by values.
     # The DIF 04 specifies a 32-bit uint, so the little-endian format '<I' is used.
@@ -370,6 +499,12 @@ class OmniPower:
                          ('042B', '<I'),
                          ('04AB3C', '<I'))
 
+    # The same, as binary DIF/VIF/VIFE codes and precompiled formats
+    long_telegram_codes = tuple((unhexlify(code), Struct(fmt)) for code, fmt in long_telegram_fmt)
+
+    # Layout of the long telegram, known before one is received, so short telegrams can be decoded
+    long_telegram_layout = tuple(code for code, fmt in long_telegram_codes)
+
     def __init__(self,
                  name: str = 'Kamstrup OmniPower one-phase',
                  meter_id: str = '32666857',
@@ -383,106 +518,204 @@ class OmniPower:
         self.manufacturer_id = manufacturer_id  # Kamstrup manufacturer ID
         self.medium = medium                    # Medium/type of meter, e.g 0x02 is electricity
         self.version = version                  # Firmware version for the wm-bus interface
-        self.AES_key = aes_key                  # 128-bit AES encryption key
+        self.AES_key = aes_key                  # 128-bit AES encryption key, see AES_key
         self.measurement_log = []               # type: List['MeterMeasurement']
 
+        # Layouts of the data records, by DIF/VIF codes and by data format signature
+        self.record_decoder = DataRecordDecoder([self.long_telegram_layout])
+
+        # Integers to compare with C1Telegram.identity, None if the settings are not hex (matches nothing)
+        self.identity = meter_identity(manufacturer_id, meter_id, version, medium)
+
+        # This meter's part of the AES counter block
+        self.__iv_head = self.iv_head_format.pack(*self.identity) if self.identity is not None else None
+
+    @property
+    def AES_key(self) -> str:
+        """
+        The 128-bit AES key, as 32 hex digits. When set, the key is checked and the cipher is set up.
+        A bad key does not raise here, but is described in key_error, and decrypt raises AesKeyException.
+        """
+        return self.__aes_key
+
+    @AES_key.setter
+    def AES_key(self, aes_key: str) -> None:
+        self.__aes_key = aes_key
+        self.__cipher = None
+        self.key_error = None   # type: Optional[str]
+
+        try:
+            if len(aes_key) != self.aes_req_key_digits:
+                self.key_error = "Bad key length, {}".format(len(aes_key))
+                return
+            self.__cipher = AES.new(unhexlify(aes_key), AES.MODE_ECB)
+        except (TypeError, ValueError) as e:
+            # No length, or not hex (binascii.Error is a ValueError)
+            self.key_error = "Bad key, {}".format(e)
+
     def is_this_my(self, telegram: 'C1Telegram') -> bool:
         """
         Check whether a given telegram is from this meter by comparing meter setting to telegram
         """
 
-        # Comparison is done on lowercase strings and big-endian values, e.g. 2c2d == 2c2d
-        if (telegram.big_endian['A'] == self.meter_id.lower().encode()) and \
-                (telegram.big_endian['M'] == self.manufacturer_id.lower().encode()) and \
-                (telegram.big_endian['version'] == self.version.lower().encode()) and \
-                (telegram.big_endian['medium'] == self.medium.lower().encode()):
-            return True
-        else:
-            return False
+        # Comparison is done on integers, e.g. 0x2c2d == 0x2C2D, computed when the meter was made
+        return telegram.identity == self.identity
 
     def decrypt(self, telegram: 'C1Telegram') -> bytes:
         """
-        Decrypt a telegram. Returns decrypted bytes.
+        Decrypt a telegram. Returns decrypted bytes, as hex.
+        Raises CrcCheckException if CRCs do not match after decryption.
+        Same as decrypt_raw, for debugging.
+        """
+        return hexlify(self.decrypt_raw(telegram))
+
+    def decrypt_raw(self, telegram: 'C1Telegram') -> bytes:
+        """
+        Decrypt a telegram. Returns decrypted bytes (not hex).
         Raises CrcCheckException if CRCs do not match after decryption.
 
         Requires:
 
-         - the prefix from the telegram (telegram.prefix), and
-         - the encryption key stored in the meter object.
+         - the CC and ELL-SN fields from the telegram, for the counter block (as in telegram.prefix), and
+         - the cipher set up from the encryption key stored in the meter object.
 
-        Decrypts the data stored in field telegram.encrypted
+        Decrypts the data in telegram.ciphertext
 
         """
 
-        # Check that 16 byte (128 bit) key has 32 hex digits
-        if len(self.AES_key) != self.aes_req_key_digits:
-            raise AesKeyException("Bad key length, {}".format(len(self.AES_key)))
+        # The key was checked when it was set
+        cipher = self.__cipher
+        if cipher is None:
+            raise AesKeyException(self.key_error)
 
-        # Get relevant variables
-        key_in = self.AES_key               # UTF-8 formatted
-        ciphertext = telegram.encrypted     # ASCII string
-        prefix = telegram.prefix            # bytestring
+        ciphertext = telegram.ciphertext        # bytes or memoryview, no hex
+        prefix = self.__counter_prefix(telegram)
 
-        # Make binary representations
-        key = unhexlify(key_in)             # type: bytes
-        ciphertext = unhexlify(ciphertext)
-
-        # Create cryptographic objects to decrypt using AES-CTR method
-        counter = Counter.new(nbits=16, prefix=prefix, initial_value=0x0000)
-        cipher = AES.new(key, AES.MODE_CTR, counter=counter)
-
-        # Perform decryption
-        decryption = hexlify(cipher.decrypt(ciphertext))
+        # AES-CTR: encrypt the counter blocks, XOR the key stream onto the ciphertext
+        blocks = -(-len(ciphertext) // self.aes_block_bytes)
+        keystream = cipher.encrypt(b''.join([prefix + bc for bc in self.block_counters[:blocks]]))
+        decryption = strxor(ciphertext, keystream[:len(ciphertext)])
 
         # Will raise exception if CRC check failed, to be caught upstream
-        crc16_check(decryption)
+        crc16_check_raw(decryption)
 
         return decryption
 
+    def decrypt_batch(self, telegrams: Sequence['C1Telegram']) -> List[Optional[bytes]]:
+        """
+        Decrypt many telegrams with this meter's key, e.g. when replaying stored telegrams.
+        Returns the decrypted bytes for each telegram, in order, or None where the CRC16 check fails.
+        Raises AesKeyException if the key is bad.
+        """
+        cipher = self.__cipher
+        if cipher is None:
+            raise AesKeyException(self.key_error)
+
+        block_bytes = self.aes_block_bytes
+        counters = []       # type: List[bytes]
+        ciphertexts = []    # type: List[Union[bytes, memoryview]]
+        spans = []          # type: List[Tuple[int, int]]
+        offset = 0
+
+        # Counter blocks and ciphertexts of all telegrams, each ciphertext padded to whole blocks
+        for telegram in telegrams:
+            ciphertext = telegram.ciphertext
+            length = len(ciphertext)
+            blocks = -(-length // block_bytes)
+            prefix = self.__counter_prefix(telegram)
+            counters.extend([prefix + bc for bc in self.block_counters[:blocks]])
+            ciphertexts.append(ciphertext)
+            ciphertexts.append(bytes(blocks * block_bytes - length))
+            spans.append((offset, length))
+            offset += blocks * block_bytes
+
+        # One AES call for the key stream, one XOR
+        decryption = strxor(b''.join(ciphertexts), cipher.encrypt(b''.join(counters)))
+
+        plaintexts = []     # type: List[Optional[bytes]]
+        for start, length in spans:
+            plaintext = decryption[start:start + length]
+            try:
+                crc16_check_raw(plaintext)
+                plaintexts.append(plaintext)
+            except (CrcCheckException, StructError):
+                # Bad message received, or too short to hold the CRC16
+                plaintexts.append(None)
+        return plaintexts
+
+    def __counter_prefix(self, telegram: 'C1Telegram') -> bytes:
+        # Counter block without BC, the meter's part is packed already for its own telegrams
+        identity = telegram.identity
+        head = self.__iv_head if identity == self.identity else self.iv_head_format.pack(*identity)
+        return head + self.iv_tail_format.pack(telegram.CC, telegram.AES_CTR)
+
     @classmethod
     def unpack_short_telegram_data(cls, data: bytes) -> Tuple[int, ...]:
         """
-        Short C1 telegrams only contain field data values, no information about DIF/VIF
+        Short C1 telegrams only contain field data values, no information about DIF/VIF.
+        Takes the decrypted payload as hex, see unpack_short_telegram_data_raw.
+        """
+        return cls.unpack_short_telegram_data_raw(unhexlify(data))
+
+    @classmethod
+    def unpack_short_telegram_data_raw(cls, data: Union[bytes, memoryview]) -> Tuple[int, ...]:
+        """
+        Short C1 telegrams only contain field data values, no information about DIF/VIF.
+        Takes the decrypted payload as bytes.
         """
         # Extract the measurements into a 4-tuple
-        return unpack(cls.short_telegram_fmt, unhexlify(data[cls.short_telegram_data_slice]))
+        return cls.short_telegram_struct.unpack_from(data, cls.short_telegram_data_start)
 
     @classmethod
     def unpack_long_telegram_data(cls, data: bytes) -> Tuple[int, ...]:
         """
-        Long C1 telegrams contain DIF/VIF information and field data values
+        Long C1 telegrams contain DIF/VIF information and field data values.
+        Takes the decrypted payload as hex, see unpack_long_telegram_data_raw.
+        """
+        return cls.unpack_long_telegram_data_raw(unhexlify(data))
+
+    @classmethod
+    def unpack_long_telegram_data_raw(cls, data: bytes) -> Tuple[int, ...]:
+        """
+        Long C1 telegrams contain DIF/VIF information and field data values.
+        Takes the decrypted payload as bytes.
         """
         # Make return value vector with exactly as many zeros as there are expected fields.
         # So if one field is not found, a zero is returned in its place
-        return_val = [0] * len(cls.long_telegram_fmt)
+        return_val = [0] * len(cls.long_telegram_codes)
 
-        for i, fmt in enumerate(cls.long_telegram_fmt):
+        for i, (code, fmt) in enumerate(cls.long_telegram_codes):
 
-            # Build Regex, which searches for the code and groups the 8 subsequent characters
-            pattern = fmt[0].lower() + "(.{8})"
+            # Search for the DIF/VIF/VIFE code, the value follows right after it
+            start = data.find(code)
 
-            # Search for the pattern in the data, which we first format to an UTF-8 string with decode
-            match = re.search(pattern, data.decode())
-
-            if match:
-                # Unpack the found specific 8 characters (4 bytes = 32 bits)
-                # match.group(1) contains these 8 characters
+            if start != -1 and start + len(code) + fmt.size <= len(data):
                 # unpack returns a 1-tuple, from which we grab the single integer element with [0]
-                # print("Found DIF/VIF/VIFE field {} in data records (long) telegram".format(fmt[0]))
-                return_val[i] = unpack(fmt[1], unhexlify(match.group(1).encode()))[0]
+                return_val[i] = fmt.unpack_from(data, start + len(code))[0]
 
         # Finally, return a tuple that we can use to convert and log measurements
         return tuple(return_val)
 
+    @classmethod
+    def select_fields(cls, plan: RecordPlan, values: Tuple) -> Tuple[int, ...]:
+        """
+        The values of the four fields in long_telegram_fmt, in that order, from decoded data records.
+        A field that is not in the records is zero.
+        """
+        return plan.getter(cls.long_telegram_layout)(values)
+
     def extract_measurement_frame(self, telegram: 'C1Telegram') -> MeterMeasurement:
         """
         Requires that the telegram is already decrypted, otherwise returns empty measurement frame.
+        The frame is stamped with the time the driver received the telegram, if known.
         """
 
-        # Create a measurement frame with static data from this meter and current time
-        omnipower_meas = MeterMeasurement(self.meter_id, datetime.now(tz=zulu_time))
+        # Create a measurement frame with static data from this meter and time of reception
+        timestamp = telegram.rx_time if telegram.rx_time is not None else datetime.now(tz=zulu_time)
+        omnipower_meas = MeterMeasurement(self.meter_id, timestamp, rssi=telegram.rssi)
 
-        if not telegram.decrypted:
+        plaintext = telegram.plaintext
+        if len(plaintext) <= self.tpl_ci_byte:
             # TODO: Do better error handling here, instead of just dumping empty objects
             return omnipower_meas
 
@@ -490,15 +723,20 @@ class OmniPower:
         #print("TPL-CI: {}".format(telegram.decrypted[4:6]))
         #if telegram.L <= OmniPower.short_telegram_lim:
 
-        tpl_ci = telegram.decrypted[self.tpl_ci_field]
-        if tpl_ci == self.tpl_ci_compact:
-            measurement_data = OmniPower.unpack_short_telegram_data(telegram.decrypted)
-        elif tpl_ci == self.tpl_ci_drh:
-            measurement_data = OmniPower.unpack_long_telegram_data(telegram.decrypted)
+        tpl_ci = plaintext[self.tpl_ci_byte]
+        if tpl_ci == self.tpl_ci_compact_byte:
+            decoded = self.record_decoder.decode_compact(plaintext, self.tpl_records_start)
+        elif tpl_ci == self.tpl_ci_drh_byte:
+            decoded = self.record_decoder.decode_full(plaintext, self.tpl_records_start)
         else:
             # TODO: Better error handling... What to do if neither 0x78 nor 0x79?
             return omnipower_meas
 
+        if decoded is None:
+            # Unknown data format signature, or records that cannot be decoded
+            return omnipower_meas
+        measurement_data = self.select_fields(*decoded)
+
         # Convert and store in measurement objects with units
         m1 = Measurement(measurement_data[0] * 10 / 1000, "kWh")  # A+ measurement
         m2 = Measurement(measurement_data[1] * 10 / 1000, "kWh")  # A- measurement
@@ -550,6 +788,29 @@ class OmniPower:
             # This is not my telegram or telegram failed to decrypt
             return False
 
+    def process_telegrams(self, telegrams: Sequence['C1Telegram']) -> int:
+        """
+        Processing chain of process_telegram for many telegrams, decrypted together by decrypt_batch.
+        Telegrams from other meters are skipped. Returns the number of measurement frames added to the log.
+        """
+        mine = [t for t in telegrams if self.is_this_my(t)]
+        try:
+            plaintexts = self.decrypt_batch(mine)
+        except AesKeyException as e:
+            # Missing key or malformed
+            print(e)
+            return 0
+
+        logged = 0
+        for telegram, plaintext in zip(mine, plaintexts):
+            if plaintext is None:
+                continue
+            telegram.plaintext = plaintext
+            measurement_frame = self.extract_measurement_frame(telegram)
+            if not measurement_frame.is_empty() and self.add_measurement_to_log(measurement_frame):
+                logged += 1
+        return logged
+
     def dump_log_to_json(self) -> str:
         """
         Returns a JSON string of all measurement frames in log, with an incremented number for each observation.
@@ -563,6 +824,24 @@ class OmniPower:
         return json.dumps(dump)
 
 
+# Settings of the identity fields, exactly as many hex digits as the field has in the telegram header
+IDENTITY_PATTERNS = tuple(re.compile('[0-9A-Fa-f]{{{}}}'.format(digits)) for digits in (4, 8, 2, 2))
+
+
+def meter_identity(manufacturer_id: str, meter_id: str, version: str, medium: str) \
+        -> Optional[Tuple[int, int, int, int]]:
+    """
+    Identity tuple (M, A, version, medium) of a meter from its hex settings, as in C1Telegram.identity.
+    Returns None if a setting is not the hex digits of its field: 4 for M, 8 for A, 2 for version and medium.
+    Upper and lower case are the same, but signs, '0x', spaces and other widths are not accepted.
+    """
+    settings = (manufacturer_id, meter_id, version, medium)
+    if not all(isinstance(setting, str) and pattern.fullmatch(setting)
+               for setting, pattern in zip(settings, IDENTITY_PATTERNS)):
+        return None
+    return int(manufacturer_id, 16), int(meter_id, 16), int(version, 16), int(medium, 16)
+
+
 class AesKeyException(Exception):
     """
     Use this to raise an exception when an AES key is missing or wrong length.
@@ -0,0 +1,216 @@
+"""
+Data records by DIF/VIF, with format signatures
+***********************************************
+
+:platform: Python 3.5.10 on Linux
+:synopsis: Learns the record layout of full (long) frames, and decodes compact (short) frames by their
+           format signature, each with one precompiled Struct.
+
+A full M-Bus frame (TPL-CI 0x78) has data records, each a data record header (DRH) followed by the value.
+The DRH is a DIF, optional DIFEs, a VIF and optional VIFEs, ref. EN 13757-3.
+A compact frame (TPL-CI 0x79) leaves out the DRHs. Instead it starts with a format signature,
+the CRC16 of all the DRHs of the full frame, and the CRC16 the full frame would have:
+
++----------------+------------------+--------------------------+
+|Format signature|Full frame CRC16  |Data 1, Data 2, ...       |
++================+==================+==========================+
+|2 bytes, LE     |2 bytes, LE       |The values, no DRHs       |
++----------------+------------------+--------------------------+
+
+So a compact frame can only be decoded with the layout of a full frame that has the same signature.
+The decoder learns layouts from the full frames it decodes, and can be given known layouts up front.
+
+A layout is compiled once into a `RecordPlan` with Structs for the full and the compact frame.
+Decoding a compact frame is then one `unpack_from`. A full frame is first checked against the layout
+of the previous full frame, by one more `unpack_from` of its DRHs, and only walked byte by byte if it differs.
+
+Data field of the DIF (lowest 4 bits), and how values are unpacked:
+
++-----------+---------------+--------+
+|Data field | Meaning       | Struct |
++===========+===============+========+
+|0x0        | No data       |        |
++-----------+---------------+--------+
+|0x1        | 8 bit integer | B      |
++-----------+---------------+--------+
+|0x2        | 16 bit integer| H      |
++-----------+---------------+--------+
+|0x4        | 32 bit integer| I      |
++-----------+---------------+--------+
+|0x5        | 32 bit real   | f      |
++-----------+---------------+--------+
+|0x7        | 64 bit integer| Q      |
++-----------+---------------+--------+
+
+Integers are unpacked unsigned, as OmniPower has always done. Other data fields (24 and 48 bit integers,
+BCD, variable length) are not supported, and frames using them are not decoded.
+Records end at the end of the frame, an idle filler (0x2F), manufacturer specific data (0x0F, 0x1F)
+or a global readout request (0x7F).
+
+"""
+
+from operator import itemgetter
+from struct import Struct, error as StructError
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from utils.crc16_wmbus import crc16_wmbus_raw
+
+
+EXTENSION_BIT = 0x80            # DIF and VIF: another DIFE or VIFE follows
+DATA_FIELD_MASK = 0x0F
+END_OF_RECORDS = (0x0F, 0x1F, 0x2F, 0x7F)
+PLAIN_TEXT_VIF = (0x7C, 0xFC)   # VIF followed by a text of its own length, not supported
+
+DATA_FIELD = {0x0: '', 0x1: 'B', 0x2: 'H', 0x4: 'I', 0x5: 'f', 0x7: 'Q'}   # type: Dict[int, str]
+DATA_SIZE = {field: Struct('<' + code).size for field, code in DATA_FIELD.items()}
+
+COMPACT_HEADER = Struct('<HH')  # Format signature, full frame CRC16
+
+
+class RecordPlan:
+    """
+    Compiled layout of a list of data records, identified by its DRHs.
+    `index` gives the position of each DRH's value in the unpacked values. DRHs without data have none.
+    """
+
+    __slots__ = ('drh', 'signature', 'full', 'compact', 'headers', 'index', '_getters')
+
+    def __init__(self, drh: Sequence[bytes]) -> None:
+        self.drh = tuple(drh)
+        self.signature = crc16_wmbus_raw(b''.join(self.drh))
+        self.index = {}     # type: Dict[bytes, int]
+        self._getters = {}  # type: Dict[Tuple[bytes, ...], Callable[[Tuple], Tuple]]
+
+        full = ['<']
+        compact = ['<']
+        headers = ['<']
+        for header in self.drh:
+            field = header[0] & DATA_FIELD_MASK
+            code = DATA_FIELD[field]
+            full.append('{}x{}'.format(len(header), code))
+            headers.append('{}s{}x'.format(len(header), DATA_SIZE[field]))
+            if code:
+                self.index[header] = len(compact) - 1
+                compact.append(code)
+
+        self.full = Struct(''.join(full))
+        self.compact = Struct(''.join(compact))
+        self.headers = Struct(''.join(headers))     # The DRHs of a full frame, skipping the values
+
+    def getter(self, drh: Tuple[bytes, ...]) -> Callable[[Tuple], Tuple]:
+        """
+        A function taking the unpacked values, and returning the values of the given DRHs in that order.
+        A DRH that is not in the layout gives zero. Made once per tuple of DRHs.
+        """
+        get = self._getters.get(drh)
+        if get is None:
+            positions = tuple(self.index.get(header) for header in drh)
+            if len(positions) > 1 and None not in positions:
+                get = itemgetter(*positions)
+            else:
+                def get(values: Tuple) -> Tuple:
+                    return tuple(0 if p is None else values[p] for p in positions)
+            self._getters[drh] = get
+        return get
+
+
+def split_records(data: Union[bytes, memoryview], offset: int = 0) -> Optional[List[bytes]]:
+    """
+    The DRHs of the data records in a full frame, starting at offset.
+    Returns None if a record is cut short or uses a data field that is not supported.
+    """
+    drh = []
+    end = len(data)
+    i = offset
+    while i < end:
+        start = i
+        dif = data[i]
+        if dif in END_OF_RECORDS:
+            break
+        size = DATA_SIZE.get(dif & DATA_FIELD_MASK)
+        if size is None:
+            return None
+
+        # DIF and DIFEs, then VIF and VIFEs
+        while data[i] & EXTENSION_BIT:
+            i += 1
+            if i >= end:
+                return None
+        i += 1
+        if i >= end or data[i] in PLAIN_TEXT_VIF:
+            return None
+        while data[i] & EXTENSION_BIT:
+            i += 1
+            if i >= end:
+                return None
+        i += 1
+
+        drh.append(bytes(data[start:i]))
+        i += size
+
+    if i > end:
+        return None
+    return drh
+
+
+class DataRecordDecoder:
+    """
+    Decodes the data records of full and compact frames. Layouts are kept by DRHs and by format signature.
+    Takes known layouts, each a sequence of DRHs, so compact frames can be decoded before a full frame is seen.
+    """
+
+    def __init__(self, layouts: Iterable[Sequence[bytes]] = ()) -> None:
+        self.by_drh = {}            # type: Dict[bytes, RecordPlan]
+        self.by_signature = {}      # type: Dict[int, RecordPlan]
+        self.unknown_signatures = 0
+        self.__last_full = None     # type: Optional[RecordPlan]
+        for drh in layouts:
+            self.learn(drh)
+
+    def learn(self, drh: Sequence[bytes]) -> RecordPlan:
+        """
+        Compile a layout, unless it is known already, and keep it.
+        """
+        key = b''.join(drh)
+        plan = self.by_drh.get(key)
+        if plan is None:
+            plan = RecordPlan(drh)
+            self.by_drh[key] = plan
+            self.by_signature[plan.signature] = plan
+        return plan
+
+    def decode_full(self, data: Union[bytes, memoryview], offset: int = 0) \
+            -> Optional[Tuple[RecordPlan, Tuple]]:
+        """
+        Decode the data records of a full frame, starting at offset, and learn its layout.
+        Returns the layout and the values, or None if the records could not be decoded.
+        """
+        # Most often the layout of the previous full frame
+        plan = self.__last_full
+        if plan is not None and len(data) - offset == plan.full.size:
+            if plan.headers.unpack_from(data, offset) == plan.drh:
+                return plan, plan.full.unpack_from(data, offset)
+
+        drh = split_records(data, offset)
+        if drh is None:
+            return None
+
+        plan = self.learn(drh)
+        self.__last_full = plan
+        return plan, plan.full.unpack_from(data, offset)
+
+    def decode_compact(self, data: Union[bytes, memoryview], offset: int = 0) \
+            -> Optional[Tuple[RecordPlan, Tuple]]:
+        """
+        Decode a compact frame, starting at its format signature at offset, by a layout with that signature.
+        Returns the layout and the values, or None if the signature is not known or the frame is too short.
+        """
+        try:
+            signature = COMPACT_HEADER.unpack_from(data, offset)[0]
+            plan = self.by_signature.get(signature)
+            if plan is None:
+                self.unknown_signatures += 1
+                return None
+            return plan, plan.compact.unpack_from(data, offset + COMPACT_HEADER.size)
+        except StructError:
+            return None
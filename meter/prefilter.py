@@ -0,0 +1,90 @@
+"""
+Fast reject of telegrams before parsing
+***************************************
+
+:platform: Python 3.5.10 on Linux
+:synopsis: Checks the fixed header fields of a raw C1 telegram, and drops foreign or garbage telegrams
+           before a C1Telegram is made or any exception is raised.
+
+Most telegrams heard are from meters that are not monitored, and some are damaged.
+Instead of parsing each one, the prefilter reads the few fields it needs from fixed offsets
+(see the first table in meter/OmniPower.py):
+
++--------+-------+-------+--------------------------------------------------------------+
+| Field  | Byte# | Bytes | Check                                                        |
++========+=======+=======+==============================================================+
+| L      | 0     | 1     | Equal to the length of the telegram, less L and the CRC16    |
++--------+-------+-------+--------------------------------------------------------------+
+| M      | 2-3   | 2     | With A, version and medium: identity of a monitored meter    |
++--------+-------+-------+--------------------------------------------------------------+
+| A      | 4-7   | 4     |                                                              |
++--------+-------+-------+--------------------------------------------------------------+
+| Ver.   | 8     | 1     |                                                              |
++--------+-------+-------+--------------------------------------------------------------+
+| Medium | 9     | 1     |                                                              |
++--------+-------+-------+--------------------------------------------------------------+
+| CI     | 10    | 1     | 0x8D, Extended Link Layer, as sent by the OmniPower          |
++--------+-------+-------+--------------------------------------------------------------+
+
+Rejected telegrams are counted by reason, see `REASONS`.
+
+"""
+
+from struct import Struct
+from typing import Any, Container, Dict, Optional, Tuple, Union
+
+
+CI_ELL = 0x8D                   # Extended Link Layer, the only CI field parsed by C1Telegram
+HEADER_PEEK = Struct('<BxHIBBB')   # L, (C), M, A, version, medium, CI
+MIN_LENGTH = 17 + 2             # Header and the CRC16 from the IM871-A
+LENGTH_OVERHEAD = 1 + 2         # Bytes not counted by L: L itself and the CRC16 from the IM871-A
+
+SHORT = 'short'                 # Too short to hold the header
+LENGTH = 'length'               # L field does not match the length received
+CI = 'ci'                       # Not an Extended Link Layer telegram
+UNMONITORED = 'unmonitored'     # From a meter that is not monitored
+REASONS = (SHORT, LENGTH, CI, UNMONITORED)
+
+
+class TelegramPrefilter:
+    """
+    Passes raw telegrams from monitored meters, counts the rest by reason.
+    Takes the identities (M, A, version, medium) of the monitored meters, e.g. a dict keyed by them.
+    The container is used as is, so updates to it take effect right away.
+    """
+
+    def __init__(self, monitored: Container[Tuple[int, int, int, int]]) -> None:
+        self.monitored = monitored
+        self.passed = 0
+        self.rejected = dict.fromkeys(REASONS, 0)     # type: Dict[str, int]
+
+    def identity(self, raw: Union[bytes, memoryview]) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Identity of the sending meter, if the telegram is well-formed and from a monitored meter.
+        Otherwise the reason is counted, and None returned.
+        """
+        if len(raw) < MIN_LENGTH:
+            self.rejected[SHORT] += 1
+            return None
+
+        length, m, a, version, medium, ci = HEADER_PEEK.unpack_from(raw)
+        if length + LENGTH_OVERHEAD != len(raw):
+            self.rejected[LENGTH] += 1
+            return None
+        if ci != CI_ELL:
+            self.rejected[CI] += 1
+            return None
+
+        identity = (m, a, version, medium)
+        if identity not in self.monitored:
+            self.rejected[UNMONITORED] += 1
+            return None
+
+        self.passed += 1
+        return identity
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Counters, for diagnostics.
+        """
+        return dict(self.rejected, passed=self.passed)
@@ -4,13 +4,25 @@ Metering system main event loop
 
 :Synopsis: This script is main loop which handles the system flow
 :Authors: Steffen, Thomas, Janus
-:Latest update: 17 November 2020
-:Version: 0.92
+:Latest update: 17 October 2026
+:Version: 1.04
 :Version history:
 * **Ver. 0.1**: Build main loop with queue and Mqtt startup.
 * **Ver. 0.9**: Implement mqtt to get command from ReCalc, dispatcher, and mqtt to send data to ReCalc.
 * **Ver. 0.91**: Implement (1) gw-id from settings into topics, (2) mqtt pub rc check (log on err), (3) Use DEBUG instead of print.
 * **Ver. 0.92**: Move functions out of __main__ section to document them.
+* **Ver. 0.93**: Read receive time and RSSI sent with each telegram by the driver.
+* **Ver. 0.94**: Send monitored meters to the driver, which drops telegrams from other meters before the FIFO.
+* **Ver. 0.95**: Read binary records (or hex lines) from the FIFO in blocks, and decode them without hex round trip.
+* **Ver. 0.96**: Optionally read telegrams in place from the driver's shared-memory ring (`--transport shm`).
+* **Ver. 0.97**: Optionally subscribe to the driver's fan-out socket (`--transport socket`), next to other consumers.
+* **Ver. 0.98**: Read through driver.sources, which reconnects after a driver restart instead of spinning on EOF.
+* **Ver. 0.99**: Handle all telegrams waiting as one batch per wakeup, debug output and publish wait once per batch.
+* **Ver. 1.0**: Optionally run the dongle readers in this process (`--transport inprocess`), without driver daemon.
+* **Ver. 1.01**: Dispatch telegrams through meter_index, keyed by the integer identity (M, A, version, medium).
+* **Ver. 1.02**: Reject malformed telegrams and telegrams from other meters by their header, before parsing.
+* **Ver. 1.03**: Meters with a bad AES key are logged once when registered, and not monitored.
+* **Ver. 1.04**: Optionally decrypt and extract in a pool of worker processes or threads (`--workers`).
 
 Starting and stopping the system
 --------------------------------
@@ -20,6 +32,18 @@ Starting and stopping the system
     - Stop: `./start_stop_system.sh stop`
 - Driver will be running as daemon and will create a FIFO as driver/IM871A_pipe.
 - This script will visibly run in terminal (debug).
+- With `TRANSPORT=shm ./start_stop_system.sh start`, the driver and this script use a shared-memory ring
+  in /dev/shm instead of the FIFO. See driver/shm_ring.py.
+- With `TRANSPORT=socket`, the driver serves telegrams on driver/IM871A.sock, and this script is one subscriber.
+  Other consumers, e.g. an archiver, can subscribe with driver.fanout.FanoutClient. See driver/fanout.py.
+- With `TRANSPORT=inprocess`, no driver daemon is started. This script brings up the dongle(s) itself and reads
+  them in threads, telegrams are handed over in memory (driver.sources.GroupSource). `--multi` and `--mode` are
+  as for driver/Start_Driver.py. The two-process modes remain, to keep the driver isolated from the main loop.
+- With `--workers N`, telegrams are decrypted and their measurements extracted by N worker processes
+  (or threads with `--worker-mode thread`), while this loop reads, filters and publishes. Each meter is
+  handled by one worker, so its measurements are published in order. See run/workers.py.
+- The driver may be restarted while this script runs. The FIFO, ring or socket is reconnected in the background
+  of the main loop, with back-off, so MQTT commands are still handled. See driver/sources.py.
 
 Stopping the system over MQTT
 -----------------------------
@@ -31,8 +55,9 @@ Stopping the system over MQTT
 Data flows
 ----------
 
-* Config flow: ReCalc command (mqtt) -> Update Dispatcher
+* Config flow: ReCalc command (mqtt) -> Update Dispatcher -> Address filter in driver (control FIFO)
 * Data flow: Driver -> (FIFO) -> C1-parser -> Dispatcher -> Handler (OmniPower) -> Mqtt publish data
+* Each wakeup takes every telegram waiting. MQTT messages are queued for the whole batch, then waited for once.
 * Error logging flow: On errors -> Logger -> SysLog
 
 Testing
@@ -50,6 +75,10 @@ Handling data from ReCalc
 Monitored list is built based on serial numbers from ReCalc messages:
 
 - Keeps object (dispatcher) to keep track of monitored meters.
+- Telegrams are dispatched by meter_index, keyed by the meter's identity (M, A, version, medium) as integers,
+  made once when the meters are registered, so no hex strings are made per telegram.
+- Before a telegram is parsed, the prefilter checks its header (meter/prefilter.py), and drops it if it is
+  malformed or not from a meter in meter_index. Rejected telegrams are counted by reason, shown with DEBUG.
 - No method (or way) to report if a serial numbers is invalid.
 - Invalid serial numbers will be monitored, but no data will ever be sent.
 - Consider expanding ReCalc Cloud API to receive messages about invalid commands.
@@ -66,15 +95,25 @@ Future implementation of more meters
 """
 
 from collections import deque
+import argparse
 import json
 import os
-from select import select
+import time
+from typing import Any, Dict, Iterable, List, Tuple
 
 from mqtt.MqttClient import MqttClient, donothing_onmessage, donothing_onpublish, publish_rc_str, publish_rc_bool
 from meter.OmniPower import OmniPower, C1Telegram
+from meter.prefilter import TelegramPrefilter
 from utils.log import log_error, log_info
 from utils.load_settings import load_settings
+from utils.Search_for_dongle import im871a_port, im871a_ports
 import mqtt.api as api
+from driver.sources import FifoSource, RingSource, SocketSource, GroupSource
+from driver.multi import IM871AGroup
+from driver.shm_ring import RING_PATH
+from driver.fanout import SOCKET_NAME
+from driver.control import send_meters, CONTROL_FIFO
+from run.workers import DecryptPool, MODES, PROCESS
 
 
 def run_system():
@@ -82,6 +121,9 @@ def run_system():
     Implements the main loop to run the entire system.
     """
 
+    # Reconnects to the driver seen so far
+    reconnects = 0
+
     # Main event loop
     DEBUG("Listening on MQTT.")
     while True:
@@ -97,6 +139,7 @@ def run_system():
             # ReCalc sends list with objects, each object represents a sensor to monitor
             obj_list = json.loads(q_elem[1])
             meter_list.clear()
+            meter_index.clear()
 
             # Step 2: Process message objects and update data structure
             for obj in obj_list:
@@ -121,6 +164,14 @@ def run_system():
                 # TODO: Prevent two objects with same serial number if sent by mistake?
                 meter_list.update({meter_id: meter_control})
 
+                # Index for dispatching telegrams, meters with invalid settings or key can not receive any
+                identity = meter_control["handler"].identity
+                key_error = meter_control["handler"].key_error
+                if key_error is not None:
+                    log_error("Meter {} not monitored: {}".format(meter_id, key_error))
+                elif identity is not None:
+                    meter_index[identity] = meter_control
+
                 # Make config topic
                 # v2/<gw-id>/<manufacturer-key>-<device-id>/config
                 config_topic = "v2/" + str(gw_id) + "/" + obj['ManufacturerKey'] + "-" + obj['DeviceId'] + "/config"
@@ -138,50 +189,125 @@ def run_system():
             DEBUG("Monitored meters:")
             DEBUG(str(meter_list))
 
-        # Step 3: Read telegram data from driver via FIFO
-        # Wait for data to read on fifo, break every 10 sec to check MQTT
-        # If this times out, we will just read an empty FIFO and restart loop.
-        select([fifo], [], [], 10)
+            # Workers get the meters, and their keys, once
+            if pool is not None:
+                pool.set_meters([m["handler"] for m in meter_index.values()])
+
+            # Let the driver drop telegrams from other meters
+            meters = [(m["handler"].manufacturer_id, m["handler"].meter_id) for m in meter_list.values()]
+            if isinstance(source, GroupSource):
+                source.set_meters(meters)
+            else:
+                send_meters(control_path, meters)
 
-        msg = fifo.readline().strip()   # UTF-8 without line break
-        if not msg:                     # If EOF telegram, just start loop again
+        # Step 3: Wait for telegram data from the driver, break every 10 sec to check MQTT
+        # If the driver is gone, this waits for it to come back, also at most 10 sec.
+        if not source.wait(10):
             continue
 
-        DEBUG("Message received from IM871A")
-        DEBUG(msg)
+        # Step 4-6: Process every complete telegram received, as one batch
+        # Ring records are read in place, and consumed when the next one is taken.
+        handle_batch(source.records())
 
-        # Step 4: Process received telegram
-        try:
-            telegram = C1Telegram(msg.encode())             # Must take bytes, not UTF-8
-            address = telegram.big_endian['A'].decode()     # Gets address into UTF-8 string
+        if source.reconnects != reconnects:
+            reconnects = source.reconnects
+            DEBUG("Reconnected to driver, {} times".format(reconnects))
 
-            # Step 5: Let a registered meter handle the telegram
-            if address in meter_list.keys():
-                DEBUG("Received data on monitored meter.")
-                meter_list[address]["handler"].process_telegram(telegram)
 
-                # See the log after message parsed, decrypted, etc.
-                DEBUG(meter_list[address]["handler"].measurement_log[-1])
+def handle_batch(records: Iterable[Tuple[Any, Dict[str, Any]]]) -> int:
+    """
+    Handle every telegram taken from the driver in one wakeup, and publish the measurements.
+    Messages for the whole batch are queued with the publisher first, and then waited for together,
+    so the fixed costs (debug output, waiting for the MQTT thread) are paid once per batch.
+    With a worker pool, the telegrams are decrypted by the workers, and published when all have answered.
+    collect() blocks once per batch, so decrypting a batch does not overlap with reading the next one:
+    the workers spread a batch over cores, they do not pipeline batches.
+    Uses publisher, pool, prefilter and meter_index from __main__ section. Returns the number of telegrams handled.
+    """
 
-                # Step 6: Make MQTT message and send
-                topic = meter_list[address]["mqttTopic"]
-                data_frame = meter_list[address]["handler"].measurement_log.pop()
-                data_msg_list = api.build_api_message_from_log_obj(data_frame)
+    count = 0
+    oldest = None
+    pending = []    # type: List[Any]
+    for raw_telegram, rx_info in records:
+        count += 1
+        if oldest is None:
+            oldest = rx_info.get('rx_monotonic')
+        if pool is None:
+            pending += handle_telegram(raw_telegram, rx_info)
+        else:
+            identity = prefilter.identity(raw_telegram)
+            if identity is not None:
+                pool.submit(identity, raw_telegram, rx_info)
+
+    if pool is not None:
+        for identity, data_frame in pool.collect():
+            # A failing frame, or a meter removed meanwhile, must not stop the others, as in handle_telegram
+            try:
+                pending += publish_frame(meter_index[identity], data_frame)
+            except Exception as e:
+                log_error(e)
+
+    if oldest is not None:
+        DEBUG("Received {} telegrams from IM871A, first queued for {:.1f} ms since reception".format(
+            count, (time.monotonic() - oldest) * 1000))
+    else:
+        DEBUG("Received {} telegrams from IM871A".format(count))
+    DEBUG("Prefilter: {}".format(prefilter.stats()))
+
+    # Step 6 (end): Wait once for all messages of the batch to be sent
+    failed = 0
+    for rc in pending:
+        if publish_rc_bool(rc):
+            rc.wait_for_publish()
+        else:
+            failed += 1
+            DEBUG("MQTT message not sent, rc " + str(rc) + ": " + publish_rc_str(rc) + ".")
+
+    if pending:
+        DEBUG("Sent {} MQTT messages".format(len(pending) - failed))
+    if failed:
+        # Save message somewhere
+        log_info("Failed to send {} MQTT messages".format(failed))
+    return count
+
+
+def handle_telegram(raw_telegram: bytes, rx_info: dict) -> List[Any]:
+    """
+    Parse a telegram from the driver, let the registered meter handle it, and publish the measurements.
+    Takes the raw telegram bytes and the receive information decoded from the FIFO.
+    Returns the publish results, which are not waited for here, see handle_batch().
+    Uses prefilter, meter_index and publisher from __main__ section.
+    """
 
-                # Loop over all measurements to be sent
-                for data_msg in data_msg_list:
-                    rc = publisher.publish(topic, json.dumps(data_msg))
-                    DEBUG(json.dumps(data_msg))
-                    rc.wait_for_publish()
+    # Step 4: Drop malformed telegrams and telegrams from other meters, without parsing them
+    identity = prefilter.identity(raw_telegram)
+    if identity is None:
+        return []
 
-                DEBUG("Sent MQTT message with rc" + str(rc) + ": " + publish_rc_str(rc) + ".")
-                if not publish_rc_bool(rc):
-                    # Save message somewhere
-                    log_info("Failed to send MQTT message")
+    # Step 5: Let the registered meter handle the telegram
+    try:
+        telegram = C1Telegram.from_bytes(raw_telegram, **rx_info)
+        meter = meter_index[identity]
+        if meter["handler"].process_telegram(telegram):
+            return publish_frame(meter, meter["handler"].measurement_log.pop())
 
-        except Exception as e:
+    except Exception as e:
 
-            log_error(e)
+        log_error(e)
+
+    return []
+
+
+def publish_frame(meter: Dict[str, Any], data_frame: Any) -> List[Any]:
+    """
+    Step 6: Make MQTT messages from a measurement frame of a meter in meter_list, and queue them for sending.
+    Returns the publish results. Uses publisher from __main__ section.
+    """
+    topic = meter["mqttTopic"]
+    data_msg_list = api.build_api_message_from_log_obj(data_frame)
+
+    # Loop over all measurements to be sent
+    return [publisher.publish(topic, json.dumps(data_msg)) for data_msg in data_msg_list]
 
 
 def on_command_callback(client, userdata, message):
@@ -203,10 +329,12 @@ def on_command_callback(client, userdata, message):
 def end_loop():
     """
     Function to cleanly exit loop and end threads, disconnect.
-    From __main__ section: FIFO queue, fifo; Mqtt subscriber, recalc; Mqtt publisher.
+    From __main__ section: Telegram source, source; worker pool, pool; Mqtt subscriber, recalc; Mqtt publisher.
     """
 
-    fifo.close()
+    source.close()
+    if pool is not None:
+        pool.close()
     recalc.loop_stop()
 
     # TODO: Consider implementing disconnects in destructors (must be tested)
@@ -227,6 +355,16 @@ def DEBUG(message: str):
 
 if __name__ == '__main__':
     # When run from terminal, it sets up globals, and away we go...
+    parser = argparse.ArgumentParser(description="Metering system main loop")
+    parser.add_argument('--transport', choices=('fifo', 'shm', 'socket', 'inprocess'), default='fifo',
+                        help="read from pipe, shared-memory ring, fan-out socket, or the dongles in this process")
+    parser.add_argument('--ring', default=RING_PATH, help="path of the shared-memory ring")
+    parser.add_argument('--multi', action='store_true', help="inprocess: use all IM871A dongles found")
+    parser.add_argument('--mode', action='append', help="inprocess: link mode, repeat for each dongle (default c1a)")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="decrypt in this many workers, 0 to decrypt in the main loop (default)")
+    parser.add_argument('--worker-mode', choices=MODES, default=PROCESS, help="workers are processes or threads")
+    args = parser.parse_args()
 
     # Debug printouts
     DEBUG_ON = True
@@ -237,16 +375,42 @@ if __name__ == '__main__':
     # Dispatcher object, empty dict (hashmap)
     meter_list = {}
 
+    # Same meters by identity (M, A, version, medium), for dispatching telegrams
+    meter_index = {}
+
+    # Passes only well-formed telegrams from the meters in meter_index
+    prefilter = TelegramPrefilter(meter_index)
+
+    # Started before the MQTT threads, so worker processes do not inherit them
+    pool = DecryptPool(args.workers, args.worker_mode) if args.workers > 0 else None
+
     # Try to open FIFO, first build an absolute path to the FIFO
     curr_path = os.path.dirname(os.path.abspath(__file__))
     base_path = os.path.split(curr_path)[0]
     fifo_path = os.path.join(base_path, "driver", "IM871A_pipe")
+    control_path = os.path.join(base_path, "driver", CONTROL_FIFO)
 
+    # Sources do not wait for the driver, they connect when it is there
     try:
-        DEBUG("Trying to open FIFO, waiting for communication partner.")
-        fifo = open(fifo_path, 'r')
-        DEBUG("Connected to pipe: {}".format(fifo_path))
-    except OSError as err:
+        if args.transport == 'shm':
+            source = RingSource(args.ring)
+            DEBUG("Connected to ring: {} {}".format(args.ring, source.ring.stats()))
+        elif args.transport == 'socket':
+            socket_path = os.path.join(base_path, "driver", SOCKET_NAME)
+            source = SocketSource(socket_path)
+            DEBUG("Subscribing to: {}".format(socket_path))
+        elif args.transport == 'inprocess':
+            ports = im871a_ports() if args.multi else [im871a_port()]
+            group = IM871AGroup(os.path.join(base_path, "driver"), ports, hotplug=True)
+            if not group.bring_up(args.mode or ['c1a']):
+                log_error("IM871A could not bring up dongle")
+                exit(1)
+            source = GroupSource(group)
+            DEBUG("Reading in process from: {}".format(ports))
+        else:
+            source = FifoSource(fifo_path)
+            DEBUG("Reading from pipe: {}".format(fifo_path))
+    except Exception as err:
         log_error(err)
         exit(1)
 
@@ -0,0 +1,248 @@
+"""
+Worker pool for decrypting telegrams
+************************************
+
+:Platform: Python 3.5.10 on Linux
+:Synopsis: Decrypts, CRC-checks and extracts measurements on several cores, for the main loop in run_system.
+
+At dense sites, decrypting and extracting measurements on one thread can fall behind the dongles.
+The pool spreads this stage over worker processes (or threads), while the main loop keeps reading,
+filtering and publishing:
+
+- Each worker has its own meters, made from the settings (including the AES key) sent by `set_meters`,
+  only when the monitored meters change. Telegrams carry no keys.
+- A meter belongs to one worker, chosen by its address (A). That worker handles its telegrams one by one,
+  in the order received, so the measurements of a meter stay in order.
+- The telegrams of a batch are sent to each worker in one message, and the measurement frames come back
+  in one message per worker. The batch is finished when all workers have answered, see `collect`.
+- A worker that died (killed, crashed) is started again with its meters. Its telegrams of the batch are sent
+  again once, and given up on if it dies on them again. A batch waits at most `COLLECT_TIMEOUT`.
+  A worker process that does not answer in time is stopped and started again as well.
+- Each worker has its own inbox and outbox, so a worker dying while using a queue does not block the others.
+
+Processes use all cores, but telegrams and measurement frames are pickled between them.
+Threads avoid that, but only help as far as the work releases the GIL, which AES does, the rest not.
+
+"""
+
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from meter.MeterMeasurement import MeterMeasurement
+from meter.OmniPower import C1Telegram, OmniPower
+from utils.log import log_error
+
+
+PROCESS = 'process'
+THREAD = 'thread'
+MODES = (PROCESS, THREAD)
+
+COLLECT_TIMEOUT = 1.0       # Seconds to wait for the workers' answers before giving up on the batch
+POLL_INTERVAL = 0.05        # Seconds between checks that a worker being waited for is still alive
+
+# Messages to a worker
+METERS = 'meters'
+TELEGRAMS = 'telegrams'
+STOP = 'stop'
+
+Identity = Tuple[int, int, int, int]
+
+
+def meter_settings(meter: OmniPower) -> Dict[str, str]:
+    """
+    Settings to make the same meter in a worker, including its AES key.
+    """
+    return dict(name=meter.name, meter_id=meter.meter_id, manufacturer_id=meter.manufacturer_id,
+                medium=meter.medium, version=meter.version, aes_key=meter.AES_key)
+
+
+def worker_loop(inbox: Any, outbox: Any, index: int) -> None:
+    """
+    Body of a worker. Takes messages from inbox until STOP:
+
+    - (METERS, settings): the meters of this worker, replacing those before.
+    - (TELEGRAMS, batch, telegrams): telegrams, each raw bytes and receive information.
+      Answers (index, batch, frames) on outbox, with the identity and measurement frame for each telegram
+      that gave one.
+    """
+    meters = {}     # type: Dict[Identity, OmniPower]
+    while True:
+        message = inbox.get()
+        if message[0] == STOP:
+            return
+
+        if message[0] == METERS:
+            meters = {}
+            for settings in message[1]:
+                meter = OmniPower(**settings)
+                meters[meter.identity] = meter
+            continue
+
+        frames = []     # type: List[Tuple[Identity, MeterMeasurement]]
+        for raw_telegram, rx_info in message[2]:
+            try:
+                telegram = C1Telegram.from_bytes(raw_telegram, **rx_info)
+                meter = meters.get(telegram.identity)
+                if meter is not None and meter.process_telegram(telegram):
+                    frames.append((telegram.identity, meter.measurement_log.pop()))
+            except Exception as e:
+                log_error(e)
+        outbox.put((index, message[1], frames))
+
+
+class DecryptPool:
+    """
+    Workers that decrypt and extract measurements, each for a fixed share of the meters.
+    Takes the number of workers, and whether they are processes or threads (mode).
+    """
+
+    def __init__(self, workers: int, mode: str = PROCESS) -> None:
+        if mode not in MODES:
+            raise ValueError("Unknown worker mode: {}".format(mode))
+        if workers < 1:
+            raise ValueError("At least one worker is needed, not {}".format(workers))
+
+        self.mode = mode
+        self.batches = 0
+        self.timeouts = 0           # Batches given up on, because a worker did not answer
+        self.restarts = 0           # Workers started again, after dying or not answering
+        self.__batch = 0
+        self.__pending = [[] for _ in range(workers)]   # type: List[List[Tuple[bytes, Dict[str, Any]]]]
+        self.__shares = [[] for _ in range(workers)]    # type: List[List[Dict[str, str]]]
+
+        if mode == PROCESS:
+            self.__make_queue = multiprocessing.Queue       # type: Callable[[], Any]
+            self.__make_worker = multiprocessing.Process    # type: Callable[..., Any]
+        else:
+            self.__make_queue = queue.Queue
+            self.__make_worker = threading.Thread
+
+        self.__inboxes = [None] * workers   # type: List[Any]
+        self.__outboxes = [None] * workers  # type: List[Any]
+        self.workers = [None] * workers     # type: List[Any]
+        for i in range(workers):
+            self.__start(i)
+
+    def __len__(self) -> int:
+        return len(self.workers)
+
+    def __start(self, i: int) -> None:
+        """
+        Start worker i, with new queues, and send it its meters.
+        """
+        self.__inboxes[i] = self.__make_queue()
+        self.__outboxes[i] = self.__make_queue()
+        self.workers[i] = self.__make_worker(target=worker_loop, args=(self.__inboxes[i], self.__outboxes[i], i),
+                                             name="decrypt-{}".format(i), daemon=True)
+        self.workers[i].start()
+        if self.__shares[i]:
+            self.__inboxes[i].put((METERS, self.__shares[i]))
+
+    def __restart(self, i: int, reason: str) -> None:
+        """
+        Stop worker i, if it is still running, and start it again.
+        """
+        log_error("Decrypt worker {} {}, starting it again".format(i, reason))
+        worker = self.workers[i]
+        if self.mode == PROCESS and worker.is_alive():
+            worker.terminate()
+        worker.join(0.1 if self.mode == PROCESS else 0)
+        self.restarts += 1
+        self.__start(i)
+
+    def worker_of(self, identity: Identity) -> int:
+        """
+        The worker handling the meter, by its address.
+        """
+        return identity[1] % len(self.workers)
+
+    def set_meters(self, meters: Sequence[OmniPower]) -> None:
+        """
+        Send the monitored meters, with their keys, each to its worker.
+        They are kept, to send them again to a worker that is started again.
+        """
+        shares = [[] for _ in self.workers]     # type: List[List[Dict[str, str]]]
+        for meter in meters:
+            if meter.identity is not None:
+                shares[self.worker_of(meter.identity)].append(meter_settings(meter))
+
+        self.__shares = shares
+        for inbox, share in zip(self.__inboxes, shares):
+            inbox.put((METERS, share))
+
+    def submit(self, identity: Identity, raw_telegram: Union[bytes, memoryview], rx_info: Dict[str, Any]) -> None:
+        """
+        Add a telegram to the batch, for the worker of the meter with the identity.
+        The telegram is copied, so it may be read in place from the driver.
+        """
+        self.__pending[self.worker_of(identity)].append((bytes(raw_telegram), rx_info))
+
+    def collect(self, timeout: float = COLLECT_TIMEOUT) -> List[Tuple[Identity, MeterMeasurement]]:
+        """
+        Send the batch to the workers, and wait for their measurement frames.
+        Frames of a meter are in the order its telegrams were submitted.
+        A worker found dead is started again, see the module. If the workers do not answer within timeout,
+        the frames received so far are returned.
+        """
+        self.__batch += 1
+        batch = self.__batch
+        sent = {}       # type: Dict[int, List[Tuple[bytes, Dict[str, Any]]]]
+        for i, telegrams in enumerate(self.__pending):
+            if telegrams:
+                if not self.workers[i].is_alive():
+                    self.__restart(i, "died")
+                self.__inboxes[i].put((TELEGRAMS, batch, telegrams))
+                self.__pending[i] = []
+                sent[i] = telegrams
+
+        # The answers are needed from all workers, so they are taken in order of the workers
+        frames = []     # type: List[Tuple[Identity, MeterMeasurement]]
+        deadline = time.monotonic() + timeout
+        retried = set()     # type: Set[int]
+        missing = []    # type: List[int]
+        for i in sorted(sent):
+            while True:
+                remaining = deadline - time.monotonic()
+                try:
+                    index, answered, worker_frames = self.__outboxes[i].get(
+                        timeout=min(max(remaining, 0), POLL_INTERVAL))
+                except queue.Empty:
+                    if not self.workers[i].is_alive():
+                        self.__restart(i, "died")
+                        if i in retried:
+                            log_error("Decrypt worker {} died again, {} telegrams lost".format(i, len(sent[i])))
+                            break
+                        retried.add(i)
+                        self.__inboxes[i].put((TELEGRAMS, batch, sent[i]))
+                    elif remaining <= 0:
+                        missing.append(i)
+                        break
+                    continue
+
+                # Late answers to a batch given up on are dropped
+                if answered == batch:
+                    frames += worker_frames
+                    break
+
+        if missing:
+            self.timeouts += 1
+            log_error("Decrypt workers did not answer within {} s, {} missing".format(timeout, len(missing)))
+            # Threads cannot be stopped, their late answers are dropped
+            if self.mode == PROCESS:
+                for i in missing:
+                    self.__restart(i, "did not answer")
+
+        self.batches += 1
+        return frames
+
+    def close(self, timeout: Optional[float] = 1.0) -> None:
+        """
+        Stop the workers.
+        """
+        for inbox in self.__inboxes:
+            inbox.put((STOP,))
+        for worker in self.workers:
+            worker.join(timeout)
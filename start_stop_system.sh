@@ -1,4 +1,7 @@
 # Script to start/stop Omnipower/WMBUS reading system 
+# Set TRANSPORT=shm to pass telegrams through shared memory instead of the UNIX pipe
+# Set TRANSPORT=inprocess to read the dongle in the main loop's process, without driver daemon
+TRANSPORT=${TRANSPORT:-fifo}
 
 
 # Test for input argument
@@ -14,17 +17,34 @@ else
 		# Look for driver
 		pids=$(pgrep -f driver/Start_Driver.py)
 		echo $pids
-		if [[ $pids != "" ]]
+		if [[ $TRANSPORT == "inprocess" ]]
+		then
+		  echo "Driver runs in main loop"
+		elif [[ $pids != "" ]]
 		then
 		  echo "Driver already running"
 		else
-		  PYTHONPATH=$PYTHONPATH:pwd python driver/Start_Driver.py
+		  # Remove readiness file left behind by a driver that did not stop cleanly
+		  rm -f driver/IM871A_ready
+		  PYTHONPATH=$PYTHONPATH:pwd python driver/Start_Driver.py --transport $TRANSPORT
 		fi
 		
-		# 2 seconds delay. This is to make time for the driver to create the UNIX pipe. 
-		sleep 2
+		# Wait for the driver to signal that the dongle is set up and the UNIX pipe exists, at most 5 seconds.
+		for i in $(seq 1 100)
+		do
+		  if [[ $TRANSPORT == "inprocess" ]]
+		  then
+		    break
+		  fi
+		  if [ -e driver/IM871A_ready ]
+		  then
+		    echo "Driver ready: $(cat driver/IM871A_ready)"
+		    break
+		  fi
+		  sleep 0.05
+		done
 		# Start main event loop in this terminal
-		PYTHONPATH=$PYTHONPATH:pwd python run/run_system.py
+		PYTHONPATH=$PYTHONPATH:pwd python run/run_system.py --transport $TRANSPORT
 
 	elif [ $1 == "stop" ]
 	then
@@ -15,9 +15,11 @@ import pytest
 import os
 from unittest import mock
 import serial as port  # type: ignore
+from binascii import hexlify
 
 # Import class to be tested
 from driver.DriverClass import IM871A
+from driver.ipc import RecordDecoder, RecordWriter
 
 
 # Data from DriverClass testrun
@@ -57,38 +59,70 @@ def test_vectors():
     """
 
     # specify data as
-    # (raw bytes, raw bytes as hex in ascii, message expected in pipe)
+    # (raw bytes, raw bytes as hex in ascii, telegram expected in pipe)
     t = [(b'\xa5\x82\x03!D-,\x12P\x00d\x1b\x16\x8d ?\x02\xd9\xf3" Z\x06G\xe3hH\xe4\x0cE"V\x90~P\x1d\xe9\xfdl',
           'a5820321442d2c125000641b168d203f02d9f322205a0647e36848e40c452256907e501de9fd6c',
-          '21442d2c125000641b168d203f02d9f322205a0647e36848e40c452256907e501de9fd6c\n'), ]
+          b'21442d2c125000641b168d203f02d9f322205a0647e36848e40c452256907e501de9fd6c'), ]
     return t
 
 
+def pipe_telegrams(messages):
+    """
+    Pull the hex telegram out of each record written to the pipe.
+    """
+    decoder = RecordDecoder()
+    telegrams = [hexlify(t) for m in messages for t, _ in decoder.feed(m)]
+    assert len(decoder.buffer) == 0
+    return telegrams
+
+
 class PatchSerial:
     """
     Fakes the serial.Serial object.
     Avoids attempts of write/read operations from /dev/tty devices on local machines.
+    Every request written gets a response frame, and otherwise a raw radio frame is read.
     """
 
     def __init__(self, read_raw_return):
         self.read_raw_return = read_raw_return
+        self.responses = []
+        self.down_pings = 0     # Number of pings to leave unanswered, e.g. while module restarts
+
+        # The driver waits in select() on the port, so expose a descriptor that is always readable
+        self.__ready_r, self.__ready_w = os.pipe()
+        os.write(self.__ready_w, b'x')
+
+    def fileno(self):
+        return self.__ready_r
+
+    @property
+    def in_waiting(self):
+        if self.responses:
+            return len(self.responses[0])
+        return len(self.read_raw_return)
 
     def close(self):
         return True
 
     def read(self, num_bytes):
-        if num_bytes <= 10:
-            # Reading return value from setting config
+        if self.responses:
+            # Reading response to a request, e.g. for setting config
             # 0xa5 for SOF
             # 0x01 for DEVMGMT_ID
             # 0x04 for DEVMGMT_MSG_SET_CONFIG_RSP
-            return b'\xa5\x01\x04'
+            # 0x01 for length, 0x00 for status OK
+            return self.responses.pop(0)
 
-        elif num_bytes > 10:
-            # Reading a raw serial bytes message
-            return self.read_raw_return
+        # Reading a raw serial bytes message
+        return self.read_raw_return
 
     def write(self, message_bytes):
+        if message_bytes[2] == 0x01 and self.down_pings > 0:
+            self.down_pings -= 1
+            return True
+
+        # Respond with the same endpoint, msg-id + 1 and status OK
+        self.responses.append(bytes([0xa5, message_bytes[1], message_bytes[2] + 1, 0x01, 0x00]))
         return True
 
 
@@ -100,10 +134,12 @@ class PipeWriter:
 
     def __init__(self):
         self.message = str()
+        self.messages = []
 
     def write(self, message):
         # Store the message
         self.message = message
+        self.messages.append(message)
         return True
 
     def close(self):
@@ -178,6 +214,59 @@ def test_setup_linkmode(patched_driver):
     assert d.setup_linkmode('c1a')
 
 
+@pytest.mark.skipif(is_on_gateway(), reason="Don't run mocked tests on Gateway")
+def test_bring_up(patched_driver):
+    """
+    Bring-up waits for the module to go down and come back after reset, then sets up link mode.
+    """
+    d = patched_driver  # Get fixture
+    d.IM871 = PatchSerial(b'')
+    d.IM871.down_pings = 2
+
+    assert d.bring_up('c1a')
+    assert list(d.bring_up_times.keys()) == ['reset', 'restart', 'ready', 'linkmode']
+    assert d.IM871.down_pings == 0
+
+
+@pytest.mark.skipif(is_on_gateway(), reason="Don't run mocked tests on Gateway")
+def test_command_keeps_radio_frames(patched_driver):
+    """
+    A radio frame received before the response to a command must not be discarded.
+    """
+    d = patched_driver  # Get fixture
+    d.IM871 = PatchSerial(test_vectors()[0][0])
+    d.fp = PipeWriter()
+    d.writer = RecordWriter(d.fp)
+
+    # Radio frame is read first, then the ping response
+    d.IM871.responses.append(test_vectors()[0][0])
+    assert d.ping()
+
+    assert len(d.backlog) == 1
+    assert d.read_data()
+    assert pipe_telegrams(d.fp.messages) == [test_vectors()[0][2]]
+
+
+@pytest.mark.skipif(is_on_gateway(), reason="Don't run mocked tests on Gateway")
+def test_reconnect(patched_driver):
+    """
+    Reconnect opens the new port, drops half-received bytes and sets up link mode again.
+    """
+    d = patched_driver  # Get fixture
+    new_port = PatchSerial(b'')
+    new_port.down_pings = 1
+    d.framer.feed(test_vectors()[0][0][:10])
+
+    with mock.patch("driver.DriverClass.port.Serial", return_value=new_port) as mock_serial:
+        assert d.reconnect('c1a', '/dev/serial/by-id/usb-IMST_GmbH_iM871A-USB_2-if00-port0')
+
+    assert mock_serial.call_args[1]['port'] == '/dev/serial/by-id/usb-IMST_GmbH_iM871A-USB_2-if00-port0'
+    assert d.Port == '/dev/serial/by-id/usb-IMST_GmbH_iM871A-USB_2-if00-port0'
+    assert d.IM871 is new_port
+    assert len(d.framer.buffer) == 0
+    assert new_port.down_pings == 0
+
+
 #@pytest.mark.skip
 @pytest.mark.skipif(is_on_gateway(), reason="Don't run mocked tests on Gateway")
 def test_read_data(patched_driver):
@@ -191,7 +280,22 @@ def test_read_data(patched_driver):
     assert d.read_data()
 
     # Require that read_data() has entered correct message into "pipe"
-    assert d.fp.message == test_vectors()[0][2]
+    assert pipe_telegrams([d.fp.message]) == [test_vectors()[0][2]]
+
+
+@pytest.mark.skipif(is_on_gateway(), reason="Don't run mocked tests on Gateway")
+def test_read_data_multiple_frames(patched_driver):
+    """
+    Two frames received in a single read must both be sent to the pipe.
+    """
+
+    d = patched_driver  # Get fixture
+    d.IM871 = PatchSerial(test_vectors()[0][0] * 2)
+    d.fp = PipeWriter()
+    d.writer = RecordWriter(d.fp)
+
+    assert d.read_data()
+    assert pipe_telegrams(d.fp.messages) == [test_vectors()[0][2]] * 2
 
 
 # Can object be instantiated
@@ -214,8 +318,8 @@ def test_read_data_RPi(IM871A_pipe, input_data):
     test_driver = IM871A(path_pipe)
     test_driver.setup_linkmode('c1a')
 
-    # Open pipe
-    test_driver.open_pipe()
+    # Open pipe, with hex lines so the text file can be read back line by line
+    test_driver.open_pipe(binary=False)
 
     assert test_driver.read_data()
 
@@ -9,7 +9,10 @@ import json
 
 # Include implementation to be tested
 from meter.OmniPower import C1Telegram, OmniPower, TelegramParseException, AesKeyException, CrcCheckException
-from utils.timezone import zulu_time_str
+from utils.timezone import zulu_time_str, ZuluTime
+from utils.crc16_wmbus import crc16_check_raw
+from datetime import datetime
+from binascii import hexlify, unhexlify
 
 
 @pytest.fixture
@@ -299,3 +302,139 @@ def test_process_telegram_returns_false_if_not_parsable(omnipower_base, good_tel
     # Make telegram and attempt to process. Expect False if not sent by this meter
     t = C1Telegram(tlg.encode())
     assert omnipower.process_telegram(t) is False
+
+
+def test_measurement_stamped_with_receive_time(omnipower_base, good_telegrams_list):
+    """
+    Receive time and RSSI from the driver must travel through to the measurement frame,
+    instead of the time of parsing.
+    """
+    omnipower = omnipower_base
+    rx_time = datetime(2020, 11, 20, 8, 0, 0, tzinfo=ZuluTime())
+
+    t = C1Telegram(good_telegrams_list[0], rx_time=rx_time, rssi=0xB4)
+    assert omnipower.process_telegram(t)
+
+    frame = omnipower.measurement_log[-1]
+    assert frame.timestamp == rx_time
+    assert frame.rssi == 0xB4
+    assert frame.as_dict()['RSSI'] == 0xB4
+
+
+def test_from_bytes_matches_hex(omnipower_base, good_telegrams_list):
+    """
+    A telegram made from raw bytes, also a memoryview, has the same fields as one made from hex,
+    and is decrypted the same way.
+    """
+    for hex_telegram in good_telegrams_list:
+        t_hex = C1Telegram(hex_telegram)
+        t_raw = C1Telegram.from_bytes(memoryview(unhexlify(hex_telegram)))
+
+        assert t_raw.big_endian == t_hex.big_endian
+        assert t_raw.big_endian['A'] == b'32666857'
+        assert t_raw.SN == t_hex.SN
+        assert t_raw.prefix == t_hex.prefix
+        assert t_raw.encrypted == t_hex.encrypted
+        assert omnipower_base.decrypt(t_raw) == omnipower_base.decrypt(t_hex)
+
+
+def test_identity_dispatch(good_telegrams_list):
+    """
+    A meter is found by its telegrams' identity, settings are compared as numbers, not strings.
+    Settings that are not hex match no telegram.
+    """
+    meter = OmniPower(meter_id='32666857', manufacturer_id='2c2d')
+    index = {meter.identity: meter}
+    t = C1Telegram(good_telegrams_list[0])
+
+    assert index.get(t.identity) is meter
+    assert meter.is_this_my(t)
+    assert OmniPower(meter_id='not-hex').identity is None
+    assert not OmniPower(meter_id='not-hex').is_this_my(t)
+
+
+def test_identity_out_of_range(good_telegrams_list):
+    """
+    Hex settings too large or negative for their field in the telegram header give no identity,
+    instead of failing to make the meter.
+    """
+    t = C1Telegram(good_telegrams_list[0])
+    for settings in (dict(meter_id='123456789'), dict(meter_id='-1'), dict(manufacturer_id='12C2D'),
+                     dict(version='100'), dict(medium='-2')):
+        meter = OmniPower(**settings)
+        assert meter.identity is None
+        assert not meter.is_this_my(t)
+
+
+def test_identity_exact_hex(good_telegrams_list):
+    """
+    Settings are only the hex digits of their field, so prefixes, signs, spaces or other widths match nothing.
+    """
+    t = C1Telegram(good_telegrams_list[0])
+    assert OmniPower(manufacturer_id='2c2d').identity == t.identity
+    for settings in (dict(manufacturer_id='0x2C2D'), dict(manufacturer_id=' 2c2d '), dict(medium='+2'),
+                     dict(meter_id='0032666857'), dict(meter_id='2666857'), dict(version='030')):
+        meter = OmniPower(**settings)
+        assert meter.identity is None
+        assert not meter.is_this_my(t)
+
+
+def test_binary_path_matches_hex(omnipower_base, good_telegrams_list):
+    """
+    Decryption and unpacking on bytes give the same as on hex, and the CRC16 is checked on bytes.
+    """
+    for hex_telegram in good_telegrams_list:
+        t = C1Telegram.from_bytes(memoryview(unhexlify(hex_telegram)))
+        plaintext = omnipower_base.decrypt_raw(t)
+
+        assert plaintext == unhexlify(omnipower_base.decrypt(t))
+        assert t.decrypt_using(omnipower_base)
+        assert t.plaintext == plaintext
+        assert t.decrypted == hexlify(plaintext)
+
+        if plaintext[OmniPower.tpl_ci_byte] == OmniPower.tpl_ci_compact_byte:
+            assert OmniPower.unpack_short_telegram_data_raw(plaintext) == \
+                OmniPower.unpack_short_telegram_data(t.decrypted)
+        else:
+            assert OmniPower.unpack_long_telegram_data_raw(plaintext) == \
+                OmniPower.unpack_long_telegram_data(t.decrypted)
+
+    # A damaged payload fails the binary CRC16 check
+    with pytest.raises(CrcCheckException):
+        crc16_check_raw(b'\x00\x00' + plaintext[2:])
+
+
+def test_key_checked_when_set(good_telegrams_list):
+    """
+    A bad key is described when it is set, without raising, and each decrypt raises AesKeyException.
+    A good key set later is used from then on.
+    """
+    omnipower = OmniPower(aes_key='not a key')
+    t = C1Telegram(good_telegrams_list[0])
+
+    assert omnipower.key_error is not None
+    with pytest.raises(AesKeyException):
+        omnipower.decrypt_raw(t)
+
+    omnipower.AES_key = '9A25139E3244CC2E391A8EF6B915B697'
+    assert omnipower.key_error is None
+    assert omnipower.decrypt_raw(t) == OmniPower().decrypt_raw(t)
+
+    # A telegram from another meter is decrypted with its own counter block, as before
+    assert OmniPower(meter_id='11111111').decrypt_raw(t) == omnipower.decrypt_raw(t)
+
+
+def test_decrypt_batch(omnipower_base, good_telegrams_list, bad_payload_list):
+    """
+    Decrypting many telegrams at once gives the same as one at a time, and None for a bad payload.
+    """
+    telegrams = [C1Telegram(t) for t in good_telegrams_list] + bad_payload_list
+    plaintexts = omnipower_base.decrypt_batch(telegrams)
+
+    assert plaintexts[:-1] == [omnipower_base.decrypt_raw(t) for t in telegrams[:-1]]
+    assert plaintexts[-1] is None
+    assert omnipower_base.decrypt_batch([]) == []
+
+    # Only the good telegrams are logged, as by process_telegram
+    assert omnipower_base.process_telegrams(telegrams) == len(good_telegrams_list)
+    assert len(omnipower_base.measurement_log) == len(good_telegrams_list)
@@ -0,0 +1,66 @@
+"""
+Tests for the driver's control channel and address filter.
+
+"""
+
+import os
+import time
+from binascii import unhexlify
+
+from driver.hci import HciFrame
+from driver.control import AddressFilter, ControlChannel, send_meters
+
+
+# Telegram from OmniPower 32666857, manufacturer 2C2D
+FRAME = unhexlify(b'a5820327442d2c5768663230028d201a13e00920dddf142f84b1107cae4e84dbcb98210fc275ddc868ce8d2554')
+
+
+def test_filter_passes_all_until_set():
+    f = AddressFilter()
+    assert f.accepts(HciFrame(FRAME))
+    assert f.stats() == {'meters': None, 'passed': 1, 'filtered': 0}
+
+
+def test_filter_monitored_and_foreign():
+    """
+    Only frames from monitored (M, A) pairs pass, the rest are counted.
+    """
+    f = AddressFilter()
+    f.set_meters([('2C2D', '32666857')])
+    assert f.accepts(HciFrame(FRAME))
+
+    f.set_meters([('2C2D', '12345678')])
+    assert not f.accepts(HciFrame(FRAME))
+
+    f.set_meters([])
+    assert not f.accepts(HciFrame(FRAME))
+    assert f.stats() == {'meters': 0, 'passed': 1, 'filtered': 2}
+
+
+def test_send_meters_over_fifo(tmpdir):
+    """
+    Meters sent by the main loop reach the filter in the driver.
+    """
+    path = str(tmpdir.join('IM871A_ctrl'))
+    f = AddressFilter()
+    ControlChannel(path, f).start()
+
+    # Channel opens the FIFO in its thread, wait for it to listen
+    deadline = time.monotonic() + 5
+    while not send_meters(path, [('2C2D', '12345678')]):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    while f.stats()['meters'] != 1:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert not f.accepts(HciFrame(FRAME))
+
+
+def test_send_meters_without_driver(tmpdir):
+    """
+    Sending never blocks, even when no driver is listening.
+    """
+    path = str(tmpdir.join('IM871A_ctrl'))
+    os.mkfifo(path)
+    assert not send_meters(path, [('2C2D', '32666857')])
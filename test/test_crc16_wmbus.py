@@ -0,0 +1,55 @@
+"""
+Tests for the wm-bus CRC16 (EN 13757).
+
+"""
+
+from binascii import unhexlify
+
+import pytest
+
+from utils.crc16_wmbus import Crc16, CrcCheckException, crc16_check, crc16_check_raw, crc16_wmbus, crc16_wmbus_raw
+
+
+# Messages (hex) and their CRC16 (hex, little-endian), from the self-test in utils/crc16_wmbus.py
+VECTORS = [(b'1444AE0C7856341201078C2027780B13436587', b'c57a'),
+           (b'79138C7976CE000000000000000400000000000000', b'bb52'),
+           (b'79138C4491CE000000000000000300000000000000', b'1170'),
+           (b'780404CE00000004843C00000000042B0300000004AB3C00000000', b'0fe6')]
+
+
+@pytest.mark.parametrize('message, expected_crc', VECTORS)
+def test_vectors(message, expected_crc):
+    """
+    Hex and binary functions, and the CRC16 given in parts, agree with the known CRC16s.
+    """
+    assert crc16_wmbus(message) == expected_crc
+    assert crc16_check(expected_crc + message)
+    assert crc16_check_raw(unhexlify(expected_crc + message))
+    assert Crc16(unhexlify(message)).digest() == unhexlify(expected_crc)
+
+    # Any split, also odd lengths and memoryviews
+    raw = unhexlify(message)
+    for split in range(len(raw) + 1):
+        crc = Crc16(raw[:split])
+        crc.update(memoryview(raw)[split:])
+        assert crc.hexdigest() == expected_crc
+        assert crc.value == crc16_wmbus_raw(raw)
+
+
+def test_check_fails():
+    """
+    A changed message fails the check, with the CRC16s in the exception as hex.
+    """
+    message, expected_crc = VECTORS[2]
+    with pytest.raises(CrcCheckException) as info:
+        crc16_check(expected_crc + message[:-1] + b'1')
+    assert info.value.crc_recv == expected_crc
+
+    with pytest.raises(CrcCheckException) as info:
+        crc16_check_raw(unhexlify(expected_crc + message[:-1] + b'1'))
+    assert info.value.crc_recv == expected_crc
+
+    # The hex function takes the message as a number, as it always has
+    assert crc16_wmbus(b'1') == crc16_wmbus(b'01')
+    with pytest.raises(ValueError):
+        crc16_wmbus(b'')
@@ -0,0 +1,58 @@
+"""
+Tests for decoding data records by DIF/VIF and by data format signature.
+
+"""
+
+from binascii import unhexlify
+from struct import pack
+
+from meter.difvif import DataRecordDecoder, split_records
+from meter.OmniPower import OmniPower
+from utils.crc16_wmbus import crc16_wmbus_raw
+
+
+# Decrypted payloads from the documentation in meter/OmniPower.py, records start after CRC16 and TPL-CI
+LONG_PAYLOAD = unhexlify(b'9831780404D700000004843C00000000042B0300000004AB3C00000000')
+SHORT_PAYLOAD = unhexlify(b'117079138C4491CE000000000000000300000000000000')
+
+
+def test_long_layout_is_learnt_for_short_frames():
+    """
+    The signature of the OmniPower layout is the one sent in short telegrams,
+    and a decoder that has seen a long telegram decodes the short ones.
+    """
+    decoder = DataRecordDecoder()
+    assert decoder.decode_compact(SHORT_PAYLOAD, 3) is None
+    assert decoder.unknown_signatures == 1
+
+    plan, values = decoder.decode_full(LONG_PAYLOAD, 3)
+    assert plan.drh == OmniPower.long_telegram_layout
+    assert plan.signature == 0x8C13
+    assert values == (0xD7, 0, 3, 0)
+
+    plan_short, values = decoder.decode_compact(SHORT_PAYLOAD, 3)
+    assert plan_short is plan
+    assert values == (0xCE, 0, 3, 0)
+    assert OmniPower.select_fields(plan, values) == OmniPower.unpack_short_telegram_data_raw(SHORT_PAYLOAD)
+
+
+def test_other_layouts():
+    """
+    Layouts other than OmniPower's: other data sizes, DIFE/VIFE, records without data, and unsupported records.
+    """
+    records = unhexlify(b'0213' + b'3412' + b'8410FD3A' + b'78563412' + b'0074' + b'01FB0D' + b'05') + b'\x2F\x2F'
+    drh = [unhexlify(b'0213'), unhexlify(b'8410FD3A'), unhexlify(b'0074'), unhexlify(b'01FB0D')]
+    assert split_records(records) == drh
+
+    decoder = DataRecordDecoder()
+    plan, values = decoder.decode_full(records)
+    assert values == (0x1234, 0x12345678, 5)
+    assert plan.index[drh[1]] == 1 and drh[2] not in plan.index
+
+    compact = pack('<HH', crc16_wmbus_raw(b''.join(drh)), 0) + pack('<HIB', 1, 2, 3)
+    assert decoder.decode_compact(compact) == (plan, (1, 2, 3))
+
+    # 24 bit integer, and a record cut short
+    assert split_records(unhexlify(b'0313563412')) is None
+    assert split_records(unhexlify(b'0413563412')) is None
+    assert decoder.decode_compact(compact[:5]) is None
@@ -0,0 +1,95 @@
+"""
+Tests for fan-out of telegrams to several subscribers.
+
+"""
+
+import time
+from binascii import unhexlify
+from select import select
+
+from driver.hci import HciFrame
+from driver.fanout import FanoutServer, FanoutClient, LAG, DISCONNECT
+
+
+FRAME = unhexlify(b'a5820327442d2c5768663230028d201a13e00920dddf142f84b1107cae4e84dbcb98210fc275ddc868ce8d2554')
+
+
+def frame(i):
+    return HciFrame(FRAME, 1600000000.0 + i, float(i))
+
+
+def wait_subscribers(server, n):
+    deadline = time.monotonic() + 5
+    while len(server.subscribers) != n:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def receive(client, n):
+    records = []
+    deadline = time.monotonic() + 5
+    while len(records) < n:
+        assert time.monotonic() < deadline
+        select([client], [], [], 0.1)
+        records += client.records()
+    return records
+
+
+def test_every_subscriber_gets_every_telegram(tmpdir):
+    server = FanoutServer(str(tmpdir.join('IM871A.sock')))
+    clients = [FanoutClient(server.path) for _ in range(3)]
+    wait_subscribers(server, 3)
+
+    for i in range(10):
+        server.write(frame(i))
+
+    for client in clients:
+        records = receive(client, 10)
+        assert [bytes(t) for t, _ in records] == [frame(0).telegram] * 10
+        assert [rx['rx_monotonic'] for _, rx in records] == [float(i) for i in range(10)]
+        assert client.lagged == 0
+    server.close()
+
+
+def test_slow_subscriber_lag_flagged(tmpdir):
+    """
+    A subscriber that does not read loses the oldest records, and is told so. Others are not affected.
+    """
+    server = FanoutServer(str(tmpdir.join('IM871A.sock')), queue_size=64, policy=LAG)
+    slow = FanoutClient(server.path)
+    fast = FanoutClient(server.path)
+    wait_subscribers(server, 2)
+
+    # Far more than the slow subscriber's socket buffer and queue can hold
+    received = 0
+    for i in range(5120):
+        server.write(frame(i))
+        if i % 32 == 31:
+            received += len(receive(fast, 32))
+    assert received == 5120
+    assert fast.lagged == 0
+
+    records = []
+    while True:
+        readable, _, _ = select([slow], [], [], 0.2)
+        more = slow.records() if readable else []
+        if not more:
+            break
+        records += more
+    assert len(records) < 5120
+    assert records[-1][1]['rx_monotonic'] == 5119.0
+    assert slow.lagged >= 1
+    assert server.stats()['subscribers'][0]['dropped'] > 0
+    server.close()
+
+
+def test_slow_subscriber_disconnected(tmpdir):
+    server = FanoutServer(str(tmpdir.join('IM871A.sock')), queue_size=4, policy=DISCONNECT)
+    slow = FanoutClient(server.path)
+    wait_subscribers(server, 1)
+
+    for i in range(2000):
+        server.write(frame(i))
+    wait_subscribers(server, 0)
+    assert server.disconnected == 1
+    server.close()
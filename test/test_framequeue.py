@@ -0,0 +1,56 @@
+"""
+Tests for the bounded frame queue between serial reader and pipe writer.
+
+"""
+
+import threading
+
+import pytest
+
+from driver.hci import HciFrame
+from driver.framequeue import FrameQueue, DROP_OLDEST, DROP_NEWEST
+
+
+def frames(n):
+    return [HciFrame(bytes([0xa5, 0x02, 0x03, 0x01, i, 0x00, 0x00]), 0.0, float(i)) for i in range(n)]
+
+
+def test_drop_oldest_keeps_newest():
+    """
+    With drop-oldest, a full queue keeps the latest frames and counts the lost ones.
+    """
+    q = FrameQueue(maxsize=3, policy=DROP_OLDEST)
+    sent = frames(5)
+    assert all(q.put(f) for f in sent)
+
+    assert q.get_all() == sent[2:]
+    assert q.stats() == {'policy': DROP_OLDEST, 'queued': 0, 'high_water': 3, 'received': 5, 'dropped': 2}
+
+
+def test_drop_newest_keeps_oldest():
+    """
+    With drop-newest, frames added to a full queue are refused.
+    """
+    q = FrameQueue(maxsize=3, policy=DROP_NEWEST)
+    sent = frames(5)
+    assert [q.put(f) for f in sent] == [True, True, True, False, False]
+
+    assert q.get_all() == sent[:3]
+    assert q.dropped == 2
+
+
+def test_get_all_waits_for_frame():
+    """
+    The writer sleeps until a reader puts a frame, or the timeout passes.
+    """
+    q = FrameQueue()
+    assert q.get_all(timeout=0.01) == []
+
+    frame = frames(1)[0]
+    threading.Timer(0.05, q.put, args=(frame,)).start()
+    assert q.get_all(timeout=5) == [frame]
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        FrameQueue(policy='drop-random')
@@ -0,0 +1,147 @@
+"""
+Tests for the streaming HCI framer used by the IM871-A driver.
+
+"""
+
+import pytest
+from binascii import unhexlify
+
+from driver.hci import HciFramer, HciFrame, HciDemux, RADIOLINK_ID, DEVMGMT_ID
+
+
+@pytest.fixture
+def frames():
+    """
+    Captured radio frames from IM871-A, with CRC16 attached.
+    """
+    return [unhexlify(b'a5820321442d2c952742761b168d206d82c40222942c7a5414f7be5ea4411ebab435fe4995ff91'),
+            unhexlify(b'a5820327442d2c5768663230028d201a13e00920dddf142f84b1107cae4e84dbcb98210fc275ddc868ce8d2554'),
+            unhexlify(b'a5820321442d2c622842761b168d20d550c00222055d80a5b9011be3fafdf8a7d65cd64c95ffd1')]
+
+
+def test_single_frame(frames):
+    """
+    One read with exactly one frame gives one frame.
+    """
+    framer = HciFramer()
+    out = framer.feed(frames[0])
+
+    assert len(out) == 1
+    assert out[0].raw == frames[0]
+    assert out[0].endpoint == RADIOLINK_ID
+    assert out[0].is_radio_message()
+    assert out[0].payload == frames[0][4:-2]
+    assert len(framer.buffer) == 0
+
+
+def test_concatenated_frames(frames):
+    """
+    Several frames in one read must all be emitted, in order.
+    """
+    framer = HciFramer()
+    out = framer.feed(b''.join(frames))
+
+    assert [f.raw for f in out] == frames
+
+
+def test_partial_frames(frames):
+    """
+    Frames split over many reads are reassembled, byte by byte in the worst case.
+    """
+    framer = HciFramer()
+    stream = b''.join(frames)
+    out = []
+    for i in range(len(stream)):
+        out += framer.feed(stream[i:i + 1])
+
+    assert [f.raw for f in out] == frames
+
+
+def test_resync_after_garbage(frames):
+    """
+    Garbage, including false SOF bytes, before and between frames is skipped.
+    """
+    framer = HciFramer()
+    stream = b'\x00\xa5\x12' + frames[0] + b'\xa5\x82\x03\x05\xff\xff' + frames[1]
+    out = framer.feed(stream)
+
+    assert [f.raw for f in out] == frames[0:2]
+    assert framer.discarded_bytes > 0
+
+
+def test_bad_crc_is_dropped(frames):
+    """
+    A frame with bad CRC16 is dropped, the following good frame still comes through.
+    """
+    framer = HciFramer()
+    bad = frames[0][:-1] + b'\x00'
+    out = framer.feed(bad + frames[1])
+
+    assert [f.raw for f in out] == [frames[1]]
+    assert framer.crc_errors == 1
+
+
+def test_false_sof_without_crc(frames):
+    """
+    A false SOF with a valid endpoint but no CRC16 is not a frame, and does not swallow the real frame after it.
+    """
+    stream = b'\x00\xa5\x01\x02\x04' + frames[0] + frames[1]
+
+    framer = HciFramer()
+    assert [f.raw for f in framer.feed(stream)] == frames[0:2]
+    assert framer.crc_errors == 1
+
+    # Allowed without CRC16, but not followed by a frame
+    framer = HciFramer(require_crc=False)
+    assert [f.raw for f in framer.feed(stream)] == frames[0:2]
+
+    # Radio telegrams always need CRC16
+    framer = HciFramer(require_crc=False)
+    assert [f.raw for f in framer.feed(b'\xa5\x02\x03\x00' + frames[1])] == [frames[1]]
+
+
+def test_command_response_without_crc():
+    """
+    Responses without CRC16 attached are emitted as-is, if frames without CRC16 are allowed.
+    """
+    framer = HciFramer(require_crc=False)
+    out = framer.feed(b'\xa5\x01\x02\x00')
+
+    assert len(out) == 1
+    assert out[0].endpoint == DEVMGMT_ID
+    assert out[0].msg_id == 0x02
+    assert not out[0].is_radio_message()
+
+
+def test_demux_routes_by_endpoint_and_msg_id(frames):
+    """
+    Responses complete the matching pending Future, radio frames go to the data callback.
+    """
+    data = []
+    demux = HciDemux(data.append)
+    framer = HciFramer(require_crc=False)
+
+    ping = demux.expect(DEVMGMT_ID, 0x02)
+    config = demux.expect(DEVMGMT_ID, 0x04)
+
+    for frame in framer.feed(frames[0] + b'\xa5\x01\x04\x01\x00' + frames[1] + b'\xa5\x01\x02\x00'):
+        demux.dispatch(frame)
+
+    assert [f.raw for f in data] == frames[0:2]
+    assert ping.result(timeout=0).msg_id == 0x02
+    assert config.result(timeout=0).payload == b'\x00'
+    assert demux.unexpected == 0
+
+
+def test_demux_forgotten_response_is_unexpected():
+    """
+    A response arriving after its deadline passed is counted and dropped.
+    """
+    demux = HciDemux(lambda f: None)
+    future = demux.expect(DEVMGMT_ID, 0x02)
+    demux.forget(DEVMGMT_ID, 0x02, future)
+
+    demux.dispatch(HciFrame(b'\xa5\x01\x02\x00'))
+
+    assert future.cancelled()
+    assert demux.unexpected == 1
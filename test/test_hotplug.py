@@ -0,0 +1,56 @@
+"""
+Tests for hotplug-aware dongle search.
+
+"""
+
+import os
+import threading
+import time
+
+from utils.hotplug import DongleWatcher
+
+
+LINK = "usb-IMST_GmbH_iM871A-USB_00000001-if00-port0"
+
+
+def test_existing_link_found(tmpdir):
+    """
+    A link already present is returned without waiting.
+    """
+    tmpdir.join(LINK).write('')
+    tmpdir.join("usb-FTDI_other-if00-port0").write('')
+    watcher = DongleWatcher(str(tmpdir))
+
+    assert watcher.ports() == [os.path.join(str(tmpdir), LINK)]
+    assert watcher.wait_for_port(timeout=0) == os.path.join(str(tmpdir), LINK)
+    watcher.close()
+
+
+def test_wait_times_out(tmpdir):
+    """
+    With no dongle, waiting gives up at the timeout.
+    """
+    watcher = DongleWatcher(str(tmpdir.join("by-id")))
+    assert watcher.wait_for_port(timeout=0.1) is None
+    watcher.close()
+
+
+def test_link_appears_with_directory(tmpdir):
+    """
+    Waiting wakes up when the by-id directory and link are created, as udev does after re-enumeration.
+    """
+    by_id = tmpdir.join("serial", "by-id")
+    watcher = DongleWatcher(str(by_id))
+
+    def plug_in():
+        time.sleep(0.1)
+        by_id.ensure(LINK)
+
+    threading.Thread(target=plug_in).start()
+    start = time.monotonic()
+    port = watcher.wait_for_port(os.path.join(str(by_id), LINK), timeout=5)
+    elapsed = time.monotonic() - start
+    watcher.close()
+
+    assert port == os.path.join(str(by_id), LINK)
+    assert elapsed < 1.0
@@ -0,0 +1,160 @@
+"""
+Tests for the message format between driver and main loop.
+
+"""
+
+import io
+import pytest
+from binascii import unhexlify
+from struct import pack
+from datetime import datetime
+
+from driver.hci import HciFrame, HciFramer
+from driver.ipc import format_line, parse_line, encode_record, RecordDecoder, RecordWriter
+from utils.crc16_im871a import crc16_im871a_raw
+from utils.timezone import ZuluTime
+
+
+@pytest.fixture
+def telegram():
+    """
+    A wm-bus telegram as sent to the main loop: length field, payload and CRC16 (dummy).
+    """
+    return unhexlify(b'27442d2c5768663230028d206360dd0320c42b87f46fc048d42498b44b5e34f083e93e6af16176313d9c')
+
+
+def make_frame(telegram: bytes, timestamp: int, rssi: int) -> bytes:
+    """
+    Build an IM871-A radio frame with time stamp, RSSI and CRC16 attached (control nibble 0xE).
+    """
+    length, payload = telegram[0], telegram[1:-2]
+    body = bytes([0xE2, 0x03, length]) + payload + pack('<I', timestamp) + bytes([rssi])
+    return b'\xa5' + body + pack('<H', crc16_im871a_raw(body))
+
+
+def test_frame_with_timestamp_and_rssi(telegram):
+    """
+    Optional fields are parsed, and left out of the telegram passed on.
+    """
+    frames = HciFramer().feed(make_frame(telegram, 123456, 0xC8))
+
+    assert len(frames) == 1
+    assert frames[0].timestamp == 123456
+    assert frames[0].rssi == 0xC8
+    assert frames[0].telegram[:-2] == telegram[:-2]
+    assert frames[0].rx_wall > 0
+
+
+def test_line_round_trip(telegram):
+    """
+    Receive info written by the driver is recovered by the main loop.
+    """
+    frame = HciFramer().feed(make_frame(telegram, 42, 0x90))[0]
+    hex_telegram, rx_info = parse_line(format_line(frame))
+
+    assert unhexlify(hex_telegram) == frame.telegram
+    assert rx_info['rssi'] == 0x90
+    assert rx_info['dongle_time'] == 42
+    assert rx_info['rx_monotonic'] == pytest.approx(frame.rx_monotonic, abs=1e-6)
+    assert rx_info['rx_time'] == datetime.fromtimestamp(round(frame.rx_wall, 6), tz=ZuluTime())
+
+
+def test_plain_hex_line(telegram):
+    """
+    A line with only the hex telegram carries no receive info.
+    """
+    hex_telegram, rx_info = parse_line(telegram.hex())
+
+    assert hex_telegram == telegram.hex().encode()
+    assert rx_info == {}
+
+
+def test_record_round_trip(telegram):
+    """
+    Binary records carry the telegram bytes and receive info, also when read in small pieces.
+    """
+    frame = HciFramer().feed(make_frame(telegram, 42, 0x90))[0]
+    record = encode_record(frame)
+    decoder = RecordDecoder()
+
+    records = []
+    for i in range(len(record) * 2):
+        records += decoder.feed((record * 2)[i:i + 1])
+
+    assert len(records) == 2
+    raw, rx_info = records[0]
+    assert raw == frame.telegram
+    assert rx_info['rssi'] == 0x90
+    assert rx_info['dongle_time'] == 42
+    assert rx_info['rx_monotonic'] == frame.rx_monotonic
+
+
+def test_record_without_rssi(telegram):
+    frame = HciFrame(b'\xa5\x02\x03' + telegram[:-2])
+    (raw, rx_info), = RecordDecoder().feed(encode_record(frame))
+
+    assert raw == frame.telegram
+    assert rx_info['rssi'] is None
+    assert rx_info['dongle_time'] is None
+
+
+def test_decoder_resyncs_after_corrupt_record(telegram):
+    """
+    A record with a corrupt length, or bytes out of step with the records, is skipped,
+    and the valid record after it is still decoded, also when read in small pieces.
+    """
+    frame = HciFramer().feed(make_frame(telegram, 42, 0x90))[0]
+    record = encode_record(frame)
+    bad_length = record[:2] + pack('<H', 0xFFFF) + record[4:]
+    stream = bad_length + record[5:] + b'\n' + record[1:] + record
+
+    decoder = RecordDecoder()
+    records = []
+    for i in range(0, len(stream), 7):
+        records += decoder.feed(stream[i:i + 7])
+
+    assert [raw for raw, rx_info in records] == [frame.telegram]
+    assert records[0][1]['rssi'] == 0x90
+    assert decoder.errors > 0
+    assert len(decoder.buffer) == 0
+
+
+def test_decoder_accepts_hex_lines(telegram):
+    """
+    Hex lines and binary records can be mixed, bad lines are skipped and counted.
+    """
+    frame = HciFramer().feed(make_frame(telegram, 42, 0x90))[0]
+    data = (format_line(frame) + '\n').encode() + b'zz\n' + encode_record(frame) + (telegram.hex() + '\n').encode()
+    decoder = RecordDecoder()
+    records = decoder.feed(data)
+
+    assert [r[0] for r in records] == [frame.telegram, frame.telegram, telegram]
+    assert records[2][1] == {}
+    assert decoder.errors == 1
+
+
+def test_writer_coalesces(telegram):
+    """
+    Records wait for the flush window, and are then written together.
+    """
+    frame = HciFramer().feed(make_frame(telegram, 42, 0x90))[0]
+    out = io.BytesIO()
+    writer = RecordWriter(out, binary=True, flush_window=60)
+
+    writer.write(frame)
+    writer.write(frame)
+    assert out.getvalue() == b''
+    assert 0 < writer.flush_timeout() <= 60
+
+    writer.flush()
+    assert out.getvalue() == encode_record(frame) * 2
+    assert writer.flush_timeout() is None
+
+
+def test_writer_hex_lines(telegram):
+    frame = HciFramer().feed(make_frame(telegram, 42, 0x90))[0]
+    out = io.BytesIO()
+    writer = RecordWriter(out, binary=False, flush_window=0)
+
+    writer.write(frame)
+    assert out.getvalue() == (format_line(frame) + '\n').encode()
@@ -0,0 +1,45 @@
+"""
+Tests for merging telegrams from several IM871-A dongles.
+
+"""
+
+from binascii import unhexlify
+
+from driver.hci import HciFrame
+from driver.multi import TelegramDeduplicator
+
+
+# Two transmissions from the same meter, different ELL-SN
+FRAME_1 = unhexlify(b'a5820327442d2c5768663230028d201a13e00920dddf142f84b1107cae4e84dbcb98210fc275ddc868ce8d2554')
+FRAME_2 = unhexlify(b'a5820327442d2c5768663230028d201b20e00920b34c894aa121ef88baa3f6e4e8b1b4cebe009978e5d7c6b153')
+
+
+def test_same_telegram_from_two_dongles_is_duplicate():
+    """
+    The same telegram heard by two dongles is only passed once.
+    """
+    dedup = TelegramDeduplicator(window=2.0)
+
+    assert not dedup.is_duplicate(HciFrame(FRAME_1, 0.0, 10.00))
+    assert dedup.is_duplicate(HciFrame(FRAME_1, 0.0, 10.05))
+    assert dedup.duplicates == 1
+
+
+def test_new_session_number_is_not_duplicate():
+    """
+    Next transmission from the same meter has a new ELL-SN and must pass.
+    """
+    dedup = TelegramDeduplicator(window=2.0)
+
+    assert not dedup.is_duplicate(HciFrame(FRAME_1, 0.0, 10.0))
+    assert not dedup.is_duplicate(HciFrame(FRAME_2, 0.0, 10.1))
+
+
+def test_window_expires():
+    """
+    Repeats outside the window are not duplicates.
+    """
+    dedup = TelegramDeduplicator(window=2.0)
+
+    assert not dedup.is_duplicate(HciFrame(FRAME_1, 0.0, 10.0))
+    assert not dedup.is_duplicate(HciFrame(FRAME_1, 0.0, 12.5))
@@ -0,0 +1,44 @@
+"""
+Tests for rejecting telegrams by their header, before parsing.
+
+"""
+
+from binascii import unhexlify
+
+from meter.OmniPower import OmniPower
+from meter.prefilter import TelegramPrefilter, SHORT, LENGTH, CI, UNMONITORED
+
+
+# Short telegram from our OmniPower, with CRC16 from the IM871-A
+TELEGRAM = unhexlify(b'27442d2c5768663230028d208e11de0320188851bdc4b72dd3c2954a341be369e9089b4eb3858169494e')
+
+
+def test_monitored_meter_passes():
+    meter = OmniPower(meter_id='32666857')
+    prefilter = TelegramPrefilter({meter.identity: meter})
+
+    assert prefilter.identity(TELEGRAM) == meter.identity
+    assert prefilter.identity(memoryview(TELEGRAM)) == meter.identity
+    assert prefilter.passed == 2
+    assert sum(prefilter.rejected.values()) == 0
+
+
+def test_rejects_counted_by_reason():
+    """
+    Garbage and foreign telegrams are dropped without exceptions, and counted.
+    """
+    monitored = {}
+    prefilter = TelegramPrefilter(monitored)
+
+    assert prefilter.identity(b'') is None
+    assert prefilter.identity(TELEGRAM[:10]) is None
+    assert prefilter.identity(TELEGRAM[:-1]) is None                        # L does not match
+    assert prefilter.identity(TELEGRAM[:10] + b'\x7a' + TELEGRAM[11:]) is None  # CI not ELL
+    assert prefilter.identity(TELEGRAM) is None                             # Nobody monitored
+
+    assert prefilter.stats() == {SHORT: 2, LENGTH: 1, CI: 1, UNMONITORED: 1, 'passed': 0}
+
+    # Meters registered later are seen right away
+    meter = OmniPower(meter_id='32666857')
+    monitored[meter.identity] = meter
+    assert prefilter.identity(TELEGRAM) == meter.identity
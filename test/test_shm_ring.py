@@ -0,0 +1,128 @@
+"""
+Tests for the shared-memory ring between driver and main loop.
+
+"""
+
+import os
+import time
+import tty
+from binascii import unhexlify
+from struct import pack
+
+from driver.hci import HciFrame
+from driver.ipc import decode_record
+from driver.multi import IM871AGroup
+from driver.shm_ring import ShmRingWriter, ShmRingReader
+
+
+FRAME = unhexlify(b'a5820327442d2c5768663230028d201a13e00920dddf142f84b1107cae4e84dbcb98210fc275ddc868ce8d2554')
+
+
+def frame(i):
+    return HciFrame(FRAME, 1600000000.0 + i, float(i))
+
+
+def read_all(reader):
+    return [(bytes(t), rx['rx_monotonic']) for t, rx in (decode_record(r) for r in reader.records())]
+
+
+def test_round_trip(tmpdir):
+    """
+    Published records are read in place, in order, and the doorbell wakes the reader.
+    """
+    path = str(tmpdir.join('ring'))
+    writer = ShmRingWriter(path, capacity=4096, flush_window=60)
+    reader = ShmRingReader(path, capacity=4096)
+
+    assert not reader.wait(0)
+    for i in range(3):
+        writer.write(frame(i))
+    assert read_all(reader) == []       # Not published yet
+
+    writer.flush()
+    assert reader.wait(1)
+    assert read_all(reader) == [(frame(0).telegram, 0.0), (frame(1).telegram, 1.0), (frame(2).telegram, 2.0)]
+    assert reader.fill() == 0.0
+
+
+def test_wraps_and_drops_when_full(tmpdir):
+    """
+    Records wrap around the end of the data area, and are dropped when the reader is behind.
+    """
+    path = str(tmpdir.join('ring'))
+    writer = ShmRingWriter(path, capacity=200)
+    reader = ShmRingReader(path, capacity=200)
+
+    received = []
+    for i in range(20):
+        writer.write(frame(i))
+        writer.flush()
+        received += [rx for _, rx in read_all(reader)]
+    assert received == [float(i) for i in range(20)]
+
+    for i in range(5):
+        writer.write(frame(i))
+    writer.flush()
+    assert writer.dropped == 3
+    assert reader.fill() > 0.5
+    assert len(read_all(reader)) == 2
+
+
+def test_survives_restarts(tmpdir):
+    """
+    A restarted reader continues where the last one stopped, and a restarted writer keeps unread records.
+    """
+    path = str(tmpdir.join('ring'))
+    writer = ShmRingWriter(path, capacity=4096)
+    reader = ShmRingReader(path, capacity=4096)
+    writer.write(frame(1))
+    writer.flush()
+    assert len(read_all(reader)) == 1
+    reader.close()
+
+    writer.write(frame(2))
+    writer.flush()
+    writer.close()
+
+    writer = ShmRingWriter(path, capacity=4096)
+    writer.write(frame(3))
+    writer.flush()
+
+    reader = ShmRingReader(path, capacity=4096)
+    assert [rx for _, rx in read_all(reader)] == [2.0, 3.0]
+
+
+def test_published_under_steady_traffic(tmpdir):
+    """
+    While frames keep coming, so the driver never finds its queue empty, records are still published
+    within the flush window, and do not pile up unpublished until the ring is full.
+    A pseudo-terminal stands in for the dongle, a frame is queued before each read, as its reader thread would.
+    """
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    path = str(tmpdir.join('ring'))
+    group = IM871AGroup(str(tmpdir), [os.ttyname(slave)])
+    assert group.open_ring(path)
+    reader = ShmRingReader(path)
+
+    published = []
+    end = time.monotonic() + 0.5
+    i = 0
+    while time.monotonic() < end:
+        # A new ELL session number for every frame, so none are duplicates
+        i += 1
+        group.queue.put(HciFrame(FRAME[:16] + pack('<I', i) + FRAME[20:], time.time(), time.monotonic()))
+        assert group.read_data()
+        if not published or reader.write_pos != published[-1][1]:
+            published.append((time.monotonic(), reader.write_pos))
+        reader.records()
+        time.sleep(0.0005)
+
+    gaps = [b[0] - a[0] for a, b in zip(published, published[1:])]
+    assert len(published) > 10
+    assert max(gaps) < 0.1
+    assert group.drivers[0].writer.dropped == 0
+
+    group.close()
+    os.close(master)
+    os.close(slave)
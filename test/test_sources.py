@@ -0,0 +1,132 @@
+"""
+Tests for reading from the driver across driver restarts.
+
+"""
+
+import fcntl
+import os
+import time
+import tty
+from binascii import unhexlify
+
+from driver.DriverClass import PIPE_SIZE, F_SETPIPE_SZ
+from driver.hci import HciFrame
+from driver.ipc import encode_record
+from driver.fanout import FanoutServer
+from driver.multi import IM871AGroup
+from driver.sources import FifoSource, SocketSource, GroupSource, FIFO_READ_SIZE
+
+
+FRAME = unhexlify(b'a5820327442d2c5768663230028d201a13e00920dddf142f84b1107cae4e84dbcb98210fc275ddc868ce8d2554')
+NEXT_FRAME = unhexlify(b'a5820327442d2c5768663230028d201b20e00920b34c894aa121ef88baa3f6e4e8b1b4cebe009978e5d7c6b153')
+
+
+def receive(source, n):
+    records = []
+    deadline = time.monotonic() + 5
+    while len(records) < n:
+        assert time.monotonic() < deadline
+        if source.wait(0.1):
+            records += source.records()
+    return records
+
+
+def test_fifo_reopened_after_writer_exits(tmpdir):
+    """
+    EOF reopens the FIFO, after that the source waits quietly for the next writer.
+    """
+    path = str(tmpdir.join('IM871A_pipe'))
+    os.mkfifo(path)
+    source = FifoSource(path)
+    record = encode_record(HciFrame(FRAME, 1600000000.0, 1.0))
+
+    for restart in range(2):
+        with open(path, 'wb') as writer:
+            writer.write(record)
+        assert [bytes(t) for t, _ in receive(source, 1)] == [HciFrame(FRAME, 0.0, 0.0).telegram]
+
+        # Sees EOF, and reopens
+        assert source.wait(1)
+        assert source.records() == []
+        assert source.reconnects == restart + 1
+
+        # No writer, no hot spin
+        assert not source.wait(0.05)
+
+    source.close()
+
+
+def test_fifo_drained_in_one_batch(tmpdir):
+    """
+    A burst larger than one read is returned by one records() call.
+    """
+    path = str(tmpdir.join('IM871A_pipe'))
+    os.mkfifo(path)
+    source = FifoSource(path)
+    writer = os.open(path, os.O_WRONLY)
+    fcntl.fcntl(writer, F_SETPIPE_SZ, PIPE_SIZE)
+
+    record = encode_record(HciFrame(FRAME, 1600000000.0, 1.0))
+    count = 2 * FIFO_READ_SIZE // len(record)
+    os.write(writer, record * count)
+
+    assert source.wait(1)
+    assert len(source.records()) == count
+
+    os.close(writer)
+    source.close()
+
+
+def test_socket_subscribes_again(tmpdir):
+    path = str(tmpdir.join('IM871A.sock'))
+    server = FanoutServer(path)
+    source = SocketSource(path)
+    server.close()
+
+    # Server gone: the closed connection is noticed, and reconnecting fails until it is back
+    assert source.wait(1)
+    assert source.records() == []
+    assert source.client is None
+    assert not source.wait(0.05)
+
+    server = FanoutServer(path)
+    deadline = time.monotonic() + 5
+    while source.client is None:
+        assert time.monotonic() < deadline
+        source.wait(0.5)
+    assert source.reconnects == 1
+
+    while not server.subscribers:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    server.write(HciFrame(FRAME, 1600000000.0, 1.0))
+    assert len(receive(source, 1)) == 1
+
+    source.close()
+    server.close()
+
+
+def test_group_in_process(tmpdir):
+    """
+    Frames read by the dongle thread reach the main loop without pipe, filtered by meter.
+    A pseudo-terminal stands in for the dongle.
+    """
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    source = GroupSource(IM871AGroup(str(tmpdir), [os.ttyname(slave)]))
+
+    os.write(master, FRAME)
+    (raw, rx_info), = receive(source, 1)
+    assert raw == HciFrame(FRAME).telegram
+    assert rx_info['rx_monotonic'] > 0
+
+    source.set_meters([('2C2D', '00000000')])
+    os.write(master, FRAME)
+    assert not source.wait(0.2)
+    source.set_meters([('2C2D', '32666857')])
+    os.write(master, NEXT_FRAME)
+    assert len(receive(source, 1)) == 1
+
+    source.close()
+    os.close(master)
+    os.close(slave)
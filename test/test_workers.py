@@ -0,0 +1,96 @@
+"""
+Tests for decrypting telegrams in a pool of workers.
+
+"""
+
+import os
+import signal
+import threading
+import time
+from binascii import unhexlify
+from datetime import datetime
+
+import pytest
+
+from meter.OmniPower import C1Telegram, OmniPower
+from run.workers import DecryptPool, PROCESS, THREAD
+from utils.timezone import ZuluTime
+
+
+zulu_time = ZuluTime()
+
+# Telegrams from our OmniPower, short and long
+TELEGRAMS = [unhexlify(t) for t in (
+    b'27442d2c5768663230028d208e11de0320188851bdc4b72dd3c2954a341be369e9089b4eb3858169494e',
+    b'2d442d2c5768663230028d206461dd032038931d14b405536e0250592f8b908138d58602eca676ff79e0caf0b14d0e7d',
+    b'27442d2c5768663230028d206e90dd03201dfbbd7871e6ec990f60ee940532c09e505bd4cac5728e2864')]
+
+
+@pytest.mark.parametrize('mode', [THREAD, PROCESS])
+def test_pool_matches_main_loop(mode):
+    """
+    The workers give the same measurement frames as the meter in the main loop, in the order received.
+    A meter belongs to one worker, and telegrams from meters not sent to the workers give nothing.
+    """
+    meter = OmniPower()
+    rx_info = {'rx_time': datetime(2020, 11, 3, tzinfo=zulu_time), 'rssi': 0xB4}
+    expected = []
+    for raw in TELEGRAMS:
+        assert meter.process_telegram(C1Telegram.from_bytes(raw, **rx_info))
+        expected.append(meter.measurement_log.pop().as_dict())
+
+    pool = DecryptPool(2, mode)
+    try:
+        m, a, version, medium = meter.identity
+        assert pool.worker_of((m, a + 2, version, medium)) == pool.worker_of(meter.identity)
+
+        # No meters yet
+        pool.submit(meter.identity, TELEGRAMS[0], {})
+        assert pool.collect() == []
+
+        pool.set_meters([meter, OmniPower(meter_id='not-hex')])
+        for raw in TELEGRAMS:
+            pool.submit(meter.identity, memoryview(raw), rx_info)
+        frames = pool.collect()
+
+        assert [identity for identity, frame in frames] == [meter.identity] * len(TELEGRAMS)
+        assert [frame.as_dict() for identity, frame in frames] == expected
+        assert pool.collect() == []
+        assert pool.timeouts == 0
+    finally:
+        pool.close()
+
+
+def test_dead_worker_started_again():
+    """
+    A killed worker process is started again with its meters, and its meters' telegrams are still decrypted,
+    without waiting for the timeout.
+    """
+    meter = OmniPower()
+    rx_info = {'rx_time': datetime(2020, 11, 3, tzinfo=zulu_time), 'rssi': 0xB4}
+
+    pool = DecryptPool(2, PROCESS)
+    try:
+        pool.set_meters([meter])
+        i = pool.worker_of(meter.identity)
+
+        # Dead before the batch
+        worker = pool.workers[i]
+        os.kill(worker.pid, signal.SIGKILL)
+        worker.join(1)
+        pool.submit(meter.identity, TELEGRAMS[0], rx_info)
+        start = time.monotonic()
+        assert [identity for identity, frame in pool.collect(timeout=5)] == [meter.identity]
+        assert time.monotonic() - start < 2
+        assert pool.restarts == 1 and pool.workers[i].is_alive()
+
+        # Dying during the batch
+        os.kill(pool.workers[i].pid, signal.SIGSTOP)
+        pool.submit(meter.identity, TELEGRAMS[1], rx_info)
+        threading.Timer(0.2, os.kill, (pool.workers[i].pid, signal.SIGKILL)).start()
+        start = time.monotonic()
+        assert [identity for identity, frame in pool.collect(timeout=5)] == [meter.identity]
+        assert time.monotonic() - start < 2
+        assert pool.restarts == 2 and pool.timeouts == 0
+    finally:
+        pool.close()
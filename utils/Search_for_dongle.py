@@ -22,11 +22,13 @@ This method first confirms the directory /dev/serial/by-id exist, afterwards loo
 If any the method will return the absolute path. If Several links contains "iM871a" the method will return path
 to first encountered link.
 
+To use several dongles on one gateway, `im871a_ports` returns the paths of all links containing "iM871a".
+
 """
 
 import os
 import serial as port  # type: ignore
-from typing import Any
+from typing import Any, List
 
 
 def im871a_port() -> Any:
@@ -47,6 +49,24 @@ def im871a_port() -> Any:
         raise Exception("No serial devices are found.")
 
 
+def im871a_ports() -> List[str]:
+    """
+    Returns absolute paths to all IM871A links in /dev/serial/by-id, sorted by name.
+    Raises an exception if none are found.
+    """
+    directory = os.path.join("/dev", "serial", "by-id")     #/dev/serial/by-id
+    match = "iM871A"
+
+    if not os.path.exists(directory):
+        raise Exception("No serial devices are found.")
+
+    ports = sorted(os.path.join(directory, f) for f in os.listdir(directory) if match in f)
+    if len(ports) == 0:
+        raise Exception("No IM871A-Link found in /dev/serial/by-id")
+
+    return ports
+
+
 if __name__ == '__main__':
     try:
         path = im871a_port()
@@ -9,11 +9,13 @@ Implementation of CRC16 for IM871-A (CCITT)
 - See IMST's WMBUS_HCL_Spec_V1.6.pdf.
 - CRC computation starts from the Control Field and ends with the last octet of the Payload Field.
 - IM871A uses CRC16-CCITT Polynomial G(x) = 1 + x^5 + x^12 + x^16.
+- `crc16_im871a_raw` computes the same CRC byte-wise with a lookup table, directly on raw bytes.
 
 """
 
-from binascii import hexlify
-from struct import pack
+from binascii import hexlify, unhexlify
+from struct import pack, unpack
+from typing import List
 
 
 def crc16_im871a_calc(m: bytes) -> bytes:
@@ -50,6 +52,40 @@ def crc16_im871a_calc(m: bytes) -> bytes:
     return crc16
 
 
+def _make_table() -> List[int]:
+    """
+    Precompute the CRC16 remainder for each of the 256 possible byte values.
+    Uses the same reflected generator polynomial as `crc16_im871a_calc`.
+    """
+    g = 0x8408
+    table = []
+    for b in range(0, 256):
+        crc = b
+        for _ in range(0, 8):
+            if crc & 1:
+                crc = (crc >> 1) ^ g
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+
+_CRC16_TABLE = _make_table()
+
+
+def crc16_im871a_raw(m: bytes) -> int:
+    """
+    Compute CRC16 (CCITT) on raw bytes, i.e. not hex encoded, and return it as an integer.
+    Argument follows the same rules as for `crc16_im871a_calc`, from control field to end of payload.
+    The CRC is sent little-endian by IM871-A, so compare with `unpack('<H', ...)` of the received CRC field.
+    """
+    crc = 0xFFFF
+    table = _CRC16_TABLE
+    for b in m:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+    return crc ^ 0xFFFF
+
+
 def crc16_im871a_check(m: bytes) -> bool:
     """
     Confirm CRC16 integrity of a full bytestring received from IM871-A.
@@ -85,6 +121,10 @@ def test_crc16():
     for test_vector in test_full_frames:
         assert crc16_im871a_check(test_vector) == True
 
+        # Table-driven version on raw bytes must agree
+        raw = unhexlify(test_vector)
+        assert crc16_im871a_raw(raw[1:-2]) == unpack('<H', raw[-2:])[0]
+
 
 if __name__ == '__main__':
     print("Self test:")
@@ -60,14 +60,102 @@ when no further division is possible.
 
 Algorithm implementation comments:
 ----------------------------------
-The implemented algorithm uses Python's ability for 'infinite' width of integers.
-That is slightly inefficient, and can't be ported to C code on an embedded device.
-But it is significantly easier to debug and understand than byte-wise algorithms or lookup tables.
+The first implementation used Python's ability for 'infinite' width of integers, dividing the whole message
+bit by bit. That was easy to debug, but slow. Now the CRC16 is computed with lookup tables, on binary data
+(bytes or memoryview):
+
+- `CRC16_TABLE[i]` is the remainder of byte i shifted through the 16-bit register, 8 divisions at once.
+- `CRC16_TABLE_HI[i]` is the same for a byte 8 bits further up, i.e. followed by another 8 divisions.
+- The message is taken 16 bits at a time: the register is XOR'ed with the next two bytes, and the new
+  register is one lookup in each table ("slicing-by-2"). An odd last byte is taken alone.
+
+`Crc16` computes the CRC16 of a message given in parts, with `update()`, e.g. block by block.
+`crc16_wmbus_raw` and `crc16_check_raw` take the whole message, as used when decrypting.
+The hex functions `crc16_wmbus` and `crc16_check` give the same as before, for debugging and the self-test.
 
 """
 
-from binascii import hexlify
-from struct import pack
+from binascii import hexlify, unhexlify
+from struct import unpack, Struct
+from typing import Tuple, Union
+
+
+CRC16_POLY = 0x3D65
+CRC16_FIELD = Struct('<H')      # CRC16 as stored in a payload, little-endian
+
+
+def _crc16_table(shift: int) -> Tuple[int, ...]:
+    # Remainder of each byte value, shifted left into the register by shift bits, then 8 divisions more
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8 + shift):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ CRC16_POLY) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16_TABLE = _crc16_table(0)
+CRC16_TABLE_HI = _crc16_table(8)
+
+
+def _crc16_update(crc: int, message: Union[bytes, memoryview]) -> int:
+    # Register before the final complement, after message
+    table, table_hi = CRC16_TABLE, CRC16_TABLE_HI
+    words = len(message) // 2
+    for word in unpack('>{}H'.format(words), message[:2 * words]):
+        crc ^= word
+        crc = table_hi[crc >> 8] ^ table[crc & 0xFF]
+    if len(message) & 1:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ message[-1]]
+    return crc
+
+
+class Crc16:
+    """
+    CRC16 of a message given in parts, e.g. block by block. Takes the first part, if any.
+    """
+
+    __slots__ = ('_crc',)
+
+    def __init__(self, message: Union[bytes, memoryview] = b'') -> None:
+        self._crc = _crc16_update(0x0000, message)
+
+    def update(self, message: Union[bytes, memoryview]) -> None:
+        """
+        Add the next part of the message.
+        """
+        self._crc = _crc16_update(self._crc, message)
+
+    @property
+    def value(self) -> int:
+        """
+        CRC16 of the message so far, as an integer.
+        """
+        return self._crc ^ 0xFFFF
+
+    def digest(self) -> bytes:
+        """
+        CRC16 of the message so far, little-endian as stored in telegrams.
+        """
+        return CRC16_FIELD.pack(self._crc ^ 0xFFFF)
+
+    def hexdigest(self) -> bytes:
+        """
+        CRC16 of the message so far, as hex of the little-endian bytes, like crc16_wmbus.
+        """
+        return hexlify(self.digest())
+
+    def copy(self) -> 'Crc16':
+        """
+        Another Crc16 with the same state, e.g. to check a prefix and continue.
+        """
+        other = Crc16()
+        other._crc = self._crc
+        return other
 
 
 def crc16_wmbus(message: bytes) -> bytes:
@@ -79,37 +167,41 @@ def crc16_wmbus(message: bytes) -> bytes:
 
     """
 
-    crc_bits = 16
-    hex_radix = 16
+    # The message is a number, so an odd number of digits has a leading zero, and there must be digits
+    if not message:
+        raise ValueError("No hex digits in message")
+    message = message.zfill(len(message) + len(message) % 2)
 
-    g = 0x3d65                                  # Generator polynomial, g(x)
-    m = int(message, hex_radix) << crc_bits     # Message, m(x), shifted to make space for 16-bit CRC
-    crc = m                                     # Start with m(x)<<16 (initial crc=remainder is 0x0000)
+    # Return as little-endian 16-bit to match how CRC16's are stored in telegrams
+    return hexlify(CRC16_FIELD.pack(crc16_wmbus_raw(unhexlify(message))))
 
-    m_bitlen = len(bin(m)[2:])                  # Hacky method to get number of bits req. to represent m(x)
-    g_bitlen = crc_bits                         # Poly is 16 bits
 
-    # Loop over each bit, from highest to lowest
-    # Continue while remainder is larger than polynomial (i.e. still divisions to perform)
-    for n in range(m_bitlen - 1, g_bitlen - 1, -1):
-        # Step 1 Check if most significant bit is 1
-        if crc & (1 << n):
-            # If yes, perform division and subtract to get remainder (XOR)
-            g_shift = g << (n - g_bitlen)     # Shift polynomial
-            crc = (crc ^ g_shift) % 2**n      # mod 2^n is to emulate << 1 (but Py doesn't shift out to the left)
-        else:
-            # If not, move on to next
-            pass
+def crc16_wmbus_raw(message: Union[bytes, memoryview]) -> int:
+    """
+    Takes a message as binary data. Returns the CRC16 value as an integer.
 
-        # Repeat
+    Example: f(unhexlify(b'79138C4491CE000000000000000300000000000000')) -> 0x7011.
 
+    """
     # Perform final complement
-    crc = crc ^ 0xFFFF
+    return _crc16_update(0x0000, message) ^ 0xFFFF
 
-    # Return as little-endian 16-bit to match how CRC16's are stored in telegrams
-    crc_hex = hexlify(pack('<H', crc))
 
-    return crc_hex
+def crc16_check_raw(payload: Union[bytes, memoryview]) -> bool:
+    """
+    Takes a binary payload, starting with its CRC16-field (little-endian), followed by the message.
+    Return True if the CRC16 computed on the message matches.
+    Raises CrcCheckException if no match.
+    """
+    crc16_recv = CRC16_FIELD.unpack_from(payload)[0]
+    crc16_calc = crc16_wmbus_raw(payload[CRC16_FIELD.size:])
+
+    if crc16_recv == crc16_calc:
+        return True
+    else:
+        # Hex only for the message
+        raise CrcCheckException(hexlify(CRC16_FIELD.pack(crc16_recv)), hexlify(CRC16_FIELD.pack(crc16_calc)),
+                                "CRC check fail. No match.")
 
 
 def crc16_check(payload: bytes) -> bool:
@@ -172,3 +264,13 @@ if __name__ == '__main__':
     expected_crc = b'0fe6'
     data = b'780404CE00000004843C00000000042B0300000004AB3C00000000'
     assert crc16_wmbus(data) == expected_crc
+
+    # Binary functions give the same
+    assert crc16_wmbus_raw(unhexlify(data)) == unpack('<H', unhexlify(expected_crc))[0]
+    assert crc16_check_raw(unhexlify(expected_crc + data))
+
+    # Also given in parts, of odd and even length
+    crc = Crc16(unhexlify(data)[:3])
+    crc.update(memoryview(unhexlify(data))[3:10])
+    crc.update(unhexlify(data)[10:])
+    assert crc.hexdigest() == expected_crc
@@ -0,0 +1,167 @@
+"""
+Hotplug-aware search for IM871A dongles
+***************************************
+
+:synopsis: Waits for an IM871A link to (re)appear in /dev/serial/by-id, without polling.
+
+If the USB stick re-enumerates, e.g. after a USB reset or being re-plugged, udev removes
+and recreates its link in /dev/serial/by-id. This module watches the directory with inotify,
+and wakes up as soon as the link is back.
+
+- udev removes /dev/serial/by-id (and /dev/serial) when the last serial device is gone.
+  The watch is therefore placed on the deepest of these directories that exists,
+  and moved whenever something changes.
+- inotify is reached through the C library with ctypes, as Python has no binding for it.
+  If that fails, the watcher falls back to checking the directory every `POLL_INTERVAL` seconds.
+
+`recover` ties it together for a driver whose serial port failed: it waits for the link,
+reconnects and sets up link mode again, and logs how long the dongle was gone.
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import time
+from select import select
+from typing import Any, List, Optional
+
+from utils.log import log_error, log_info
+
+
+BY_ID_DIRECTORY = os.path.join("/dev", "serial", "by-id")
+MATCH = "iM871A"
+POLL_INTERVAL = 0.5
+RETRY_INTERVAL = 1.0      # Pause before retrying a reconnect that failed, in seconds
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+WATCH_MASK = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+
+class DongleWatcher:
+    """
+    Watches a by-id directory and waits for IM871A links to appear.
+    """
+
+    def __init__(self, directory: str = BY_ID_DIRECTORY) -> None:
+        self.directory = directory
+        self.__fd = -1
+        self.__wd = -1
+        self.__libc = None
+
+        try:
+            self.__libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            self.__fd = fd
+        except (OSError, AttributeError) as err:
+            log_error("inotify not available, polling for dongle instead: {}".format(err))
+
+    def ports(self) -> List[str]:
+        """
+        Paths of all IM871A links currently in the directory, sorted.
+        """
+        try:
+            return sorted(os.path.join(self.directory, f) for f in os.listdir(self.directory) if MATCH in f)
+        except OSError:
+            return []
+
+    def __rearm(self) -> None:
+        """
+        Move the watch to the deepest existing directory on the way to the by-id directory.
+        """
+        if self.__wd >= 0:
+            self.__libc.inotify_rm_watch(self.__fd, self.__wd)
+            self.__wd = -1
+
+        path = self.directory
+        while path != os.path.dirname(path):
+            if os.path.isdir(path):
+                self.__wd = self.__libc.inotify_add_watch(self.__fd, path.encode(), WATCH_MASK)
+                if self.__wd >= 0:
+                    return
+            path = os.path.dirname(path)
+
+    def __drain(self) -> None:
+        """
+        Read and discard pending events. Content does not matter, the directory is listed again anyway.
+        """
+        while True:
+            try:
+                if not os.read(self.__fd, 4096):
+                    return
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    return
+                raise
+
+    def wait_for_port(self, port_path: Optional[str] = None, timeout: Optional[float] = None) -> Optional[str]:
+        """
+        Wait until a dongle link exists and return its path.
+        If port_path is given, wait for that specific link, otherwise for any IM871A link.
+        Returns None if timeout (seconds) passes first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            # Arm before looking, so a link created in between still wakes us up
+            if self.__fd >= 0:
+                self.__rearm()
+
+            if port_path is not None:
+                if os.path.exists(port_path):
+                    return port_path
+            else:
+                ports = self.ports()
+                if ports:
+                    return ports[0]
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+
+            if self.__fd >= 0:
+                readable, _, _ = select([self.__fd], [], [], remaining)
+                if readable:
+                    self.__drain()
+            else:
+                time.sleep(POLL_INTERVAL if remaining is None else min(POLL_INTERVAL, remaining))
+
+    def close(self) -> None:
+        """
+        Release the inotify instance.
+        """
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+            self.__wd = -1
+
+
+def recover(driver: Any, mode: str, watcher: DongleWatcher, port_path: Optional[str] = None) -> float:
+    """
+    Bring an IM871A driver back after its serial port failed.
+    Waits for the dongle link (port_path, or any IM871A if None), then reconnects and sets up link mode,
+    retrying until it succeeds. Returns the duration of the outage in seconds, which is also logged.
+    """
+    outage_start = time.monotonic()
+    log_error("IM871A on {} lost, waiting for it to come back".format(driver.Port))
+
+    while True:
+        found = watcher.wait_for_port(port_path)
+        if driver.reconnect(mode, found):
+            break
+        # Link is there, but the tty may not be usable yet (e.g. udev still setting permissions)
+        time.sleep(RETRY_INTERVAL)
+
+    outage = time.monotonic() - outage_start
+    log_info("IM871A back on {} after {:.1f} s outage".format(driver.Port, outage))
+    return outage
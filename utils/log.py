@@ -1,58 +1,53 @@
 import logging
 import logging.handlers
+import threading
+
+
+# Logger is set up once, on first use, see get_logger()
+LOGGER_NAME = 'TEAM 3: '
+SYSLOG_ADDRESS = '/dev/log'
+_setup_lock = threading.Lock()
+
+
+def get_logger() -> logging.Logger:
+    """
+    The logger sending to syslog. The syslog handler is created on first use and kept,
+    instead of opening a new connection to syslog for every message.
+    """
+    # Create logger with specific name
+    logger = logging.getLogger(LOGGER_NAME)
+    if logger.handlers:
+        return logger
+
+    with _setup_lock:
+        if not logger.handlers:
+            # Setting logger level
+            logger.setLevel(logging.INFO)
+
+            # Create handler addressed to syslog
+            handler = logging.handlers.SysLogHandler(address=SYSLOG_ADDRESS)
+
+            # Create and add formatter to handler
+            formatter = logging.Formatter('%(name)s %(levelname)s: %(message)s')
+            handler.setFormatter(formatter)
+
+            # Add handler to logger
+            logger.addHandler(handler)
+
+    return logger
+
 
 def log_error(message) -> None:
     """
     Function for sending logging message to syslog file.
     Use this one for error messages.
     """
-    # Create logger with specific name
-    logger = logging.getLogger('TEAM 3: ')
-
-    # Setting logger level 
-    logger.setLevel(logging.INFO)
-    
-    # Create handler addressed to syslog
-    handler = logging.handlers.SysLogHandler(address = '/dev/log')
-    
-    # Create and add formatter to handler
-    formatter = logging.Formatter('%(name)s %(levelname)s: %(message)s')
-    handler.setFormatter(formatter)
-    
-    # Add handler to logger
-    logger.addHandler(handler)
-
-    # Log message
-    logger.error(message)
-
-    # Remove the handle after logging
-    logger.removeHandler(handler)
-    
+    get_logger().error(message)
+
 
 def log_info(message) -> None:
     """
     Function for sending logging message to syslog file.
     Use this one for info messages.
     """
-    # Create logger with specific name
-    logger = logging.getLogger('TEAM 3: ')
-
-    # Setting logger level 
-    logger.setLevel(logging.INFO)
-    
-    # Create handler addressed to syslog
-    handler = logging.handlers.SysLogHandler(address = '/dev/log')
-    
-    # Create and add formatter to handler
-    formatter = logging.Formatter('%(name)s %(levelname)s: %(message)s')
-    handler.setFormatter(formatter)
-    
-    # Add handler to logger
-    logger.addHandler(handler)
-
-    # Log message
-    logger.info(message)
-
-    # Remove the handle after logging
-    logger.removeHandler(handler)
-
+    get_logger().info(message)